@@ -1,40 +1,83 @@
 import asyncio
-from flask import Flask, request, jsonify, send_file
+import uvicorn
+from quart import Quart, Response, request
+import orjson
 from datetime import datetime
 import logging
-import io
 import base64
-import threading
+import multiprocessing
 import time
+import urllib.request
 from response_engine import ResponseEngine
 from database import init_database, UserManager
-from config import LLM_MODEL, HTTP_PORT, GRADIO_PORT
-from voice_processor import VoiceProcessor
-from functools import wraps
+from config import get_settings
+from voice_processor import voice_result_headers
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+S = get_settings()
+
+# 配置日志（生产环境默认WARNING，可通过LOG_LEVEL调整）
+logging.basicConfig(level=S.log_level)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Quart与Flask接口兼容，但原生运行在ASGI事件循环上
+app = Quart(__name__)
+
+# 语音处理器和所有请求共用的响应引擎（避免每次请求重新初始化RAG、搜索工具和语音处理器）
+# 在服务启动时创建，Gradio子进程和uvicorn工作进程导入本模块时不会重复构建
+voice_processor = None
+response_engine = None
+
+# 单次历史查询最多返回的记录数
+MAX_HISTORY_LIMIT = 100
 
-# 初始化数据库
-init_database()
+@app.before_serving
+async def init_services():
+    global voice_processor, response_engine
+    init_database()
+    response_engine = ResponseEngine()
+    # 复用响应引擎内的语音处理器，每个进程只加载一次本地识别模型、只维护一组HTTP会话
+    voice_processor = response_engine.voice_processor
+    voice_processor.start_warmup()
 
-# 初始化语音处理器
-voice_processor = VoiceProcessor()
+@app.after_serving
+async def close_services():
+    await voice_processor.aclose()
 
+# 低精度时间戳缓存：0.5秒内的请求复用同一个ISO字符串
+_now_cache = ("", 0.0)
 
+def now_iso() -> str:
+    """返回缓存的当前时间ISO字符串"""
+    global _now_cache
+    t = time.time()
+    cached, last = _now_cache
+    if t - last > 0.5:
+        cached = datetime.fromtimestamp(t).isoformat()
+        _now_cache = (cached, t)
+    return cached
 
-def async_to_sync(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
-    return wrapper
+def ojsonify(obj, status: int = 200) -> Response:
+    """使用orjson直接序列化为bytes，替代jsonify"""
+    return Response(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), status=status, mimetype='application/json')
+
+def wait_for_api(timeout: float = 60.0) -> bool:
+    """轮询健康检查接口，直到API服务可用或超时"""
+    health_url = f"http://localhost:{S.http_port}/health"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(health_url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except Exception:
+            pass
+        time.sleep(0.05)
+    return False
 
 def start_gradio_interface():
-    """在后台线程中启动Gradio界面"""
-    time.sleep(2)  # 等待Flask启动
+    """在独立进程中启动Gradio界面（与API服务不共享GIL）"""
+    if not wait_for_api():
+        logger.warning("等待API服务超时，仍继续启动Gradio界面")
     
     try:
         print(" 正在启动Gradio Web界面...")
@@ -50,124 +93,169 @@ def start_gradio_interface():
         print(f" Gradio启动失败: {e}")
 
 @app.route('/chat', methods=['POST'])
-def chat_api():
+async def chat_api():
     """文本聊天API接口"""
     try:
-        data = request.get_json()
+        data = await request.get_json()
         
         # 验证请求数据
         if not data or 'phone_number' not in data or 'query' not in data:
-            return jsonify({
+            return ojsonify({
                 "error": "缺少必要参数: phone_number 和 query"
-            }), 400
+            }, status=400)
         
         phone_number = data['phone_number']
         query = data['query']
         
-        # 处理聊天请求
-        engine = ResponseEngine()
-        result = engine.process_query(phone_number, query, channel='text')
-        result["timestamp"] = datetime.now().isoformat()
+        # 处理聊天请求（阻塞步骤在线程池中执行，常规问答与并发请求合并生成回复）
+        result = await response_engine.process_query_batched(phone_number, query, 'text')
+        result["timestamp"] = now_iso()
         
-        return jsonify(result)
+        return ojsonify(result)
         
     except Exception as e:
         logger.error(f"API处理错误: {e}")
-        return jsonify({
+        return ojsonify({
             "error": "服务器内部错误",
             "message": str(e)
-        }), 500
+        }, status=500)
+
+async def _iterate_in_thread(iterator):
+    """在线程池中逐项推进同步迭代器，避免阻塞事件循环"""
+    sentinel = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, sentinel)
+        if item is sentinel:
+            break
+        yield item
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream_api():
+    """流式文本聊天API接口：模型输出的回复文本逐段以分块传输返回"""
+    data = await request.get_json()
+    
+    # 验证请求数据
+    if not data or 'phone_number' not in data or 'query' not in data:
+        return ojsonify({
+            "error": "缺少必要参数: phone_number 和 query"
+        }, status=400)
+    
+    chunks = response_engine.process_query_stream(data['phone_number'], data['query'], 'text')
+    return Response(_iterate_in_thread(chunks), mimetype="text/plain; charset=utf-8")
 
 @app.route('/voice/chat', methods=['POST'])
-@async_to_sync
 async def voice_chat_api():
     """语音聊天API接口"""
     try:
         # 获取请求数据
-        phone_number = request.form.get('phone_number')
-        audio_file = request.files.get('audio')
+        form = await request.form
+        files = await request.files
+        phone_number = form.get('phone_number')
+        audio_file = files.get('audio')
         
         if not phone_number or not audio_file:
-            return jsonify({
+            return ojsonify({
                 "error": "缺少必要参数: phone_number 和 audio"
-            }), 400
+            }, status=400)
         
         # 读取音频数据
         audio_data = audio_file.read()
         
         # 处理语音请求
-        engine = ResponseEngine()
-        result = await engine.process_voice_query(phone_number, audio_data)
+        result = await response_engine.process_voice_query(phone_number, audio_data)
         
         if "error" in result:
-            return jsonify(result), 400
-        
-        result["timestamp"] = datetime.now().isoformat()
-        
-        # 如果有音频回复，返回音频
-        if result.get("audio_response"):
-            return send_file(
-                io.BytesIO(result["audio_response"]),
-                mimetype='audio/wav',
-                as_attachment=False,
-                download_name='response.wav'
-            )
-        else:
-            # 确保返回的JSON结构正确
-            # 检查并确保必要字段存在
-            response_data = {
-                "user_id": result.get("user_id", 0),
-                "is_new_user": result.get("is_new_user", False),
-                "intent": result.get("intent", "C"),
-                "response": result.get("response", ""),
-                "recognized_text": result.get("recognized_text", ""),
-                "channel": result.get("channel", "voice"),
-                "intent_description": result.get("intent_description", ""),
-                "timestamp": result.get("timestamp")
-            }
-            return jsonify(response_data)
+            return ojsonify(result, status=400)
+        
+        result["timestamp"] = now_iso()
+        audio_response = result.get("audio_response")
+        
+        # 默认：有音频回复时直接返回音频，识别文本、回复等元数据放在响应头中
+        # 直接以bytes作为响应体一次性发送，不经BytesIO按8KB分块读取
+        if audio_response and form.get('response_format') != 'json':
+            return Response(audio_response, mimetype='audio/wav', headers=voice_result_headers(result))
+        
+        # 确保返回的JSON结构正确
+        # 检查并确保必要字段存在
+        response_data = {
+            "user_id": result.get("user_id", 0),
+            "is_new_user": result.get("is_new_user", False),
+            "intent": result.get("intent", "C"),
+            "response": result.get("response", ""),
+            "recognized_text": result.get("recognized_text", ""),
+            "channel": result.get("channel", "voice"),
+            "intent_description": result.get("intent_description", ""),
+            "timestamp": result.get("timestamp")
+        }
+        
+        # response_format=json：识别文本、回复和音频在一次请求中一起返回
+        if audio_response:
+            response_data["audio_base64"] = base64.b64encode(audio_response).decode("ascii")
+        return ojsonify(response_data)
         
     except Exception as e:
         logger.error(f"语音API处理错误: {e}")
-        return jsonify({
+        return ojsonify({
             "error": "服务器内部错误",
             "message": str(e)
-        }), 500
+        }, status=500)
 
 @app.route('/voice/recognize', methods=['POST'])
 async def voice_recognize_api():
     """语音识别API"""
     try:
-        audio_file = request.files.get('audio')
+        files = await request.files
+        audio_file = files.get('audio')
         if not audio_file:
-            return jsonify({"error": "缺少音频文件"}), 400
+            return ojsonify({"error": "缺少音频文件"}, status=400)
         
         audio_data = audio_file.read()
         text, error = await voice_processor.speech_to_text(audio_data)
         
         if error:
-            return jsonify({"error": error}), 400
+            return ojsonify({"error": error}, status=400)
         
-        return jsonify({
+        return ojsonify({
             "recognized_text": text,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso()
         })
         
     except Exception as e:
         logger.error(f"语音识别错误: {e}")
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}, status=500)
 
 
 
+@app.route('/voice/stream', methods=['POST'])
+async def voice_stream_api():
+    """流式语音识别API：请求体为16kHz单声道16bit PCM，边接收边转发给ASR"""
+    try:
+        text, error = await voice_processor.speech_to_text_stream(request.body)
+        
+        if error:
+            return ojsonify({"error": error}, status=400)
+        
+        return ojsonify({
+            "recognized_text": text,
+            "timestamp": now_iso()
+        })
+        
+    except Exception as e:
+        logger.error(f"流式语音识别错误: {e}")
+        return ojsonify({"error": str(e)}, status=500)
+
 @app.route('/user/<phone_number>/history', methods=['GET'])
-def get_user_history(phone_number):
-    """获取用户对话历史"""
+async def get_user_history(phone_number):
+    """获取用户对话历史，支持 ?limit=10&offset=0 分页（在数据库中完成）"""
     try:
+        limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_HISTORY_LIMIT)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        
         user_manager = UserManager()
-        user_id, _ = user_manager.get_or_create_user(phone_number)
-        history = user_manager.get_user_conversations(user_id)
+        user_id, _ = await asyncio.to_thread(user_manager.get_or_create_user, phone_number)
+        history = await asyncio.to_thread(user_manager.get_user_conversations, user_id, limit, offset)
         
-        return jsonify({
+        return ojsonify({
             "phone_number": phone_number,
             "user_id": user_id,
             "conversation_history": history
@@ -175,15 +263,15 @@ def get_user_history(phone_number):
         
     except Exception as e:
         logger.error(f"获取用户历史失败: {e}")
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}, status=500)
 
 @app.route('/health', methods=['GET'])
-def health_check():
+async def health_check():
     """健康检查端点"""
-    return jsonify({
+    return ojsonify({
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
-        "model": LLM_MODEL,
+        "timestamp": now_iso(),
+        "model": S.llm_model,
         "voice_enabled": voice_processor.processor is not None
     })
 
@@ -194,17 +282,28 @@ if __name__ == '__main__':
     
     # 打印API信息
     print(f" 后端API服务:")
-    print(f"   - 文本聊天API: http://localhost:{HTTP_PORT}/chat")
-    print(f"   - 语音聊天API: http://localhost:{HTTP_PORT}/voice/chat")
-    print(f"   - 语音识别API: http://localhost:{HTTP_PORT}/voice/recognize")
-    print(f"   - 健康检查: http://localhost:{HTTP_PORT}/health")
+    print(f"   - 文本聊天API: http://localhost:{S.http_port}/chat")
+    print(f"   - 语音聊天API: http://localhost:{S.http_port}/voice/chat")
+    print(f"   - 语音识别API: http://localhost:{S.http_port}/voice/recognize")
+    print(f"   - 流式语音识别API: http://localhost:{S.http_port}/voice/stream")
+    print(f"   - 健康检查: http://localhost:{S.http_port}/health")
     print()
-    print(f" Web界面将在Flask启动后自动打开...")
+    print(f" Web界面将在API服务启动后自动打开...")
     print("=" * 60)
     
-    # 在后台线程中启动Gradio界面
-    gradio_thread = threading.Thread(target=start_gradio_interface, daemon=True)
-    gradio_thread.start()
+    # 在独立进程中启动Gradio界面
+    gradio_process = multiprocessing.Process(target=start_gradio_interface, daemon=True)
+    gradio_process.start()
     
-    # 启动Flask应用
-    app.run(host='0.0.0.0', port=HTTP_PORT, debug=False)
\ No newline at end of file
+    # 使用uvicorn(ASGI)启动，替代单线程的开发服务器
+    uvicorn.run(
+        "app:app",
+        host='0.0.0.0',
+        port=S.http_port,
+        workers=S.http_workers,
+        limit_concurrency=S.http_limit_concurrency,
+        # 安装uvicorn[standard]后自动选用uvloop事件循环和httptools解析器（Windows回退到asyncio）
+        loop="auto",
+        http="auto",
+        log_level="info"
+    )
\ No newline at end of file
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+from config import MAX_BATCH_SIZE, MAX_WAIT_MS
+
+logger = logging.getLogger(__name__)
+
+class RequestBatcher:
+    """异步请求收集器：在短时间窗口内收集请求，按批次统一派发"""
+
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: int = MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector_task: Optional[asyncio.Task] = None
+        self._inflight = set()
+
+    def start(self):
+        """在当前事件循环中启动收集任务"""
+        if self._collector_task is None:
+            self._queue = asyncio.Queue()
+            self._collector_task = asyncio.get_running_loop().create_task(self._collector())
+
+    async def stop(self):
+        """停止收集任务"""
+        if self._collector_task is None:
+            return
+        self._collector_task.cancel()
+        try:
+            await self._collector_task
+        except asyncio.CancelledError:
+            pass
+        self._collector_task = None
+
+    async def submit(self, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """提交一个请求并等待其结果"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((func, args, future))
+        return await future
+
+    async def _collect_batch(self) -> list:
+        """收集一批请求：没有其他请求排队时立即返回，否则达到批大小或等待超时即返回"""
+        batch = [await self._queue.get()]
+        if self._queue.empty():
+            return batch
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _collector(self):
+        while True:
+            batch = await self._collect_batch()
+            logger.debug("派发请求批次: %d 个", len(batch))
+
+            # 同一批次的请求一起派发，各自完成后立即返回结果
+            for func, args, future in batch:
+                task = asyncio.ensure_future(func(*args))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+                task.add_done_callback(lambda t, f=future: self._resolve(f, t))
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, task: asyncio.Task):
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+class BatchProcessor(RequestBatcher):
+    """批处理器：同一批次的请求合并为一次batch_func调用，batch_func接收参数元组列表，按相同顺序返回结果列表"""
+
+    def __init__(self, batch_func: Callable[[List[tuple]], Awaitable[List[Any]]],
+                 max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: int = MAX_WAIT_MS):
+        super().__init__(max_batch_size, max_wait_ms)
+        self.batch_func = batch_func
+
+    async def submit(self, *args) -> Any:
+        """提交一组参数并等待其在所在批次中的结果"""
+        return await super().submit(None, *args)
+
+    async def _collector(self):
+        while True:
+            batch = await self._collect_batch()
+            logger.debug("派发合并批次: %d 个", len(batch))
+
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run_batch(self, batch: list):
+        try:
+            results = await self.batch_func([args for _, args, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,56 +1,210 @@
 import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
 from dotenv import load_dotenv
 
-load_dotenv()
-
-# 数据库配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE_PATH = os.path.join(BASE_DIR, 'crm_system.db')
-
-# LLM配置
-# BAIDU_API_KEY = os.getenv("baidu_api_key")
-# BAIDU_LLM_MODEL = os.getenv("BAIDU_LLM_MODEL", "ERNIE-4.0-8K")
-# BAIDU_EMBEDDING_MODEL = os.getenv("BAIDU_EMBEDDING_MODEL", "Embedding-V1")
-# BAIDU_API_BASE_URL = os.getenv("baidu_api_base_url", "https://qianfan.baidubce.com/v2/chat/completions")
-
-
-# # 使用本地嵌入模型
-# EMBEDDING_MODEL = "BAAI/bge-small-zh-v1.5"
-# EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "")
-EMBEDDING_MODEL = "BAAI/bge-m3"
-EMBEDDING_MODEL_DEVICE = "cpu"  # 使用CPU即可，如需GPU加速可改为 "cuda"
-
-LLM_MODEL = os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V2.5")
-LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", 0.3))
-API_BASE = os.getenv("SILICONFLOW_API_BASE", "https://api.siliconflow.cn/v1")
-OPENAI_API_KEY = os.getenv("openai_api_key")
-
-
-# 阿里云语音配置
-ASR_ACCESS_KEY_ID = os.getenv("ASR_ACCESS_KEY_ID")
-ASR_ACCESS_KEY_SECRET = os.getenv("ASR_ACCESS_KEY_SECRET")
-ASR_APPKEY = os.getenv("ASR_APPKEY")
-TTS_ACCESS_KEY_ID = os.getenv("TTS_ACCESS_KEY_ID")
-TTS_ACCESS_KEY_SECRET = os.getenv("TTS_ACCESS_KEY_SECRET")
-TTS_APPKEY = os.getenv("TTS_APPKEY")
-TTS_VOICE = os.getenv("TTS_VOICE", "xiaoyun")
-ALIYUN_LLM_API_KEY = os.getenv("LLM_API_KEY")
-ALIYUN_LLM_MODEL = os.getenv("LLM_MODEL", "qwen-turbo")
-
-# 服务器配置
-HTTP_PORT = int(os.getenv("SERVER_HTTP_PORT", "8003"))
-GRADIO_PORT = int(os.getenv("GRADIO_PORT", "7860"))
-FASTAPI_PORT = int(os.getenv("FASTAPI_PORT", "8000"))
-
-# RAG配置
-RAG_DOCUMENTS_PATH = os.path.join(BASE_DIR, 'data_documents')
-VECTOR_STORE_PATH = os.path.join(BASE_DIR, 'vector_store')
-
-
-# 网络搜索工具配置
-TAVILY_API_KEY = os.getenv("TAVILY_API_KEY", "")
-MAX_SEARCH_RESULTS = int(os.getenv("MAX_SEARCH_RESULTS", 3))
-
-# 工具启用开关
-ENABLE_RAG = os.getenv("ENABLE_RAG", "True").lower() == "true"
-ENABLE_WEB_SEARCH = os.getenv("ENABLE_WEB_SEARCH", "True").lower() == "true"
\ No newline at end of file
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """系统配置（进程启动时从环境变量解析一次）"""
+    # 数据库配置
+    database_path: str
+
+    # LLM配置
+    embedding_model: str
+    embedding_model_device: str
+    rag_embedding_backend: str
+    local_embedding_model: str
+    llm_model: str
+    llm_temperature: float
+    api_base: str
+    openai_api_key: Optional[str]
+
+    # 阿里云语音配置
+    asr_access_key_id: Optional[str]
+    asr_access_key_secret: Optional[str]
+    asr_appkey: Optional[str]
+    tts_access_key_id: Optional[str]
+    tts_access_key_secret: Optional[str]
+    tts_appkey: Optional[str]
+    tts_voice: str
+    tts_cache_bytes: int
+    aliyun_llm_api_key: Optional[str]
+    aliyun_llm_model: str
+
+    # 阿里云ASR/LLM/TTS单次请求超时（秒），超时后重试
+    asr_timeout: float
+    aliyun_llm_timeout: float
+    tts_timeout: float
+
+    # 本地语音识别配置（ASR_BACKEND=faster_whisper时使用faster-whisper替代阿里云ASR）
+    asr_backend: str
+    whisper_model: str
+    whisper_device: str
+
+    # 阿里云ASR上传前的音频转换（0表示按CPU核数自动计算）
+    asr_ffmpeg_workers: int
+    asr_ffmpeg_threads_per: int
+
+    # 服务器配置
+    http_port: int
+    gradio_port: int
+    fastapi_port: int
+    http_workers: int
+    http_limit_concurrency: int
+    fastapi_workers: int
+    dev_reload: bool
+    log_level: str
+    health_cache_ttl: int
+
+    # 请求批处理配置
+    max_batch_size: int
+    max_wait_ms: int
+
+    # RAG配置
+    rag_documents_path: str
+    vector_store_path: str
+    rag_quantize_int8: bool
+
+    # 网络搜索工具配置
+    tavily_api_key: str
+    max_search_results: int
+    search_cache_path: str
+    search_cache_ttl: int
+
+    # 工具启用开关
+    enable_rag: bool
+    enable_web_search: bool
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """加载.env并解析配置，结果在进程内缓存"""
+    load_dotenv()
+
+    return Settings(
+        database_path=os.path.join(BASE_DIR, 'crm_system.db'),
+
+        embedding_model="BAAI/bge-m3",
+        embedding_model_device=os.getenv("EMBEDDING_MODEL_DEVICE", "cpu"),  # 使用CPU即可，如需GPU加速可改为 "cuda"
+        # 知识库嵌入方式：api为调用嵌入接口，local为本地SentenceTransformers模型
+        rag_embedding_backend=os.getenv("RAG_EMBEDDING_BACKEND", "api").lower(),
+        local_embedding_model=os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+        llm_model=os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V2.5"),
+        llm_temperature=float(os.getenv("LLM_TEMPERATURE", 0.3)),
+        # SILICONFLOW_API_BASE优先，兼容.env.example中的OPENAI_API_BASE
+        api_base=os.getenv("SILICONFLOW_API_BASE") or os.getenv("OPENAI_API_BASE", "https://api.siliconflow.cn/v1"),
+        openai_api_key=os.getenv("openai_api_key"),
+
+        asr_access_key_id=os.getenv("ASR_ACCESS_KEY_ID"),
+        asr_access_key_secret=os.getenv("ASR_ACCESS_KEY_SECRET"),
+        asr_appkey=os.getenv("ASR_APPKEY"),
+        tts_access_key_id=os.getenv("TTS_ACCESS_KEY_ID"),
+        tts_access_key_secret=os.getenv("TTS_ACCESS_KEY_SECRET"),
+        tts_appkey=os.getenv("TTS_APPKEY"),
+        tts_voice=os.getenv("TTS_VOICE", "xiaoyun"),
+        tts_cache_bytes=int(os.getenv("TTS_CACHE_BYTES", 10 * 1024 * 1024)),  # 设为0关闭TTS结果缓存
+        aliyun_llm_api_key=os.getenv("LLM_API_KEY"),
+        aliyun_llm_model=os.getenv("LLM_MODEL", "qwen-turbo"),
+
+        asr_timeout=float(os.getenv("ASR_TIMEOUT", 10)),
+        aliyun_llm_timeout=float(os.getenv("LLM_TIMEOUT", 30)),
+        tts_timeout=float(os.getenv("TTS_TIMEOUT", 10)),
+
+        asr_backend=os.getenv("ASR_BACKEND", "aliyun").lower(),
+        whisper_model=os.getenv("WHISPER_MODEL", "small"),
+        whisper_device=os.getenv("WHISPER_DEVICE", "cpu"),
+
+        asr_ffmpeg_workers=int(os.getenv("ASR_FFMPEG_WORKERS", 0)),
+        asr_ffmpeg_threads_per=int(os.getenv("ASR_FFMPEG_THREADS_PER", 0)),
+
+        http_port=int(os.getenv("SERVER_HTTP_PORT", "8003")),
+        gradio_port=int(os.getenv("GRADIO_PORT", "7860")),
+        fastapi_port=int(os.getenv("FASTAPI_PORT", "8000")),
+        http_workers=int(os.getenv("HTTP_WORKERS", "4")),
+        http_limit_concurrency=int(os.getenv("HTTP_LIMIT_CONCURRENCY", "4096")),
+        fastapi_workers=int(os.getenv("FASTAPI_WORKERS", "1")),
+        dev_reload=os.getenv("DEV", "0") == "1",
+        log_level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+        health_cache_ttl=int(os.getenv("HEALTH_CACHE_TTL", "5")),
+
+        max_batch_size=int(os.getenv("MAX_BATCH_SIZE", 16)),
+        max_wait_ms=int(os.getenv("MAX_WAIT_MS", 10)),
+
+        rag_documents_path=os.path.join(BASE_DIR, 'data_documents'),
+        vector_store_path=os.path.join(BASE_DIR, 'vector_store'),
+        rag_quantize_int8=os.getenv("RAG_QUANTIZE_INT8", "False").lower() == "true",
+
+        tavily_api_key=os.getenv("TAVILY_API_KEY", ""),
+        max_search_results=int(os.getenv("MAX_SEARCH_RESULTS", 3)),
+        search_cache_path=os.path.join(BASE_DIR, 'search_cache.sqlite'),
+        search_cache_ttl=int(os.getenv("SEARCH_CACHE_TTL", 3600)),  # 设为0关闭搜索结果缓存
+
+        enable_rag=os.getenv("ENABLE_RAG", "True").lower() == "true",
+        enable_web_search=os.getenv("ENABLE_WEB_SEARCH", "True").lower() == "true",
+    )
+
+
+# 兼容旧的模块级常量导入方式
+_settings = get_settings()
+
+DATABASE_PATH = _settings.database_path
+
+EMBEDDING_MODEL = _settings.embedding_model
+EMBEDDING_MODEL_DEVICE = _settings.embedding_model_device
+RAG_EMBEDDING_BACKEND = _settings.rag_embedding_backend
+LOCAL_EMBEDDING_MODEL = _settings.local_embedding_model
+LLM_MODEL = _settings.llm_model
+LLM_TEMPERATURE = _settings.llm_temperature
+API_BASE = _settings.api_base
+OPENAI_API_KEY = _settings.openai_api_key
+
+ASR_ACCESS_KEY_ID = _settings.asr_access_key_id
+ASR_ACCESS_KEY_SECRET = _settings.asr_access_key_secret
+ASR_APPKEY = _settings.asr_appkey
+TTS_ACCESS_KEY_ID = _settings.tts_access_key_id
+TTS_ACCESS_KEY_SECRET = _settings.tts_access_key_secret
+TTS_APPKEY = _settings.tts_appkey
+TTS_VOICE = _settings.tts_voice
+TTS_CACHE_BYTES = _settings.tts_cache_bytes
+ALIYUN_LLM_API_KEY = _settings.aliyun_llm_api_key
+ALIYUN_LLM_MODEL = _settings.aliyun_llm_model
+
+ASR_TIMEOUT = _settings.asr_timeout
+ALIYUN_LLM_TIMEOUT = _settings.aliyun_llm_timeout
+TTS_TIMEOUT = _settings.tts_timeout
+
+ASR_BACKEND = _settings.asr_backend
+WHISPER_MODEL = _settings.whisper_model
+WHISPER_DEVICE = _settings.whisper_device
+
+ASR_FFMPEG_WORKERS = _settings.asr_ffmpeg_workers
+ASR_FFMPEG_THREADS_PER = _settings.asr_ffmpeg_threads_per
+
+HTTP_PORT = _settings.http_port
+GRADIO_PORT = _settings.gradio_port
+FASTAPI_PORT = _settings.fastapi_port
+HTTP_WORKERS = _settings.http_workers
+HTTP_LIMIT_CONCURRENCY = _settings.http_limit_concurrency
+FASTAPI_WORKERS = _settings.fastapi_workers
+DEV_RELOAD = _settings.dev_reload
+LOG_LEVEL = _settings.log_level
+HEALTH_CACHE_TTL = _settings.health_cache_ttl
+
+MAX_BATCH_SIZE = _settings.max_batch_size
+MAX_WAIT_MS = _settings.max_wait_ms
+
+RAG_DOCUMENTS_PATH = _settings.rag_documents_path
+VECTOR_STORE_PATH = _settings.vector_store_path
+RAG_QUANTIZE_INT8 = _settings.rag_quantize_int8
+
+TAVILY_API_KEY = _settings.tavily_api_key
+MAX_SEARCH_RESULTS = _settings.max_search_results
+SEARCH_CACHE_PATH = _settings.search_cache_path
+SEARCH_CACHE_TTL = _settings.search_cache_ttl
+
+ENABLE_RAG = _settings.enable_rag
+ENABLE_WEB_SEARCH = _settings.enable_web_search
@@ -1,14 +1,141 @@
 import sqlite3
 import logging
-import json
+import orjson
+import hashlib
+import atexit
+import queue
+import threading
 from typing import List, Dict, Tuple, Optional
 from config import DATABASE_PATH
 
 logger = logging.getLogger(__name__)
 
+# 每个线程持有一个长连接，避免每次调用都重新打开数据库
+_local = threading.local()
+
+# page_size只在新建数据库（尚未建表、切换WAL之前）时生效，必须放在最前
+_CONNECTION_PRAGMAS = (
+    "PRAGMA page_size=4096",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+
+def _get_conn() -> sqlite3.Connection:
+    """获取当前线程的数据库连接（首次调用时创建并设置PRAGMA）"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, cached_statements=128)
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+    return conn
+
+# 对话记录由后台线程批量写入：一个事务提交多条记录，请求线程无需等待fsync
+_WRITE_BATCH_SIZE = 100
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+_INSERT_CONVERSATION_SQL = '''INSERT INTO conversations 
+    (user_id, channel, role, content, intent, audio_path, metadata) 
+    VALUES (?, ?, ?, ?, ?, ?, ?)'''
+_TOUCH_USER_SQL = 'UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE id = ?'
+
+# 读取对话历史前等待后台写入的最长时间（秒），超时后读取已写入的部分
+_FLUSH_TIMEOUT = 2.0
+
+def _write_records(conn: sqlite3.Connection, records: list):
+    """在一个事务中写入对话记录并更新用户最后活跃时间"""
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(_INSERT_CONVERSATION_SQL, records)
+    conn.executemany(_TOUCH_USER_SQL, [(user_id,) for user_id in {r[0] for r in records}])
+    conn.commit()
+
+def _writer_loop():
+    """后台写入线程：取出队列中已有的记录，合并为一个事务写入"""
+    conn = _get_conn()
+    while True:
+        items = [_write_queue.get()]
+        while len(items) < _WRITE_BATCH_SIZE:
+            try:
+                items.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        records = [item for item in items if not isinstance(item, threading.Event)]
+        try:
+            if records:
+                try:
+                    _write_records(conn, records)
+                except sqlite3.Error as e:
+                    # 整批回滚后逐条重写，只丢弃写入失败的那一条
+                    conn.rollback()
+                    logger.warning(f"批量写入对话记录失败({len(records)}条)，改为逐条写入: {e}")
+                    for record in records:
+                        try:
+                            _write_records(conn, [record])
+                        except sqlite3.Error as e:
+                            conn.rollback()
+                            logger.error(f"写入对话记录失败，已丢弃: user_id={record[0]}, role={record[2]}: {e}")
+        except Exception as e:
+            logger.exception(f"写入对话记录异常: {e}")
+        finally:
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+                _write_queue.task_done()
+
+def _ensure_writer():
+    global _writer_thread
+    if _writer_thread is None:
+        with _writer_lock:
+            if _writer_thread is None:
+                _writer_thread = threading.Thread(target=_writer_loop, name="conversation-writer", daemon=True)
+                _writer_thread.start()
+
+def flush_writes(timeout: Optional[float] = None) -> bool:
+    """等待此前提交的对话记录全部写入数据库"""
+    if _writer_thread is None or not _write_queue.unfinished_tasks:
+        return True
+    done = threading.Event()
+    _write_queue.put(done)
+    return done.wait(timeout)
+
+def _optimize_on_exit():
+    """进程退出前让SQLite根据本次运行的查询情况更新统计信息"""
+    try:
+        _get_conn().execute('PRAGMA optimize')
+    except sqlite3.Error as e:
+        logger.warning(f"PRAGMA optimize 执行失败: {e}")
+
+# atexit按注册的逆序执行：先写完队列中剩余的记录，再执行optimize
+atexit.register(_optimize_on_exit)
+atexit.register(flush_writes, 5.0)
+
+def _phone_hash(phone_number: str) -> bytes:
+    """手机号的16字节定长哈希，作为用户查找键"""
+    return hashlib.blake2b(phone_number.encode('utf-8'), digest_size=16).digest()
+
+def _migrate_phone_hash(cursor):
+    """为旧库的users表补充phone_hash列并回填"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(users)')]
+    if 'phone_hash' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN phone_hash BLOB')
+    
+    rows = cursor.execute('SELECT id, phone_number FROM users WHERE phone_hash IS NULL').fetchall()
+    if rows:
+        cursor.executemany(
+            'UPDATE users SET phone_hash = ? WHERE id = ?',
+            [(_phone_hash(phone_number), user_id) for user_id, phone_number in rows]
+        )
+        logger.info(f"已回填 {len(rows)} 个用户的phone_hash")
+
 def init_database():
     """初始化扩展的SQLite数据库"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = _get_conn()
     cursor = conn.cursor()
     
     # 用户表（保留）
@@ -16,6 +143,7 @@ def init_database():
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             phone_number TEXT UNIQUE NOT NULL,
+            phone_hash BLOB,
             name TEXT,
             email TEXT,
             preferred_channel TEXT DEFAULT 'text',
@@ -53,8 +181,17 @@ def init_database():
         )
     ''')
     
+    _migrate_phone_hash(cursor)
+    cursor.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_phone_hash ON users(phone_hash)'
+    )
+    
+    # 对话历史按用户+时间查询
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_conv_user_ts ON conversations(user_id, timestamp DESC)'
+    )
+    
     conn.commit()
-    conn.close()
     logger.info("数据库初始化完成")
 
 class UserManager:
@@ -62,65 +199,82 @@ class UserManager:
         self.db_path = DATABASE_PATH
     
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        return _get_conn()
     
     def get_or_create_user(self, phone_number: str, channel: str = 'text') -> Tuple[int, bool]:
         """获取或创建用户，支持指定渠道偏好"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id, preferred_channel FROM users WHERE phone_number = ?', (phone_number,))
-        result = cursor.fetchone()
+        phone_hash = _phone_hash(phone_number)
         
+        # 老用户：只读查询，渠道偏好变化时才写入
+        result = conn.execute(
+            'SELECT id, preferred_channel FROM users WHERE phone_hash = ?', (phone_hash,)
+        ).fetchone()
         if result:
             user_id = result[0]
-            # 更新渠道偏好
-            if channel != result[1]:
-                cursor.execute(
-                    'UPDATE users SET preferred_channel = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                    (channel, user_id)
+            if result[1] != channel:
+                conn.execute(
+                    'UPDATE users SET preferred_channel = ?, updated_at = CURRENT_TIMESTAMP '
+                    'WHERE id = ? AND preferred_channel IS NOT ?',
+                    (channel, user_id, channel)
+                )
+                conn.commit()
+            logger.debug("用户管理: phone=%s, user_id=%s, is_new=False, channel=%s", phone_number, user_id, channel)
+            return user_id, False
+        
+        # 新用户：获取写锁后再确认一次（其他连接可能已创建），两次写入在同一事务中提交
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = conn.execute('SELECT id FROM users WHERE phone_hash = ?', (phone_hash,)).fetchone()
+            if result:
+                user_id = result[0]
+                is_new = False
+            else:
+                user_id = conn.execute(
+                    'INSERT INTO users (phone_number, phone_hash, preferred_channel) VALUES (?, ?, ?) RETURNING id',
+                    (phone_number, phone_hash, channel)
+                ).fetchone()[0]
+                is_new = True
+                
+                # 记录初始对话
+                conn.execute(
+                    'INSERT INTO conversations (user_id, channel, role, content) VALUES (?, ?, ?, ?)',
+                    (user_id, channel, 'system', f'新用户通过{channel}渠道注册')
                 )
-            is_new = False
-        else:
-            # 创建新用户
-            cursor.execute(
-                'INSERT INTO users (phone_number, preferred_channel) VALUES (?, ?)',
-                (phone_number, channel)
-            )
-            user_id = cursor.lastrowid
-            is_new = True
             
-            # 记录初始对话
-            cursor.execute(
-                'INSERT INTO conversations (user_id, channel, role, content) VALUES (?, ?, ?, ?)',
-                (user_id, channel, 'system', f'新用户通过{channel}渠道注册')
-            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         
-        conn.commit()
-        conn.close()
-        logger.info(f"用户管理: phone={phone_number}, user_id={user_id}, is_new={is_new}, channel={channel}")
+        logger.debug("用户管理: phone=%s, user_id=%s, is_new=%s, channel=%s", phone_number, user_id, is_new, channel)
         return user_id, is_new
     
-    def get_user_conversations(self, user_id: int, limit: int = 10) -> List[Dict]:
-        """获取用户对话历史"""
+    def get_user_conversations(self, user_id: int, limit: int = 10, offset: int = 0) -> List[Dict]:
+        """获取用户对话历史（从最新一条往前跳过offset条，取limit条）"""
+        if not flush_writes(_FLUSH_TIMEOUT):
+            logger.warning("等待对话记录写入超时，历史中可能缺少最新的记录")
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # 子查询取最近limit条，外层直接按时间正序返回
         cursor.execute('''
-            SELECT role, content, intent, timestamp, channel, metadata
-            FROM conversations 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (user_id, limit))
+            SELECT role, content, intent, timestamp, channel, metadata FROM (
+                SELECT id, role, content, intent, timestamp, channel, metadata
+                FROM conversations 
+                WHERE user_id = ? 
+                ORDER BY timestamp DESC, id DESC 
+                LIMIT ? OFFSET ?
+            ) ORDER BY timestamp ASC, id ASC
+        ''', (user_id, limit, offset))
         
         conversations = []
         for row in cursor.fetchall():
             metadata = {}
             if row[5]:
                 try:
-                    metadata = json.loads(row[5])
-                except:
+                    metadata = orjson.loads(row[5])
+                except orjson.JSONDecodeError:
                     metadata = {}
             
             conversations.append({
@@ -132,46 +286,37 @@ class UserManager:
                 'metadata': metadata
             })
         
-        conn.close()
-        return conversations[::-1]  # 反转以得到时间正序
+        return conversations
     
     def add_conversation(self, user_id: int, channel: str, role: str, content: str, 
                         intent: str = None, audio_path: str = None, metadata: dict = None):
-        """添加对话记录，支持语音和文本"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """添加对话记录，支持语音和文本（交给后台线程批量写入，立即返回）；
+        必填字段缺失时在入队前抛出ValueError，不会在后台写入时才失败"""
+        if not role or content is None:
+            raise ValueError("对话记录缺少role或content")
         
+        # orjson直接输出UTF-8字节，以BLOB形式写入，读取时orjson可直接解析
         metadata_str = None
         if metadata:
-            metadata_str = json.dumps(metadata)
-        
-        cursor.execute(
-            '''INSERT INTO conversations 
-               (user_id, channel, role, content, intent, audio_path, metadata) 
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (user_id, channel, role, content, intent, audio_path, metadata_str)
-        )
-        
-        # 更新用户最后活跃时间
-        cursor.execute(
-            'UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-            (user_id,)
-        )
+            metadata_str = orjson.dumps(metadata)
         
-        conn.commit()
-        conn.close()
-        logger.info(f"添加对话记录: user_id={user_id}, role={role}, channel={channel}, intent={intent}")
+        _ensure_writer()
+        _write_queue.put((user_id, channel, role, content, intent, audio_path, metadata_str))
+        logger.debug("添加对话记录: user_id=%s, role=%s, channel=%s, intent=%s", user_id, role, channel, intent)
     
     def update_user_profile(self, user_id: int, key: str, value: str):
         """更新用户信息"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # 原地更新已有偏好，避免INSERT OR REPLACE的删除+插入
         cursor.execute('''
-            INSERT OR REPLACE INTO user_profiles (user_id, preference_key, preference_value, updated_at)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            INSERT INTO user_preferences (user_id, preference_key, preference_value)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, preference_key) DO UPDATE SET
+                preference_value = excluded.preference_value,
+                updated_at = CURRENT_TIMESTAMP
         ''', (user_id, key, value))
         
         conn.commit()
-        conn.close()
-        logger.info(f"更新用户资料: user_id={user_id}, {key}={value}")
\ No newline at end of file
+        logger.debug("更新用户资料: user_id=%s, %s=%s", user_id, key, value)
\ No newline at end of file
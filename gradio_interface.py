@@ -1,24 +1,95 @@
 import gradio as gr
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson
 from datetime import datetime, timezone, timedelta
 import logging
 import tempfile
 import os
 import sys
+from functools import lru_cache
+from itertools import chain
+from typing import Optional
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # API 配置
-from config import HTTP_PORT
+from config import HTTP_PORT, LLM_MODEL
+from voice_processor import parse_voice_result_headers
 API_BASE_URL = f"http://localhost:{HTTP_PORT}"
 
+# 北京时间 (UTC+8)
+_BEIJING_TZ = timezone(timedelta(hours=8))
+
+# fromisoformat无法解析时依次尝试的时间格式
+# （只有时间的"%H:%M:%S"不含"-"，从未进入此分支；且补当天日期的结果不能缓存，故移除）
+_TIMESTAMP_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y-%m-%d %H:%M"
+)
+
+# 语音请求共用的异步连接池（语音处理耗时较长，不设读超时，与原同步请求一致）
+async_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=httpx.Timeout(None, connect=10.0)
+)
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(timestamp_str: str) -> Optional[str]:
+    """将时间戳字符串转换为北京时间字符串，无法解析时返回None（结果按输入字符串缓存）"""
+    # 移除可能的时间戳字符串周围的空格和引号
+    timestamp_str = timestamp_str.strip().strip('"').strip("'")
+    
+    # 如果已经是格式化好的时间字符串，直接返回
+    if ":" in timestamp_str and "-" in timestamp_str:
+        # 快速路径：数据库和API返回的ISO格式时间戳
+        try:
+            dt = datetime.fromisoformat(timestamp_str.replace("Z", "+00:00"))
+            if dt.tzinfo is not None:
+                dt = dt.astimezone(_BEIJING_TZ)
+            # 无时区信息时假设这是北京时间
+            return dt.strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            pass
+        
+        for fmt in _TIMESTAMP_FORMATS:
+            try:
+                dt = datetime.strptime(timestamp_str, fmt)
+                # 假设这是北京时间
+                return dt.strftime("%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                continue
+        logger.debug(f"时间解析失败: {timestamp_str}")
+    
+    # 如果是Unix时间戳
+    try:
+        # 尝试解析为Unix时间戳
+        ts = float(timestamp_str)
+        # 假设是UTC时间戳，转换为北京时间
+        beijing_dt = datetime.fromtimestamp(ts, tz=_BEIJING_TZ)
+        return beijing_dt.strftime("%Y-%m-%d %H:%M:%S")
+    except (ValueError, TypeError, OverflowError, OSError):
+        pass
+    
+    return None
+
 class IntegratedCRMInterface:
-    def __init__(self, api_base_url=API_BASE_URL):
+    def __init__(self, api_base_url=API_BASE_URL, engine=None):
         self.api_base_url = api_base_url
+        # 与ResponseEngine同进程运行时可直接传入引擎实例，聊天请求不再经过HTTP
+        self.engine = engine
         self.app = None
+        # 同步请求复用同一个连接池，保持keep-alive
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=100)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         # 检测Gradio版本
         self.gradio_version = self._detect_gradio_version()
         logger.info(f"检测到Gradio版本: {self.gradio_version}")
@@ -33,59 +104,15 @@ class IntegratedCRMInterface:
     
     def _normalize_timestamp(self, timestamp_str):
         """规范化时间戳 - 自动检测格式并转换为北京时间"""
-        if not timestamp_str:
+        normalized = parse_timestamp(str(timestamp_str)) if timestamp_str else None
+        if normalized is None:
             # 返回当前北京时间
-            beijing_tz = timezone(timedelta(hours=8))
-            return datetime.now(beijing_tz).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 移除可能的时间戳字符串周围的空格和引号
-        timestamp_str = str(timestamp_str).strip().strip('"').strip("'")
-        
-        # 如果已经是格式化好的时间字符串，直接返回
-        if ":" in timestamp_str and "-" in timestamp_str:
-            try:
-                # 尝试直接解析为北京时间
-                for fmt in [
-                    "%Y-%m-%d %H:%M:%S",
-                    "%Y-%m-%dT%H:%M:%S",
-                    "%Y/%m/%d %H:%M:%S",
-                    "%Y-%m-%d %H:%M",
-                    "%H:%M:%S"
-                ]:
-                    try:
-                        dt = datetime.strptime(timestamp_str, fmt)
-                        # 如果是只有时间没有日期，补充当前日期
-                        if fmt == "%H:%M:%S":
-                            now = datetime.now()
-                            dt = dt.replace(year=now.year, month=now.month, day=now.day)
-                        # 假设这是北京时间
-                        return dt.strftime("%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        continue
-            except Exception as e:
-                logger.debug(f"时间解析失败: {timestamp_str} - {e}")
-        
-        # 如果是Unix时间戳
-        try:
-            # 尝试解析为Unix时间戳
-            ts = float(timestamp_str)
-            # 假设是UTC时间戳
-            utc_dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-            # 转换为北京时间
-            beijing_tz = timezone(timedelta(hours=8))
-            beijing_dt = utc_dt.astimezone(beijing_tz)
-            return beijing_dt.strftime("%Y-%m-%d %H:%M:%S")
-        except (ValueError, TypeError):
-            pass
-        
-        # 如果所有尝试都失败，返回当前北京时间
-        beijing_tz = timezone(timedelta(hours=8))
-        return datetime.now(beijing_tz).strftime("%Y-%m-%d %H:%M:%S")
+            return datetime.now(_BEIJING_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        return normalized
     
     def _get_current_beijing_time(self):
         """获取当前北京时间"""
-        beijing_tz = timezone(timedelta(hours=8))
-        return datetime.now(beijing_tz).strftime("%H:%M:%S")
+        return datetime.now(_BEIJING_TZ).strftime("%H:%M:%S")
     
     def _ensure_message_format(self, history):
         """
@@ -101,13 +128,12 @@ class IntegratedCRMInterface:
         
         # 检查第一个元素来判断格式
         if history and isinstance(history[0], list):
-            messages = []
-            for pair in history:
-                if isinstance(pair, list) and len(pair) == 2:
-                    user_msg, bot_msg = pair
-                    messages.append({"role": "user", "content": str(user_msg)})
-                    messages.append({"role": "assistant", "content": str(bot_msg)})
-            return messages
+            # 一次遍历展开为 user/assistant 消息对
+            return list(chain.from_iterable(
+                ({"role": "user", "content": str(pair[0])}, {"role": "assistant", "content": str(pair[1])})
+                for pair in history
+                if isinstance(pair, list) and len(pair) == 2
+            ))
         elif history and isinstance(history[0], dict) and "role" in history[0]:
             # 已经是消息格式
             return history
@@ -117,10 +143,14 @@ class IntegratedCRMInterface:
     
     def test_connection(self):
         """测试与后端的连接"""
+        if self.engine is not None:
+            voice_enabled = self.engine.voice_processor.processor is not None
+            return f"**连接状态:** 正常（进程内）\n\n**模型:** {LLM_MODEL}\n**语音支持:** {'已启用' if voice_enabled else '未启用'}\n"
+        
         try:
-            response = requests.get(f"{self.api_base_url}/health")
+            response = self.session.get(f"{self.api_base_url}/health")
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 status = f"**连接状态:** 正常\n\n**模型:** {data.get('model')}\n**语音支持:** {'已启用' if data.get('voice_enabled') else '未启用'}\n"
                 return status
             else:
@@ -141,124 +171,98 @@ class IntegratedCRMInterface:
             
             logger.info(f"发送文本消息: {phone_number} - {message}")
             
-            response = requests.post(
-                f"{self.api_base_url}/chat",
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                
-                # 确保历史是消息格式
-                current_messages = self._ensure_message_format(history)
+            if self.engine is not None:
+                # 同进程直接调用，省去本地HTTP往返和JSON编解码
+                result = self.engine.process_query(phone_number, message, 'text')
+            else:
+                response = self.session.post(
+                    f"{self.api_base_url}/chat",
+                    json=payload,
+                    headers={"Content-Type": "application/json"}
+                )
                 
-                # 添加新消息
-                current_messages.append({
-                    "role": "user", 
-                    "content": message
-                })
-                current_messages.append({
-                    "role": "assistant", 
-                    "content": result["response"]
-                })
+                if response.status_code != 200:
+                    error_msg = f"API错误: {response.status_code} - {response.text}"
+                    return history, error_msg
                 
-                details = self._format_response_details(result)
-                return current_messages, details
-            else:
-                error_msg = f"API错误: {response.status_code} - {response.text}"
-                return history, error_msg
+                result = orjson.loads(response.content)
+            
+            # 确保历史是消息格式
+            current_messages = self._ensure_message_format(history)
+            
+            # 添加新消息
+            current_messages.append({
+                "role": "user", 
+                "content": message
+            })
+            current_messages.append({
+                "role": "assistant", 
+                "content": result["response"]
+            })
+            
+            details = self._format_response_details(result)
+            return current_messages, details
                 
         except Exception as e:
             error_msg = f"请求失败: {str(e)}"
             return history, error_msg
     
-    def send_voice_message(self, phone_number, audio_file, history):
-        """发送语音消息"""
+    async def send_voice_message(self, phone_number, audio_file, history):
+        """发送语音消息（异步请求，等待后端处理时不占用Gradio工作线程）"""
         if not phone_number or not audio_file:
             return history, "请填写手机号码并录制语音"
         
         try:
-            # 读取音频文件
-            with open(audio_file, 'rb') as f:
-                audio_data = f.read()
-            
-            files = {
-                'audio': ('audio.wav', audio_data, 'audio/wav')
-            }
-            data = {
-                'phone_number': phone_number
-            }
-            
             logger.info(f"发送语音消息: {phone_number}")
             
-            # 语音识别
-            recognize_files = {'audio': ('audio.wav', audio_data, 'audio/wav')}
-            recognize_response = requests.post(
-                f"{self.api_base_url}/voice/recognize",
-                files=recognize_files
-            )
-            
-            user_text = ""
-            if recognize_response.status_code == 200:
-                recognize_data = recognize_response.json()
-                user_text = recognize_data.get('recognized_text', '')
-                user_message = f"[语音] {user_text}"
+            if self.engine is not None:
+                # 读取音频文件
+                with open(audio_file, 'rb') as f:
+                    audio_data = f.read()
+                
+                # 同进程直接调用，语音回复直接以bytes返回，无需Base64
+                result = await self.engine.process_voice_query(phone_number, audio_data)
+                if "error" in result:
+                    return history, f"语音处理失败: {result['error']}", None
+                audio_response = result.get('audio_response')
             else:
-                user_message = "[语音消息]"
-            
-            # 确保历史是消息格式
-            current_messages = self._ensure_message_format(history)
-            
-            # 发送文本查询以获取文本回复
-            text_response = None
-            if user_text:
-                try:
-                    text_payload = {
-                        "phone_number": phone_number,
-                        "query": user_text
-                    }
-                    text_response = requests.post(
-                        f"{self.api_base_url}/chat",
-                        json=text_payload,
-                        headers={"Content-Type": "application/json"}
+                data = {
+                    'phone_number': phone_number
+                }
+                
+                # 上传时直接从文件分块读取，不先把整个WAV读入内存
+                with open(audio_file, 'rb') as f:
+                    voice_response = await async_http_client.post(
+                        f"{self.api_base_url}/voice/chat",
+                        files={'audio': ('audio.wav', f, 'audio/wav')},
+                        data=data
                     )
-                except Exception as e:
-                    logger.error(f"文本查询失败: {e}")
+                
+                if voice_response.status_code != 200:
+                    error_msg = f"语音API错误: {voice_response.status_code} - {voice_response.text}"
+                    return history, error_msg, None
+                
+                # 有语音回复时响应体为原始WAV，识别文本、回复等在响应头中；否则为JSON
+                if 'audio' in voice_response.headers.get('content-type', ''):
+                    result = parse_voice_result_headers(voice_response.headers)
+                    audio_response = voice_response.content
+                else:
+                    result = orjson.loads(voice_response.content)
+                    audio_response = None
             
-            # 发送语音聊天请求获取音频回复
-            voice_response = requests.post(
-                f"{self.api_base_url}/voice/chat",
-                files=files,
-                data=data
-            )
+            user_text = result.get('recognized_text', '')
+            user_message = f"[语音] {user_text}" if user_text else "[语音消息]"
+            assistant_text_response = result.get('response', '')
             
+            # 语音回复
             audio_path = None
-            assistant_text_response = ""
+            if audio_response:
+                with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_file:
+                    tmp_file.write(audio_response)
+                    audio_path = tmp_file.name
             
-            if voice_response.status_code == 200:
-                content_type = voice_response.headers.get('content-type', '')
-                
-                if 'audio' in content_type:
-                    # 语音回复
-                    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_file:
-                        tmp_file.write(voice_response.content)
-                        audio_path = tmp_file.name
-                    
-                    # 从文本响应中获取回复文本
-                    if text_response and text_response.status_code == 200:
-                        text_result = text_response.json()
-                        assistant_text_response = text_result.get('response', '已收到语音回复，请稍候播放')
-                    else:
-                        # 如果文本查询失败，使用通用回复
-                        assistant_text_response = "已收到语音回复，请稍候播放"
-                else:
-                    # 文本回复
-                    voice_result = voice_response.json()
-                    assistant_text_response = voice_result.get('response', '')
-            else:
-                error_msg = f"语音API错误: {voice_response.status_code} - {voice_response.text}"
-                return history, error_msg, None
+            # 确保历史是消息格式
+            current_messages = self._ensure_message_format(history)
             
             # 添加消息到历史
             current_messages.append({
@@ -271,20 +275,7 @@ class IntegratedCRMInterface:
             })
             
             # 格式化详情信息
-            if text_response and text_response.status_code == 200:
-                text_result = text_response.json()
-                details = self._format_response_details(text_result)
-            else:
-                current_time = self._get_current_beijing_time()
-                details = f"""
-**回复详情:**
-{assistant_text_response}
-
-**意图**: 语音查询 (实时信息-网络搜索)
-**用户ID**: 1 | **渠道**: voice
-**类型**: 老用户
-**时间**: {current_time}
-"""
+            details = self._format_response_details(result)
             
             return current_messages, details, audio_path
                 
@@ -335,10 +326,22 @@ class IntegratedCRMInterface:
             return "请先输入手机号码"
         
         try:
-            response = requests.get(f"{self.api_base_url}/user/{phone_number}/history")
+            if self.engine is not None:
+                user_manager = self.engine.user_manager
+                user_id, _ = user_manager.get_or_create_user(phone_number)
+                return self._format_history_display({
+                    "phone_number": phone_number,
+                    "user_id": user_id,
+                    "conversation_history": user_manager.get_user_conversations(user_id, 10)
+                })
+            
+            response = self.session.get(
+                f"{self.api_base_url}/user/{phone_number}/history",
+                params={"limit": 10}
+            )
             
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 return self._format_history_display(data)
             else:
                 return f"获取历史失败: {response.text}"
@@ -357,21 +360,26 @@ class IntegratedCRMInterface:
         recent_history = history[-10:] if len(history) > 10 else history
         recent_history.reverse()  # 按时间顺序显示，最新的在最后
         
-        formatted = f"**用户 {data['phone_number']} 的对话历史 (共{len(history)}条，显示最近{len(recent_history)}条):**\n\n"
+        parts = [f"**用户 {data['phone_number']} 的对话历史 (共{len(history)}条，显示最近{len(recent_history)}条):**\n\n"]
         
         for i, conv in enumerate(recent_history, 1):
-            intent_info = f" ({conv.get('intent', 'N/A')})" if conv.get("intent") else ""
+            intent = conv.get("intent")
+            intent_info = f" ({intent})" if intent else ""
             
             # 规范化时间显示
-            timestamp_str = conv.get('timestamp', '')
-            normalized_time = self._normalize_timestamp(timestamp_str)
+            normalized_time = self._normalize_timestamp(conv.get('timestamp', ''))
             
-            formatted += f"{i}. {conv['role'].title()} {intent_info}\n"
-            formatted += f"   时间: {normalized_time}\n"
             content = conv.get('content', '')
-            formatted += f"   内容: {content[:60]}{'...' if len(content) > 60 else ''}\n\n"
+            preview = content[:60]
+            ellipsis = '...' if len(preview) < len(content) else ''
+            
+            parts.append(
+                f"{i}. {conv['role'].title()} {intent_info}\n"
+                f"   时间: {normalized_time}\n"
+                f"   内容: {preview}{ellipsis}\n\n"
+            )
         
-        return formatted
+        return "".join(parts)
     
     def create_integrated_interface(self):
         """创建整合的界面 - 适配Gradio 6.x"""
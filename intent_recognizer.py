@@ -1,25 +1,115 @@
+import asyncio
 import logging
-import openai
-from config import OPENAI_API_KEY, API_BASE, LLM_MODEL
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Optional
+from config import LLM_MODEL, MAX_BATCH_SIZE, MAX_WAIT_MS
+from llm_client import create_async_client
 
 logger = logging.getLogger(__name__)
 
-# 配置OpenAI客户端（使用SiliconFlow）
-client = openai.OpenAI(
-    api_key=OPENAI_API_KEY,
-    base_url=API_BASE
-)
+# 意图缓存容量和键长度上限
+_INTENT_CACHE_SIZE = 8192
+_INTENT_CACHE_KEY_LENGTH = 200
+
+# 批量分类结果的行格式，如 "1. A"、"2：B"
+_BATCH_LINE_PATTERN = re.compile(r'^\s*(\d+)\s*[\.\)、:：]?\s*([ABC])', re.MULTILINE)
 
 class IntentRecognizer:
-    def __init__(self):
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: int = MAX_WAIT_MS):
         self.intent_categories = {
             "A": "产品咨询-RAG检索",
             "B": "实时信息-网络搜索",
             "C": "常规问答-模型回复"
         }
+        
+        # 并发的意图识别请求在短时间窗口内合并为一次LLM调用
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._collector = None
+        self._collector_lock = threading.Lock()
+        
+        # 各批次的LLM请求在后台事件循环中用异步客户端并发发出，不为每个在途请求占用线程
+        self._loop = None
+        self._async_client = None
+        
+        # 重复问题（问候语、常见价格咨询等）直接命中缓存，跳过LLM调用
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cache_lock = threading.Lock()
     
     def detect_intent(self, query: str) -> str:
-        """识别用户意图"""
+        """识别用户意图（先查缓存，未命中时阻塞等待所在批次的分类结果）"""
+        key = query.strip().lower()[:_INTENT_CACHE_KEY_LENGTH]
+        if key:
+            with self._cache_lock:
+                intent_code = self._cache.get(key)
+                if intent_code is not None:
+                    self._cache.move_to_end(key)
+                    return intent_code
+        
+        self._ensure_collector()
+        future = Future()
+        self._queue.put((query, future))
+        intent_code = future.result()
+        
+        # 模型调用失败或结果无法解析时默认使用常规回复，不写入缓存
+        if intent_code is None:
+            return 'C'
+        
+        if key:
+            with self._cache_lock:
+                self._cache[key] = intent_code
+                self._cache.move_to_end(key)
+                if len(self._cache) > _INTENT_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return intent_code
+    
+    def _ensure_collector(self):
+        if self._collector is None:
+            with self._collector_lock:
+                if self._collector is None:
+                    self._loop = asyncio.new_event_loop()
+                    self._async_client = create_async_client()
+                    threading.Thread(target=self._loop.run_forever, name="intent-loop", daemon=True).start()
+                    
+                    self._collector = threading.Thread(target=self._collect_loop, name="intent-collector", daemon=True)
+                    self._collector.start()
+    
+    def _collect_loop(self):
+        """收集请求：达到批大小或等待超时即派发一批"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            logger.debug("派发意图识别批次: %d 个", len(batch))
+            asyncio.run_coroutine_threadsafe(self._run_batch(batch), self._loop)
+    
+    async def _run_batch(self, batch: list):
+        queries = [query for query, _ in batch]
+        try:
+            intents = await self.detect_intents_batch(queries)
+        except Exception as e:
+            logger.error(f"批量意图识别失败: {e}")
+            intents = [None] * len(batch)
+        
+        for (_, future), intent_code in zip(batch, intents):
+            future.set_result(intent_code)
+    
+    async def classify_intent(self, query: str) -> Optional[str]:
+        """单条问题的意图分类，模型调用失败或结果无法解析时返回None"""
         # 使用模型进行意图分类
         prompt = f"""
         请分析以下用户问题的意图，并返回对应的分类代码（A、B或C）：
@@ -34,7 +124,7 @@ class IntentRecognizer:
         """
         
         try:
-            response = client.chat.completions.create(
+            response = await self._async_client.chat.completions.create(
                 model=LLM_MODEL,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.1,
@@ -43,17 +133,63 @@ class IntentRecognizer:
             
             intent_code = response.choices[0].message.content.strip().upper()
             
-            # 验证返回结果
+            # 验证返回结果，无法识别时返回None（调用方按常规回复处理且不缓存）
             if intent_code in ['A', 'B', 'C']:
                 return intent_code
-            else:
-                # 默认返回C
-                return 'C'
-                
+            logger.warning("意图识别返回无法解析的结果: %r", intent_code)
+            return None
+        
         except Exception as e:
             logger.error(f"意图识别失败: {e}")
-            return 'C'  # 失败时默认使用常规回复
+            return None
+    
+    async def detect_intents_batch(self, queries: List[str]) -> List[Optional[str]]:
+        """在一次模型调用中对多条问题分类，返回与输入顺序一致的分类代码（调用失败时为None）"""
+        if len(queries) == 1:
+            return [await self.classify_intent(queries[0])]
+        
+        # 问题内的换行会打乱编号，合并为单行
+        numbered = "\n".join(f"{i}. {' '.join(query.split())}" for i, query in enumerate(queries, 1))
+        prompt = f"""
+        请分析以下每个编号的用户问题的意图，并返回对应的分类代码（A、B或C）：
+        
+        A - 产品咨询：涉及具体产品信息、规格、价格等需要检索知识库的问题
+        B - 实时信息：需要最新市场信息、新闻、天气等实时数据的问题
+        C - 常规问答：一般性咨询、客服问题、使用指导等
+        
+        用户问题：
+        {numbered}
+        
+        每行返回一个结果，格式为"编号. 字母"，例如"1. A"，不要其他内容。
+        """
+        
+        try:
+            response = await self._async_client.chat.completions.create(
+                model=LLM_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+                max_tokens=8 * len(queries)
+            )
+            content = response.choices[0].message.content.upper()
+        except Exception as e:
+            logger.error(f"批量意图识别失败: {e}")
+            return [None] * len(queries)
+        
+        intents: List[Optional[str]] = [None] * len(queries)
+        for number, intent_code in _BATCH_LINE_PATTERN.findall(content):
+            index = int(number) - 1
+            if 0 <= index < len(queries):
+                intents[index] = intent_code
+        
+        # 缺失或无法解析的编号逐条重新分类，仍失败的保持None（调用方按常规回复处理且不缓存）
+        missing = [i for i, intent_code in enumerate(intents) if intent_code is None]
+        if missing:
+            logger.warning("批量意图识别有 %d/%d 条未能解析，逐条重试", len(missing), len(queries))
+            retried = await asyncio.gather(*(self.classify_intent(queries[i]) for i in missing))
+            for i, intent_code in zip(missing, retried):
+                intents[i] = intent_code
+        return intents
     
     def get_intent_description(self, intent_code: str) -> str:
         """获取意图描述"""
-        return self.intent_categories.get(intent_code, "未知意图")
\ No newline at end of file
+        return self.intent_categories.get(intent_code, "未知意图")
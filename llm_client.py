@@ -0,0 +1,30 @@
+import atexit
+import httpx
+import openai
+from config import OPENAI_API_KEY, API_BASE
+
+# 进程内共享的HTTP连接池，所有LLM请求复用已建立的TCP/TLS连接
+http_client = httpx.Client(
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+    timeout=httpx.Timeout(60.0, connect=10.0)
+)
+
+# 配置OpenAI客户端（使用SiliconFlow）
+client = openai.OpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=API_BASE,
+    http_client=http_client
+)
+
+atexit.register(http_client.close)
+
+def create_async_client() -> openai.AsyncOpenAI:
+    """创建异步LLM客户端（httpx.AsyncClient连接池绑定首次使用的事件循环，每个事件循环各建一个）"""
+    return openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=API_BASE,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=100),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+    )
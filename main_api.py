@@ -1,29 +1,43 @@
 import uvicorn
 import base64
+import gradio as gr
+import orjson
 import logging
-from fastapi import FastAPI, Request, UploadFile, File, Body, HTTPException
+from fastapi import FastAPI, Request, UploadFile, File, Body, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
 from datetime import datetime
 import asyncio
+import hashlib
+import time
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 导入项目模块
-from config import DATABASE_PATH, LLM_MODEL, HTTP_PORT, GRADIO_PORT,ASR_ACCESS_KEY_ID, TTS_ACCESS_KEY_ID, OPENAI_API_KEY, FASTAPI_PORT
+from config import DATABASE_PATH, LLM_MODEL, HTTP_PORT, GRADIO_PORT,ASR_ACCESS_KEY_ID, TTS_ACCESS_KEY_ID, OPENAI_API_KEY, FASTAPI_PORT, HEALTH_CACHE_TTL, FASTAPI_WORKERS, DEV_RELOAD
 from database import init_database
 from response_engine import ResponseEngine
+from gradio_interface import IntegratedCRMInterface
+from voice_processor import voice_result_headers
 
-# 初始化数据库
-init_database()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """服务启动时初始化数据库（每个进程一次，不阻塞模块导入）并后台预热语音服务，退出时关闭语音服务的HTTP会话"""
+    await asyncio.to_thread(init_database)
+    engine.voice_processor.start_warmup()
+    yield
+    await engine.voice_processor.aclose()
 
 # 初始化FastAPI
 app = FastAPI(
     title="CRM智能语音客服系统",
     description="整合文本聊天和语音交互的CRM客服系统",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # 配置跨域
@@ -38,36 +52,101 @@ app.add_middleware(
 # 初始化响应引擎
 engine = ResponseEngine()
 
+# 在同一进程内挂载Gradio界面，界面回调直接调用engine，不经过本地回环HTTP
+app = gr.mount_gradio_app(
+    app,
+    IntegratedCRMInterface(engine=engine).create_integrated_interface(),
+    path="/ui"
+)
+
+# 秒级时间戳缓存：同一秒内的响应复用同一个ISO字符串
+_now_cache = (0, "")
+
+def now_iso() -> str:
+    """返回缓存的当前时间ISO字符串（秒级精度）"""
+    global _now_cache
+    now = int(time.time())
+    if now != _now_cache[0]:
+        _now_cache = (now, datetime.fromtimestamp(now).isoformat())
+    return _now_cache[1]
+
 # 标准化响应
 def standard_response(success: bool, data: dict = None, message: str = ""):
-    return JSONResponse({
+    return ORJSONResponse({
         "success": success,
         "message": message,
         "data": data,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     })
 
+# 健康检查响应缓存：TTL内直接返回已序列化的JSON，避免监控轮询反复查询引擎
+_health_cache = {"ts": 0.0, "body": None}
+_health_lock = asyncio.Lock()
+
+def _cached_health_response(cache_status: str) -> Response:
+    return Response(
+        content=_health_cache["body"],
+        media_type="application/json",
+        headers={
+            "Cache-Control": f"public, max-age={HEALTH_CACHE_TTL}",
+            "X-Cache": cache_status
+        }
+    )
+
+def _health_cache_fresh() -> bool:
+    return _health_cache["body"] is not None and time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL
+
 # ==================== API接口 ====================
 @app.get("/health", summary="健康检查")
 async def health_check():
     """系统健康检查"""
-    voice_caps = engine.get_voice_capabilities()
-    return standard_response(
-        success=True,
-        data={
-            "status": "healthy",
-            "crm_model": LLM_MODEL,
-            "voice_capabilities": voice_caps,
-            "database": DATABASE_PATH
-        },
-        message="系统运行正常"
-    )
+    if _health_cache_fresh():
+        return _cached_health_response("HIT")
+    
+    # 同一时间只允许一个请求刷新缓存，其余请求等待后直接命中
+    async with _health_lock:
+        if _health_cache_fresh():
+            return _cached_health_response("HIT")
+        
+        voice_processor = engine.voice_processor
+        voice_caps = {
+            "asr": voice_processor.processor is not None or voice_processor.whisper_model is not None,
+            "asr_backend": "faster_whisper" if voice_processor.whisper_model is not None else "aliyun",
+            "tts": voice_processor.processor is not None
+        }
+        response = standard_response(
+            success=True,
+            data={
+                "status": "healthy",
+                "crm_model": LLM_MODEL,
+                "voice_capabilities": voice_caps,
+                "database": DATABASE_PATH
+            },
+            message="系统运行正常"
+        )
+        _health_cache["body"] = response.body
+        _health_cache["ts"] = time.monotonic()
+    
+    return _cached_health_response("MISS")
+
+# 处理中的文本查询：相同(手机号, 问题)的并发请求共享同一次处理，避免重复提交触发多次LLM调用
+_inflight_queries = {}
+
+async def _process_text_query_once(phone_number: str, query: str) -> dict:
+    key = (phone_number, hashlib.blake2b(query.encode('utf-8'), digest_size=16).digest())
+    task = _inflight_queries.get(key)
+    if task is None:
+        task = asyncio.ensure_future(engine.process_query_batched(phone_number, query, 'text'))
+        _inflight_queries[key] = task
+        task.add_done_callback(lambda _: _inflight_queries.pop(key, None))
+    # 某个请求断开不影响共享同一任务的其他请求
+    return await asyncio.shield(task)
 
 @app.post("/chat/text", summary="文本聊天")
 async def text_chat(request: Request):
     """文本聊天接口"""
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         
         # 验证参数
         if not data or 'phone_number' not in data or 'query' not in data:
@@ -79,8 +158,8 @@ async def text_chat(request: Request):
         phone_number = data['phone_number']
         query = data['query']
         
-        # 处理文本查询
-        result = engine.process_text_query(phone_number, query)
+        # 处理文本查询（阻塞步骤在线程池中执行，常规问答与并发请求合并生成回复）
+        result = await _process_text_query_once(phone_number, query)
         
         return standard_response(
             success=True,
@@ -95,12 +174,31 @@ async def text_chat(request: Request):
             message=f"服务器内部错误: {str(e)}"
         )
 
+@app.post("/chat/text/stream", summary="流式文本聊天")
+async def text_chat_stream(request: Request):
+    """流式文本聊天接口：模型输出的回复文本逐段以分块传输返回"""
+    data = orjson.loads(await request.body())
+    
+    # 验证参数
+    if not data or 'phone_number' not in data or 'query' not in data:
+        return standard_response(
+            success=False,
+            message="缺少必要参数: phone_number 和 query"
+        )
+    
+    # 同步生成器由StreamingResponse在线程池中迭代
+    return StreamingResponse(
+        engine.process_query_stream(data['phone_number'], data['query'], 'text'),
+        media_type="text/plain; charset=utf-8"
+    )
+
 @app.post("/chat/voice", summary="语音聊天")
 async def voice_chat(
+    request: Request,
     phone_number: str = Body(..., embed=True),
     audio_file: UploadFile = File(...)
 ):
-    """语音聊天接口"""
+    """语音聊天接口（请求头Accept: audio/wav时直接返回WAV，元数据放在响应头）"""
     try:
         # 读取音频文件
         audio_data = await audio_file.read()
@@ -120,10 +218,19 @@ async def voice_chat(
                 data=result
             )
         
-        # 处理音频数据（转为base64）
-        if result.get("audio"):
-            result["audio_base64"] = base64.b64encode(result["audio"]).decode("utf-8")
-            del result["audio"]  # 移除二进制数据
+        # 处理音频数据：客户端接受WAV时直接返回原始音频，省去Base64编解码和33%的体积膨胀
+        audio = result.pop("audio_response", None)
+        if audio and "audio/wav" in request.headers.get("accept", ""):
+            result["timestamp"] = now_iso()
+            return Response(
+                content=audio,
+                media_type="audio/wav",
+                headers=voice_result_headers(result)
+            )
+        
+        # 否则转为base64，识别文本、回复和音频一次返回
+        if audio:
+            result["audio_base64"] = base64.b64encode(audio).decode("utf-8")
         
         return standard_response(
             success=True,
@@ -139,9 +246,13 @@ async def voice_chat(
         )
 
 @app.get("/user/{phone_number}/history", summary="获取用户对话历史")
-async def get_user_history(phone_number: str):
-    """获取用户对话历史"""
-    result = engine.get_user_history(phone_number)
+async def get_user_history(
+    phone_number: str,
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0)
+):
+    """获取用户对话历史，分页在数据库中完成"""
+    result = await asyncio.to_thread(engine.get_user_history, phone_number, limit, offset)
     return standard_response(
         success=result["success"],
         data=result if result["success"] else None,
@@ -158,16 +269,30 @@ async def generate_tts(text: str):
                 message="文本内容不能为空"
             )
         
-        audio, error = await engine.voice_processor.text_to_voice(text)
-        if error or not audio:
+        if not engine.voice_processor.processor:
+            return standard_response(
+                success=False,
+                message="TTS合成失败: 语音处理器未初始化"
+            )
+        
+        # 边合成边返回音频流，首个音频块到达即可开始发送，无需缓冲完整WAV
+        # 先取出第一块再构造响应，合成失败时仍返回错误信息而不是空的200音频
+        stream = engine.voice_processor.text_to_speech_stream(text)
+        try:
+            first_chunk = await stream.__anext__()
+        except StopAsyncIteration:
             return standard_response(
                 success=False,
-                message=f"TTS合成失败: {error}"
+                message="TTS合成失败"
             )
         
-        # 返回音频文件
-        return Response(
-            content=audio,
+        async def audio_stream():
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+        
+        return StreamingResponse(
+            audio_stream(),
             media_type="audio/wav",
             headers={"Content-Disposition": f"attachment; filename=tts_{datetime.now().timestamp()}.wav"}
         )
@@ -204,13 +329,19 @@ def main():
     print(f"\n CRM智能语音客服系统启动中...")
     print(f" API地址: http://0.0.0.0:{port}")
     print(f" API文档: http://0.0.0.0:{port}/docs")
+    print(f" Web界面: http://0.0.0.0:{port}/ui")
     
-    # 启动服务
+    # 启动服务：仅开发模式(DEV=1)开启自动重载，生产环境可用FASTAPI_WORKERS开启多进程
+    # 注意：挂载的Gradio界面依赖进程内队列状态，使用/ui时保持单进程
     uvicorn.run(
         "main_api:app",
         host="0.0.0.0",
         port=port,
-        reload=True,
+        reload=DEV_RELOAD,
+        workers=1 if DEV_RELOAD else FASTAPI_WORKERS,
+        # 安装uvicorn[standard]后自动选用uvloop事件循环和httptools解析器
+        loop="auto",
+        http="auto",
         log_level="info"
     )
 
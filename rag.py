@@ -1,52 +1,213 @@
 import os
 import sys
+import json
+import hashlib
+import mmap
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
 sys.path.append('.')
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
-from config import RAG_DOCUMENTS_PATH, VECTOR_STORE_PATH, API_BASE, EMBEDDING_MODEL, OPENAI_API_KEY
+from config import (RAG_DOCUMENTS_PATH, VECTOR_STORE_PATH, API_BASE, EMBEDDING_MODEL, EMBEDDING_MODEL_DEVICE, OPENAI_API_KEY,
+                    RAG_QUANTIZE_INT8, RAG_EMBEDDING_BACKEND, LOCAL_EMBEDDING_MODEL)
 
 print("[RAG] 开始初始化RAG系统...")
 
-def load_documents():
-    """加载指定目录下的所有文本文件"""
+# 每次嵌入请求携带的文本块数量，以及并发请求数
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_WORKERS = 8
+
+# 文档分块大小和重叠（字符数）；在换行、中文标点和空格之后切分，分隔符保留在前一段末尾
+CHUNK_SIZE = 150
+CHUNK_OVERLAP = 20
+_SEPARATOR_PATTERN = re.compile(r'(?<=[\n。！？；， ])')
+
+# 并发读取文档文件的线程数
+DOCUMENT_READ_WORKERS = 8
+
+# 查询检索结果缓存容量
+QUERY_CACHE_SIZE = 1024
+
+# 向量库文件：vectors.bin为float32（或int8）原始矩阵（N×D），scales.bin为int8时每行的缩放系数，meta.json为对应的文本和元数据；manifest.json记录已向量化文件的内容哈希
+VECTORS_FILE = 'vectors.bin'
+SCALES_FILE = 'scales.bin'
+META_FILE = 'meta.json'
+MANIFEST_PATH = os.path.join(VECTOR_STORE_PATH, 'manifest.json')
+
+# 每次检索返回的文档块数
+RETRIEVAL_TOP_K = 3
+
+def _list_text_files():
+    """列出文档目录下的文本文件，返回{文件名: [大小, 修改时间ns]}（scandir的目录项自带stat信息）"""
+    stats = {}
+    if not os.path.exists(RAG_DOCUMENTS_PATH):
+        return stats
+    
+    with os.scandir(RAG_DOCUMENTS_PATH) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def _hash_file(file):
+    with open(os.path.join(RAG_DOCUMENTS_PATH, file), 'rb') as f:
+        # 空文件无法映射
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+def hash_documents(manifest=None):
+    """计算文档目录下每个文本文件的SHA-256，返回(哈希, 文件状态)；大小和修改时间与清单一致的文件直接沿用清单中的哈希"""
+    manifest = manifest or {}
+    indexed_hashes = manifest.get("files", {})
+    indexed_stats = manifest.get("stats", {})
+    
+    stats = _list_text_files()
+    hashes = {
+        file: indexed_hashes[file] for file, stat in stats.items()
+        if file in indexed_hashes and indexed_stats.get(file) == stat
+    }
+    
+    # 其余文件并发读取并计算哈希
+    pending = [file for file in stats if file not in hashes]
+    with ThreadPoolExecutor(max_workers=DOCUMENT_READ_WORKERS) as executor:
+        hashes.update(zip(pending, executor.map(_hash_file, pending)))
+    return hashes, stats
+
+def load_manifest():
+    """读取上次向量化时的清单"""
+    try:
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(embedding_model, file_hashes, file_stats):
+    os.makedirs(VECTOR_STORE_PATH, exist_ok=True)
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump({"embedding_model": embedding_model, "files": file_hashes, "stats": file_stats}, f, ensure_ascii=False, indent=2)
+
+def create_embeddings():
+    """
+    创建嵌入模型，返回(embeddings, 模型名)
+    RAG_EMBEDDING_BACKEND=local时使用本地SentenceTransformers模型，指定cuda但GPU不可用时回退到嵌入接口
+    """
+    if RAG_EMBEDDING_BACKEND == "local":
+        try:
+            import torch
+            if EMBEDDING_MODEL_DEVICE.startswith("cuda") and not torch.cuda.is_available():
+                print("[RAG] CUDA不可用，本地嵌入模型回退为嵌入接口")
+            else:
+                from langchain_community.embeddings import HuggingFaceEmbeddings
+                print(f"[RAG] 初始化本地嵌入模型: {LOCAL_EMBEDDING_MODEL} ({EMBEDDING_MODEL_DEVICE})")
+                embeddings = HuggingFaceEmbeddings(
+                    model_name=LOCAL_EMBEDDING_MODEL,
+                    model_kwargs={"device": EMBEDDING_MODEL_DEVICE},
+                    encode_kwargs={"batch_size": 64, "normalize_embeddings": True}
+                )
+                return embeddings, LOCAL_EMBEDDING_MODEL
+        except ImportError as e:
+            print(f"[RAG] 本地嵌入模型依赖未安装，回退为嵌入接口: {e}")
+    
+    print(f"[RAG] 初始化嵌入模型，使用: {EMBEDDING_MODEL}")
+    embeddings = OpenAIEmbeddings(
+        openai_api_base=API_BASE,
+        openai_api_key=OPENAI_API_KEY,
+        model=EMBEDDING_MODEL,
+        chunk_size=EMBEDDING_BATCH_SIZE,
+        max_retries=6,
+        request_timeout=60
+    )
+    return embeddings, EMBEDDING_MODEL
+
+def _read_document(file):
+    file_path = os.path.join(RAG_DOCUMENTS_PATH, file)
+    try:
+        # 映射文件后直接解码，不再经过中间的bytes副本
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                content = ""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    content = str(mm, 'utf-8')
+        
+        # 与文本模式读取一致，统一换行符
+        if '\r' in content:
+            content = content.replace('\r\n', '\n').replace('\r', '\n')
+        print(f"[RAG] 成功加载文件: {file}")
+        return Document(page_content=content, metadata={"source": file})
+    except Exception as e:
+        print(f"[RAG] 加载文件 {file} 时出错: {e}")
+        return None
+
+def load_documents(file_names=None):
+    """加载指定目录下的所有文本文件（线程池并发读取），file_names不为None时只加载其中的文件"""
     if not os.path.exists(RAG_DOCUMENTS_PATH):
         os.makedirs(RAG_DOCUMENTS_PATH, exist_ok=True)
         print(f"[RAG] 创建文档目录: {RAG_DOCUMENTS_PATH}")
         return []
     
-    documents = []
-    for file in os.listdir(RAG_DOCUMENTS_PATH):
-        if file.endswith('.txt'):
-            file_path = os.path.join(RAG_DOCUMENTS_PATH, file)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                doc = Document(page_content=content, metadata={"source": file})
-                documents.append(doc)
-                print(f"[RAG] 成功加载文件: {file}")
-            except Exception as e:
-                print(f"[RAG] 加载文件 {file} 时出错: {e}")
+    with os.scandir(RAG_DOCUMENTS_PATH) as entries:
+        files = [
+            entry.name for entry in entries
+            if entry.name.endswith('.txt') and entry.is_file() and (file_names is None or entry.name in file_names)
+        ]
+    
+    with ThreadPoolExecutor(max_workers=DOCUMENT_READ_WORKERS) as executor:
+        documents = [doc for doc in executor.map(_read_document, files) if doc is not None]
     
     print(f"[RAG] 共加载 {len(documents)} 个文档")
     return documents
 
+def _split_pieces(text, chunk_size):
+    """在分隔符处切成小段，仍超过chunk_size的小段按长度硬切"""
+    for piece in _SEPARATOR_PATTERN.split(text):
+        if len(piece) <= chunk_size:
+            if piece:
+                yield piece
+        else:
+            for i in range(0, len(piece), chunk_size):
+                yield piece[i:i + chunk_size]
+
+def split_text(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """将小段依次合并为不超过chunk_size个字符的块，相邻块之间重叠不超过chunk_overlap个字符"""
+    chunks = []
+    window = deque()
+    total = 0
+    for piece in _split_pieces(text, chunk_size):
+        if window and total + len(piece) > chunk_size:
+            chunk = "".join(window).strip()
+            if chunk:
+                chunks.append(chunk)
+            # 保留末尾的小段作为下一块的开头
+            while window and (total > chunk_overlap or total + len(piece) > chunk_size):
+                total -= len(window.popleft())
+        window.append(piece)
+        total += len(piece)
+    
+    chunk = "".join(window).strip()
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
 def split_documents(documents):
     """分块文档以便于向量化"""
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=150,
-        chunk_overlap=20,
-        length_function=len,
-        separators=["\n\n", "\n", "。", "！", "？", "；", "，", " "]
-    )
-    
     if not documents:
         print("[RAG] 警告：没有文档可分割")
         return []
     
-    splits = text_splitter.split_documents(documents)
+    splits = [
+        Document(page_content=chunk, metadata=dict(doc.metadata))
+        for doc in documents for chunk in split_text(doc.page_content)
+    ]
     print(f"[RAG] 文档分割完成，共生成 {len(splits)} 个文档块")
     
     # 预览，确认分割有效
@@ -56,54 +217,261 @@ def split_documents(documents):
     
     return splits
 
+def embed_texts(embeddings, texts):
+    """按批次并发调用嵌入接口，返回与texts顺序一致的向量"""
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    if not batches:
+        return []
+    
+    with ThreadPoolExecutor(max_workers=min(EMBEDDING_WORKERS, len(batches))) as executor:
+        results = executor.map(embeddings.embed_documents, batches)
+        return [vector for batch in results for vector in batch]
+
+def _normalize(vectors):
+    """按行L2归一化（零向量保持不变），归一化后内积即余弦相似度"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def _quantize(vectors):
+    """按行对称量化为int8，返回(int8矩阵, 每行缩放系数)，原向量约等于 int8值 × 缩放系数"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+class VectorStore:
+    """平铺向量库：向量按行归一化后保存为float32（或int8加每行缩放系数）矩阵，启动时用np.memmap映射；检索为一次矩阵向量乘加top-k"""
+    
+    def __init__(self, vectors=None, texts=None, metadatas=None, scales=None, quantized=RAG_QUANTIZE_INT8):
+        self.vectors = vectors
+        self.scales = scales
+        self.texts = texts or []
+        self.metadatas = metadatas or []
+        self.quantized = quantized
+        # 载入后做过格式转换、需要重新保存
+        self.dirty = False
+    
+    def __len__(self):
+        return len(self.texts)
+    
+    @classmethod
+    def load(cls, path, quantized=RAG_QUANTIZE_INT8):
+        """映射已保存的向量库，文件缺失或不完整时返回None；保存的精度与quantized不一致时在内存中转换"""
+        try:
+            with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if not meta["count"]:
+                return None
+            
+            stored_quantized = meta.get("dtype") == "int8"
+            vectors = np.memmap(
+                os.path.join(path, VECTORS_FILE), dtype=np.int8 if stored_quantized else np.float32, mode='r',
+                shape=(meta["count"], meta["dim"])
+            )
+            scales = None
+            if stored_quantized:
+                scales = np.fromfile(os.path.join(path, SCALES_FILE), dtype=np.float32)
+                if len(scales) != meta["count"]:
+                    return None
+        except (OSError, ValueError, KeyError):
+            return None
+        
+        store = cls(vectors, meta["texts"], meta["metadatas"], scales, stored_quantized)
+        
+        # 早期保存的向量未归一化，载入内存后归一化
+        if not meta.get("normalized"):
+            store.vectors = _normalize(vectors)
+            store.dirty = True
+        store.set_quantized(quantized)
+        return store
+    
+    def set_quantized(self, quantized):
+        """切换向量精度（int8与float32互转），转换后需重新保存"""
+        if quantized == self.quantized:
+            return
+        
+        if self.vectors is not None:
+            if quantized:
+                self.vectors, self.scales = _quantize(self.vectors)
+            else:
+                self.vectors = self.vectors.astype(np.float32) * self.scales[:, None]
+                self.scales = None
+        self.quantized = quantized
+        self.dirty = True
+    
+    def save(self, path):
+        """保存向量和元数据（先写临时文件再替换，中途失败不会留下不一致的文件）"""
+        os.makedirs(path, exist_ok=True)
+        vectors_path = os.path.join(path, VECTORS_FILE)
+        scales_path = os.path.join(path, SCALES_FILE)
+        meta_path = os.path.join(path, META_FILE)
+        
+        np.ascontiguousarray(self.vectors).tofile(vectors_path + '.tmp')
+        if self.quantized:
+            self.scales.tofile(scales_path + '.tmp')
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                "count": len(self),
+                "dim": self.vectors.shape[1],
+                "dtype": "int8" if self.quantized else "float32",
+                "normalized": True,
+                "texts": self.texts,
+                "metadatas": self.metadatas
+            }, f, ensure_ascii=False)
+        
+        os.replace(vectors_path + '.tmp', vectors_path)
+        if self.quantized:
+            os.replace(scales_path + '.tmp', scales_path)
+        os.replace(meta_path + '.tmp', meta_path)
+        self.dirty = False
+    
+    def add(self, texts, vectors, metadatas):
+        vectors = _normalize(vectors)
+        scales = None
+        if self.quantized:
+            vectors, scales = _quantize(vectors)
+        
+        if self.vectors is None:
+            self.vectors, self.scales = vectors, scales
+        else:
+            self.vectors = np.vstack([self.vectors, vectors])
+            if self.quantized:
+                self.scales = np.concatenate([self.scales, scales])
+        self.texts = self.texts + list(texts)
+        self.metadatas = self.metadatas + list(metadatas)
+    
+    def delete_sources(self, sources):
+        """删除来源于指定文件的全部文档块"""
+        keep = [i for i, metadata in enumerate(self.metadatas) if metadata.get("source") not in sources]
+        if len(keep) == len(self):
+            return
+        
+        self.vectors = self.vectors[keep] if keep else None
+        if self.quantized:
+            self.scales = self.scales[keep] if keep else None
+        self.texts = [self.texts[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+    
+    def search(self, query_vector, k=RETRIEVAL_TOP_K):
+        """返回与查询向量内积最大的k个文档块，按相似度降序"""
+        if not len(self):
+            return []
+        
+        if self.quantized:
+            # 查询同样量化为int8，按int32累加内积后乘回两侧的缩放系数
+            query, query_scale = _quantize(_normalize(query_vector))
+            scores = np.einsum('ij,j->i', self.vectors, query[0], dtype=np.int32) * (self.scales * query_scale[0])
+        else:
+            # 一次矩阵向量乘（SGEMV）得到全部余弦相似度；np.asarray去掉memmap子类，结果为普通ndarray
+            scores = np.asarray(self.vectors) @ _normalize(query_vector)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [Document(page_content=self.texts[i], metadata=self.metadatas[i]) for i in top]
+
+class VectorRetriever:
+    """检索器：查询向量化后在向量库中取top-k，调用方式与LangChain检索器一致"""
+    
+    def __init__(self, vector_store, embeddings, k=RETRIEVAL_TOP_K):
+        self.vector_store = vector_store
+        self.embeddings = embeddings
+        self.k = k
+    
+    def invoke(self, query):
+        return self.vector_store.search(self.embeddings.embed_query(query), self.k)
+    
+    get_relevant_documents = invoke
+
+def add_splits_to_store(vector_store, embeddings, splits):
+    """预先批量计算向量，再写入向量库"""
+    texts = [split.page_content for split in splits]
+    if texts:
+        vector_store.add(texts, embed_texts(embeddings, texts), [split.metadata for split in splits])
+
+# 单例实例
+rag_processor = None
+_rag_processor_lock = threading.Lock()
+
+# 创建失败后的重试间隔（秒），避免每次检索都重新加载、向量化全部文档
+RAG_RETRY_INTERVAL = 60
+_rag_failed_at = None
+
 def get_rag_processor():
     """
     获取RAG处理器单例
-    返回一个包含search方法的简单对象，与response_engine兼容
+    返回一个包含search方法的简单对象，与response_engine兼容；创建失败时返回None，超过重试间隔后才会再次尝试创建
     """
+    global rag_processor, _rag_failed_at
+    if rag_processor is None:
+        with _rag_processor_lock:
+            if rag_processor is None:
+                if _rag_failed_at is not None and time.monotonic() - _rag_failed_at < RAG_RETRY_INTERVAL:
+                    return None
+                rag_processor = _create_rag_processor()
+                _rag_failed_at = None if rag_processor is not None else time.monotonic()
+    return rag_processor
+
+def _create_rag_processor():
     print("[RAG] 开始创建RAG处理器...")
     
-    # 加载文档
-    documents = load_documents()
-    if not documents:
+    # 计算文档哈希（大小和修改时间未变的文件沿用清单中的哈希）
+    manifest = load_manifest()
+    file_hashes, file_stats = hash_documents(manifest)
+    if not file_hashes:
+        load_documents()  # 确保文档目录存在
         print("[RAG] 错误：没有加载到任何文档")
         return None
     
-    # 分割文档
-    splits = split_documents(documents)
-    if not splits:
-        print("[RAG] 错误：文档分割后为空")
-        return None
-    
     try:
         # 初始化嵌入模型
-        print(f"[RAG] 初始化嵌入模型，使用: {EMBEDDING_MODEL}")
-        embeddings = OpenAIEmbeddings(
-            openai_api_base=API_BASE,
-            openai_api_key=OPENAI_API_KEY,
-            model=EMBEDDING_MODEL
-        )
+        embeddings, embedding_model = create_embeddings()
         
-        # 创建向量存储
-        print(f"[RAG] 创建向量存储到: {VECTOR_STORE_PATH}")
+        # 映射持久化的向量库，不存在、与清单对不上或嵌入模型已更换时整体重建
+        vector_store = None
+        indexed_hashes = manifest.get("files", {})
+        if manifest.get("embedding_model") != embedding_model:
+            indexed_hashes = {}
+        if indexed_hashes:
+            vector_store = VectorStore.load(VECTOR_STORE_PATH)
+        if vector_store is not None:
+            print(f"[RAG] 加载向量库: {VECTOR_STORE_PATH}，共 {len(vector_store)} 个文档块")
+        else:
+            vector_store = VectorStore()
+            indexed_hashes = {}
         
-        # 删除旧的向量存储
-        import shutil
-        if os.path.exists(VECTOR_STORE_PATH):
-            shutil.rmtree(VECTOR_STORE_PATH, ignore_errors=True)
+        # 对比文件哈希与上次向量化时的清单，只处理新增、修改和删除的文件
+        changed = {file for file, digest in file_hashes.items() if indexed_hashes.get(file) != digest}
+        removed = set(indexed_hashes) - set(file_hashes)
         
-        # 创建新的向量存储
-        vector_store = Chroma.from_documents(
-            documents=splits,
-            embedding=embeddings,
-            persist_directory=VECTOR_STORE_PATH
-        )
+        if changed or removed:
+            print(f"[RAG] 需要更新的文件: {len(changed)} 个，已删除的文件: {len(removed)} 个")
+            
+            # 清除变更文件的旧向量
+            vector_store.delete_sources(changed | removed)
+            
+            # 只加载、分割并向量化变更的文件，文档块按批并发嵌入后一次写入
+            if changed:
+                splits = split_documents(load_documents(changed))
+                add_splits_to_store(vector_store, embeddings, splits)
+            
+            if not len(vector_store):
+                print("[RAG] 错误：文档分割后为空")
+                return None
+        else:
+            print("[RAG] 文档未变化，直接复用已有向量库")
+        
+        # 向量有变化或载入后转换过格式时保存向量库
+        if changed or removed or vector_store.dirty:
+            vector_store.save(VECTOR_STORE_PATH)
+        
+        # 内容变化或仅修改时间变化（如touch）时更新清单，下次启动无需重新计算哈希
+        if changed or removed or file_stats != manifest.get("stats"):
+            save_manifest(embedding_model, file_hashes, file_stats)
         
         
         # 创建检索器
-        retriever = vector_store.as_retriever(
-            search_kwargs={"k": 3}
-        )
+        retriever = VectorRetriever(vector_store, embeddings)
         
         print("[RAG] RAG处理器创建成功！")
         
@@ -111,20 +479,26 @@ def get_rag_processor():
         class SimpleRAGProcessor:
             def __init__(self, retriever):
                 self.retriever = retriever
+                # 重复的查询直接命中缓存，跳过查询向量化和检索
+                self._retrieve = lru_cache(maxsize=QUERY_CACHE_SIZE)(self._retrieve_uncached)
+            
+            def _retrieve_uncached(self, query):
+                """检索并返回(来源, 内容)元组，Document不可哈希，缓存中只存元组"""
+                docs = self.retriever.invoke(query)
+                return tuple((doc.metadata.get("source", "未知"), doc.page_content) for doc in docs)
             
             def search(self, query):
                 try:
                     print(f"[RAG] 正在搜索: {query}")
 
-                    docs = self.retriever.invoke(query)
+                    docs = self._retrieve(query.strip().lower())
                     
                     if not docs:
                         return "未找到相关产品信息。"
                     
                     results = []
-                    for i, doc in enumerate(docs, 1):
-                        source = doc.metadata.get("source", "未知")
-                        content = doc.page_content[:200].replace('\n', ' ')
+                    for source, page_content in docs:
+                        content = page_content[:200].replace('\n', ' ')
                         results.append(f"[来源: {source}] {content}...")
                     
                     return "\n".join(results)
@@ -142,6 +516,7 @@ def get_rag_processor():
 
 
 def search_documents(query):
+    """使用缓存的RAG处理器检索，不会重新加载文档"""
     processor = get_rag_processor()
     if processor:
         return processor.search(query)
@@ -1,6 +1,9 @@
+import asyncio
 import logging
-import openai
-from config import (OPENAI_API_KEY, API_BASE, LLM_MODEL, LLM_TEMPERATURE, 
+import re
+import threading
+from typing import Iterator, List, Optional, Tuple
+from config import (LLM_MODEL, LLM_TEMPERATURE, 
                     ENABLE_RAG,ENABLE_WEB_SEARCH, RAG_DOCUMENTS_PATH, VECTOR_STORE_PATH,
                     EMBEDDING_MODEL, TAVILY_API_KEY)
 from database import UserManager
@@ -8,51 +11,170 @@ from intent_recognizer import IntentRecognizer
 from voice_processor import VoiceProcessor
 from rag import get_rag_processor
 from tools import get_web_tools
+from llm_client import client
 logger = logging.getLogger(__name__)
 
-# 配置OpenAI客户端
-client = openai.OpenAI(
-    api_key=OPENAI_API_KEY,
-    base_url=API_BASE
+# 搜索工具选择关键词（按优先级排列）
+_SEARCH_TOOL_KEYWORDS = (
+    ("WeatherSearch", frozenset(('天气', '气温', '温度', '预报', '下雨', '下雪', '晴', '阴'))),
+    ("NewsSearch", frozenset(('新闻', '最新', '头条', '热点', '时事', '报道'))),
+    ("PriceSearch", frozenset(('价格', '价钱', '多少钱', '报价', '行情', '市场价'))),
 )
+_SEARCH_TOOL_PRIORITY = {tool_name: i for i, (tool_name, _) in enumerate(_SEARCH_TOOL_KEYWORDS)}
+
+# 全部关键词编译为一个带命名分组的正则，一次扫描即可得到命中的工具类别
+_SEARCH_TOOL_PATTERN = re.compile("|".join(
+    f"(?P<{tool_name}>" + "|".join(map(re.escape, sorted(keywords, key=len, reverse=True))) + ")"
+    for tool_name, keywords in _SEARCH_TOOL_KEYWORDS
+))
+
+# 常规问答携带的历史消息条数
+HISTORY_TURNS = 5
+_ROLE_NAMES = {"user": "用户", "assistant": "助手"}
+
+def _history_messages(conversations: List[dict]) -> List[dict]:
+    """将数据库中的对话记录转换为模型的多轮消息"""
+    return [
+        {"role": c["role"], "content": c["content"]}
+        for c in conversations if c["role"] in _ROLE_NAMES and c["content"]
+    ]
 
 class ResponseEngine:
-    def __init__(self):
+    # 实例属性固定，使用__slots__省去每个实例的__dict__
+    __slots__ = (
+        'llm_client', 'user_manager', 'intent_recognizer', 'voice_processor',
+        '_rag_processor', '_rag_initialized', '_web_tools', '_web_tools_initialized',
+        '_init_lock'
+    )
+    
+    # 各意图的回复提示词模板，调用时只格式化选中的一个
+    _PROMPTS = {
+        "A": """
+            你是一个专业的CRM产品客服助手。基于以下检索到的产品信息回答用户的问题：
+            
+            用户问题：{query}
+            
+            检索到的产品信息：
+            {context}
+            
+            请注意：
+            1. 如果检索到的信息中有直接答案，请优先使用检索到的信息
+            2. 如果信息不完整，可以基于常识补充，但要注明哪些是检索信息，哪些是补充信息
+            3. 保持回答的专业性和准确性
+            4. 如果用户询问产品文档中没有的信息，可以建议用户提供更多细节或联系技术支持
+            
+            请提供专业、准确的产品咨询回复。
+            """,
+        "B": """
+            你是一个精准的实时信息助手。基于以下搜索到的实时信息回答用户的问题：
+            
+            用户问题：{query}
+            搜索到的实时信息：
+            {context}
+            
+            【强制要求】：
+            1. 必须提炼核心数据（如天气需包含温度、天气状况；价格需包含具体数值；新闻需包含核心事件）；
+            2. 回答要简洁、直接，不要使用"请访问链接"等模糊表述，直接给出具体数值/状态；
+            3. 信息格式要结构化（如：深圳今日天气：晴，气温18℃，东风2级）；
+            4. 仅使用搜索到的信息回答，不要编造数据；如果信息不足，明确说明核心数据，但不要推荐外部链接。
+            
+            请提供精准、结构化的实时信息回复，不要冗余内容。
+            """,
+        "C": """
+            你是一个友好的CRM客服助手。回复用户问题：
+            
+            用户问题：{query}
+            对话上下文：{context}
+            
+            请提供有帮助的、友好的回复。
+            如果你是第一次与用户交流，请先自我介绍："你好，我是CRM智能助手小云，请问有什么可以帮您？"
+            """
+    }
+    
+    # 模型调用失败时的降级回复
+    _FALLBACK_RESPONSES = {
+        "A": "抱歉，我暂时无法查询到详细的产品信息。您可以联系我们的产品专家获取更详细的解答。",
+        "B": "抱歉，目前无法获取到最新的实时信息。请您稍后再试或尝试其他查询方式。",
+        "C": "抱歉，我暂时无法处理您的问题，请稍后再试。"
+    }
+    
+    def __init__(self, llm_client=None):
+        # 默认使用进程内共享连接池的LLM客户端
+        self.llm_client = llm_client or client
         self.user_manager = UserManager()
         self.intent_recognizer = IntentRecognizer()
         self.voice_processor = VoiceProcessor()
 
-        # 初始化RAG处理器
-        self.rag_processor = None
-        if ENABLE_RAG:
-            try:
-                self.rag_processor = get_rag_processor()
-                if self.rag_processor.retriever:
-                    logger.info("RAG处理器初始化成功")
-                else:
-                    logger.warning("RAG处理器初始化失败，产品咨询功能将受限")
-            except Exception as e:
-                logger.error(f"RAG处理器初始化异常: {e}")
-        
-        # 初始化Web搜索工具
-        self.web_tools = None
-        if ENABLE_WEB_SEARCH:
-            try:
-                self.web_tools = get_web_tools()
-                if self.web_tools.tools:
-                    logger.info(f"Web搜索工具初始化成功，共 {len(self.web_tools.tools)} 个工具")
-                else:
-                    logger.warning("Web搜索工具初始化失败，实时信息功能将受限")
-            except Exception as e:
-                logger.error(f"Web搜索工具初始化异常: {e}")
+        # RAG处理器和Web搜索工具在首次使用时才初始化，只走常规问答的请求不承担初始化开销
+        self._rag_processor = None
+        self._rag_initialized = False
+        self._web_tools = None
+        self._web_tools_initialized = False
+        self._init_lock = threading.Lock()
     
-    def process_query(self, phone_number: str, query: str, channel: str = 'text') -> dict:
-        """处理用户查询，支持文本和语音渠道"""
+    @property
+    def rag_processor(self):
+        """RAG处理器（首次访问时初始化）"""
+        if not self._rag_initialized:
+            with self._init_lock:
+                if not self._rag_initialized:
+                    self._rag_processor = self._init_rag_processor()
+                    self._rag_initialized = True
+        return self._rag_processor
+    
+    @property
+    def web_tools(self):
+        """Web搜索工具（首次访问时初始化）"""
+        if not self._web_tools_initialized:
+            with self._init_lock:
+                if not self._web_tools_initialized:
+                    self._web_tools = self._init_web_tools()
+                    self._web_tools_initialized = True
+        return self._web_tools
+    
+    def _init_rag_processor(self):
+        if not ENABLE_RAG:
+            return None
+        try:
+            rag_processor = get_rag_processor()
+            if rag_processor and rag_processor.retriever:
+                logger.info("RAG处理器初始化成功")
+            else:
+                logger.warning("RAG处理器初始化失败，产品咨询功能将受限")
+            return rag_processor
+        except Exception as e:
+            logger.error(f"RAG处理器初始化异常: {e}")
+            return None
+    
+    def _init_web_tools(self):
+        if not ENABLE_WEB_SEARCH:
+            return None
+        try:
+            web_tools = get_web_tools()
+            if web_tools.tools:
+                logger.info(f"Web搜索工具初始化成功，共 {len(web_tools.tools)} 个工具")
+            else:
+                logger.warning("Web搜索工具初始化失败，实时信息功能将受限")
+            return web_tools
+        except Exception as e:
+            logger.error(f"Web搜索工具初始化异常: {e}")
+            return None
+    
+    def _prepare_query(self, phone_number: str, query: str, channel: str) -> Tuple[int, bool, str, str, List[dict]]:
+        """识别用户、记录提问、识别意图并获取上下文，返回(user_id, is_new_user, intent_code, context, history)"""
         # 用户识别和管理
         user_id, is_new_user = self.user_manager.get_or_create_user(phone_number, channel)
         
-        # 获取用户对话历史
-        chat_history = self.user_manager.get_user_conversations(user_id)
+        # 意图识别
+        intent_code = self.intent_recognizer.detect_intent(query)
+        logger.info(f"用户{phone_number} 意图识别: {intent_code} (渠道: {channel})")
+        
+        # 常规问答需要最近的对话历史，在记录本次提问前读取一次，作为多轮消息传给模型
+        history = []
+        if intent_code not in ("A", "B"):
+            history = _history_messages(
+                self.user_manager.get_user_conversations(user_id, limit=HISTORY_TURNS)
+            )
         
         # 记录用户提问
         metadata = {}
@@ -64,10 +186,6 @@ class ResponseEngine:
             audio_path=None, metadata=metadata
         )
         
-        # 意图识别
-        intent_code = self.intent_recognizer.detect_intent(query)
-        logger.info(f"用户{phone_number} 意图识别: {intent_code} (渠道: {channel})")
-        
         # 根据意图处理查询
         context = ""
         if intent_code == "A":
@@ -75,12 +193,34 @@ class ResponseEngine:
         elif intent_code == "B":
             context = self.web_search(query)
         else:
-            context = "对话历史: " + str(chat_history[-5:]) if chat_history else "无历史对话"
+            context = "请参考之前的对话" if history else "无历史对话"
+        
+        return user_id, is_new_user, intent_code, context, history
+    
+    def process_query(self, phone_number: str, query: str, channel: str = 'text') -> dict:
+        """处理用户查询，支持文本和语音渠道"""
+        user_id, is_new_user, intent_code, context, history = self._prepare_query(phone_number, query, channel)
         
         # 生成回复
-        response = self.generate_response(query, context, intent_code)
+        response = self.generate_response(query, context, intent_code, history)
         
-        # 记录助手回复
+        return self._finish_query(user_id, is_new_user, intent_code, response, channel)
+    
+    async def process_query_batched(self, phone_number: str, query: str, channel: str = 'text') -> dict:
+        """异步处理用户查询，阻塞步骤在线程池中执行"""
+        user_id, is_new_user, intent_code, context, history = await asyncio.to_thread(
+            self._prepare_query, phone_number, query, channel
+        )
+        
+        if intent_code == "C":
+            response = await asyncio.to_thread(self.generate_response, query, context, intent_code, history)
+        else:
+            response = await asyncio.to_thread(self.generate_response, query, context, intent_code)
+        
+        return await asyncio.to_thread(self._finish_query, user_id, is_new_user, intent_code, response, channel)
+    
+    def _finish_query(self, user_id: int, is_new_user: bool, intent_code: str, response: str, channel: str) -> dict:
+        """记录助手回复并组装返回结果"""
         self.user_manager.add_conversation(
             user_id, channel, "assistant", response, intent_code
         )
@@ -97,58 +237,26 @@ class ResponseEngine:
         
         return result
     
+    def process_query_stream(self, phone_number: str, query: str, channel: str = 'text') -> Iterator[str]:
+        """处理用户查询并逐段产出回复文本，回复结束后记录到对话历史"""
+        user_id, _, intent_code, context, history = self._prepare_query(phone_number, query, channel)
+        
+        parts = []
+        for delta in self.generate_response_stream(query, context, intent_code, history):
+            parts.append(delta)
+            yield delta
+        
+        # 记录助手回复
+        self.user_manager.add_conversation(
+            user_id, channel, "assistant", "".join(parts).strip(), intent_code
+        )
+    
     async def process_voice_query(self, phone_number: str, audio_data: bytes) -> dict:
         """专门处理语音查询"""
         # 使用语音处理器处理
-        result = await self.voice_processor.process_voice_query(audio_data, phone_number)
+        result = await self.voice_processor.process_voice_query(audio_data, phone_number, engine=self)
         return result
 
-    def generate_response(self, query: str, context: str, intent: str) -> str:
-        """生成最终回复"""
-        prompt_templates = {
-            "A": f"""
-            你是一个专业的客服助手。基于以下信息回复用户：
-            
-            用户问题：{query}
-            检索到的产品信息：{context}
-            用户历史对话：请参考对话历史提供连贯的回复
-            
-            请提供专业、准确的产品咨询回复。
-            """,
-            "B": f"""
-            你是一个信息助手。基于以下信息回复用户：
-            
-            用户问题：{query}
-            实时搜索信息：{context}
-            
-            请提供最新、准确的实时信息。
-            """,
-            "C": f"""
-            你是一个友好的客服助手。回复用户问题：
-            
-            用户问题：{query}
-            对话上下文：{context}
-            
-            请提供有帮助的、友好的回复。
-            """
-        }
-        
-        prompt = prompt_templates.get(intent, prompt_templates["C"])
-        
-        try:
-            response = client.chat.completions.create(
-                model=LLM_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=LLM_TEMPERATURE,
-                max_tokens=1000
-            )
-            
-            return response.choices[0].message.content.strip()
-            
-        except Exception as e:
-            logger.error(f"模型回复生成失败: {e}")
-            return "抱歉，我暂时无法处理您的问题，请稍后再试。"
-        
     def rag_retrieval(self, query: str) -> str:
         """RAG检索处理 - 从本地知识库获取产品信息"""
         logger.info(f"执行RAG检索: {query}")
@@ -200,92 +308,61 @@ class ResponseEngine:
     
     def _select_search_tool(self, query: str) -> str:
         """根据查询内容选择合适的搜索工具"""
-        query_lower = query.lower()
-        
-        # 检查是否包含天气相关关键词
-        weather_keywords = ['天气', '气温', '温度', '预报', '下雨', '下雪', '晴', '阴']
-        if any(keyword in query_lower for keyword in weather_keywords):
-            return "WeatherSearch"
-        
-        # 检查是否包含新闻相关关键词
-        news_keywords = ['新闻', '最新', '头条', '热点', '时事', '报道']
-        if any(keyword in query_lower for keyword in news_keywords):
-            return "NewsSearch"
-        
-        # 检查是否包含价格相关关键词
-        price_keywords = ['价格', '价钱', '多少钱', '报价', '行情', '市场价']
-        if any(keyword in query_lower for keyword in price_keywords):
-            return "PriceSearch"
+        # 一次扫描收集命中的类别，多个类别命中时按天气、新闻、价格的优先级选择
+        matched = {match.lastgroup for match in _SEARCH_TOOL_PATTERN.finditer(query)}
+        if matched:
+            return min(matched, key=_SEARCH_TOOL_PRIORITY.__getitem__)
         
         # 默认使用通用搜索
         return "WebSearch"
     
-    def generate_response(self, query: str, context: str, intent: str) -> str:
-        """生成最终回复 - 增强版，包含RAG和搜索上下文"""
-        prompt_templates = {
-            "A": f"""
-            你是一个专业的CRM产品客服助手。基于以下检索到的产品信息回答用户的问题：
-            
-            用户问题：{query}
-            
-            检索到的产品信息：
-            {context}
-            
-            请注意：
-            1. 如果检索到的信息中有直接答案，请优先使用检索到的信息
-            2. 如果信息不完整，可以基于常识补充，但要注明哪些是检索信息，哪些是补充信息
-            3. 保持回答的专业性和准确性
-            4. 如果用户询问产品文档中没有的信息，可以建议用户提供更多细节或联系技术支持
-            
-            请提供专业、准确的产品咨询回复。
-            """,
-            "B": f"""
-            你是一个精准的实时信息助手。基于以下搜索到的实时信息回答用户的问题：
-            
-            用户问题：{query}
-            搜索到的实时信息：
-            {context}
-            
-            【强制要求】：
-            1. 必须提炼核心数据（如天气需包含温度、天气状况；价格需包含具体数值；新闻需包含核心事件）；
-            2. 回答要简洁、直接，不要使用"请访问链接"等模糊表述，直接给出具体数值/状态；
-            3. 信息格式要结构化（如：深圳今日天气：晴，气温18℃，东风2级）；
-            4. 仅使用搜索到的信息回答，不要编造数据；如果信息不足，明确说明核心数据，但不要推荐外部链接。
-            
-            请提供精准、结构化的实时信息回复，不要冗余内容。
-            """,
-            "C": f"""
-            你是一个友好的CRM客服助手。回复用户问题：
-            
-            用户问题：{query}
-            对话上下文：{context}
-            
-            请提供有帮助的、友好的回复。
-            如果你是第一次与用户交流，请先自我介绍："你好，我是CRM智能助手小云，请问有什么可以帮您？"
-            """
-        }
-        
-        prompt = prompt_templates.get(intent, prompt_templates["C"])
+    def generate_response_stream(self, query: str, context: str, intent: str,
+                                 history: Optional[List[dict]] = None) -> Iterator[str]:
+        """流式生成回复，模型输出的文本逐段产出；history为之前的多轮消息；未产出任何内容就失败时产出降级回复"""
+        prompt = self._PROMPTS.get(intent, self._PROMPTS["C"]).format(query=query, context=context)
+        messages = [*(history or ()), {"role": "user", "content": prompt}]
         
+        produced = False
         try:
-            response = client.chat.completions.create(
+            stream = self.llm_client.chat.completions.create(
                 model=LLM_MODEL,
-                messages=[{"role": "user", "content": prompt}],
+                messages=messages,
                 temperature=LLM_TEMPERATURE,
-                max_tokens=1000
+                max_tokens=1000,
+                stream=True
             )
             
-            return response.choices[0].message.content.strip()
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    produced = True
+                    yield delta
             
         except Exception as e:
             logger.error(f"模型回复生成失败: {e}")
             # 提供降级回复
-            fallback_responses = {
-                "A": "抱歉，我暂时无法查询到详细的产品信息。您可以联系我们的产品专家获取更详细的解答。",
-                "B": "抱歉，目前无法获取到最新的实时信息。请您稍后再试或尝试其他查询方式。",
-                "C": "抱歉，我暂时无法处理您的问题，请稍后再试。"
+            if not produced:
+                yield self._FALLBACK_RESPONSES.get(intent, self._FALLBACK_RESPONSES["C"])
+    
+    def generate_response(self, query: str, context: str, intent: str, history: Optional[List[dict]] = None) -> str:
+        """生成最终回复 - 增强版，包含RAG和搜索上下文（汇总流式输出）"""
+        return "".join(self.generate_response_stream(query, context, intent, history)).strip()
+    
+    def get_user_history(self, phone_number: str, limit: int = 10, offset: int = 0) -> dict:
+        """获取用户对话历史（分页）"""
+        try:
+            user_id, _ = self.user_manager.get_or_create_user(phone_number)
+            return {
+                "success": True,
+                "phone_number": phone_number,
+                "user_id": user_id,
+                "conversation_history": self.user_manager.get_user_conversations(user_id, limit, offset)
             }
-            return fallback_responses.get(intent, "抱歉，我暂时无法处理您的问题，请稍后再试。")
+        except Exception as e:
+            logger.error(f"获取用户历史失败: {e}")
+            return {"success": False, "error": str(e)}
     
     # 添加RAG管理方法
     def add_document_to_knowledge_base(self, file_path: str) -> bool:
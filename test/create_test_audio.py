@@ -2,6 +2,7 @@
 使用本地TTS库生成测试音频
 """
 
+import asyncio
 import os
 import sys
 import time
@@ -57,24 +58,15 @@ class LocalTTSGenerator:
         
         return engines
     
-    def generate_with_edge_tts(self, text: str, output_path: Path) -> bool:
-        """使用edge-tts生成语音"""
+    async def _edge_tts_save(self, text: str, output_path: Path) -> bool:
+        """使用edge-tts生成一条语音"""
         try:
-            import asyncio
             import edge_tts
             
-            async def _generate():
-                tts = edge_tts.Communicate(text=text, voice="zh-CN-XiaoxiaoNeural")
-                await tts.save(str(output_path))
-                return True
-            
-            # 运行异步函数
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(_generate())
-            loop.close()
+            tts = edge_tts.Communicate(text=text, voice="zh-CN-XiaoxiaoNeural")
+            await tts.save(str(output_path))
             
-            if result and output_path.exists():
+            if output_path.exists():
                 print(f"  ✅ edge-tts: {text[:30]}...")
                 return True
             return False
@@ -82,6 +74,20 @@ class LocalTTSGenerator:
             print(f"  ❌ edge-tts失败: {e}")
             return False
     
+    async def _edge_tts_all(self, jobs: List[tuple], max_concurrency: int = 5) -> List[bool]:
+        """在同一个事件循环中并发生成多条语音（限制同时进行的请求数）"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def _generate(text, output_path):
+            async with semaphore:
+                return await self._edge_tts_save(text, output_path)
+        
+        return await asyncio.gather(*(_generate(text, output_path) for text, output_path in jobs))
+    
+    def generate_with_edge_tts(self, text: str, output_path: Path) -> bool:
+        """使用edge-tts生成语音"""
+        return asyncio.run(self._edge_tts_save(text, output_path))
+    
     def generate_with_pyttsx3(self, text: str, output_path: Path) -> bool:
         """使用pyttsx3生成语音"""
         try:
@@ -190,33 +196,40 @@ class LocalTTSGenerator:
         print(f"输出目录: {output_path.absolute()}")
         print("-" * 60)
         
-        # 生成音频
-        generated_files = []
+        # 创建安全的文件名
+        jobs = []
         for i, phrase in enumerate(self.test_phrases, 1):
-            print(f"生成音频 {i}/{len(self.test_phrases)}: {phrase[:40]}...")
-            
-            # 创建安全的文件名
             safe_name = f"test_{i:02d}_{phrase[:10]}.wav".replace(' ', '_')
-            file_path = output_path / safe_name
-            
-            success = False
-            if engine_choice == "edge-tts":
-                success = self.generate_with_edge_tts(phrase, file_path)
-            elif engine_choice == "pyttsx3":
-                success = self.generate_with_pyttsx3(phrase, file_path)
-            elif engine_choice == "gtts":
-                success = self.generate_with_gtts(phrase, file_path)
-            
+            jobs.append((phrase, output_path / safe_name))
+        
+        # 生成音频：edge-tts是网络请求，所有语句在一个事件循环中并发生成
+        if engine_choice == "edge-tts":
+            print(f"并发生成 {len(jobs)} 条音频...")
+            results = asyncio.run(self._edge_tts_all(jobs))
+        else:
+            results = []
+            for i, (phrase, file_path) in enumerate(jobs, 1):
+                print(f"生成音频 {i}/{len(jobs)}: {phrase[:40]}...")
+                
+                success = False
+                if engine_choice == "pyttsx3":
+                    success = self.generate_with_pyttsx3(phrase, file_path)
+                elif engine_choice == "gtts":
+                    success = self.generate_with_gtts(phrase, file_path)
+                results.append(success)
+                
+                # 避免请求过快
+                time.sleep(1)
+        
+        generated_files = []
+        for (phrase, file_path), success in zip(jobs, results):
             if success and file_path.exists():
                 generated_files.append((phrase, file_path))
                 # 显示文件大小
                 size_kb = os.path.getsize(file_path) / 1024
-                print(f"    大小: {size_kb:.1f} KB")
+                print(f"    {file_path.name} 大小: {size_kb:.1f} KB")
             else:
-                print(f"    ❌ 生成失败")
-            
-            # 避免请求过快
-            time.sleep(1)
+                print(f"    ❌ {file_path.name} 生成失败")
         
         print("-" * 60)
         print(f"✅ 完成！共生成 {len(generated_files)} 个音频文件")
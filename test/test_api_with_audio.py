@@ -1,34 +1,134 @@
+import asyncio
+import httpx
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+import orjson
+import hashlib
+import heapq
 import os
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
 from pathlib import Path
 from typing import Dict, List, Optional
 import wave
 
+# response_audio目录中超过保留天数的响应音频在生成报告时清理
+RESPONSE_AUDIO_RETENTION_DAYS = 7
+
 class APIAudioTester:
     """API音频测试器 - 优化版"""
     
-    def __init__(self, base_url: str = "http://localhost:8003"):
+    def __init__(self, base_url: str = "http://localhost:8003", max_workers: Optional[int] = None):
         self.base_url = base_url
         self.test_results = []
         
+        # 各测试用例互相独立，并发发出请求；并发数即对服务端的限流
+        self.max_workers = max_workers or max(2, (os.cpu_count() or 4) - 2)
+        
+        # 所有请求共用一个会话，复用keep-alive连接，连接池不小于并发数
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(32, self.max_workers),
+            max_retries=Retry(total=2, backoff_factor=0.1)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        
         # 设置音频保存目录和测试报告目录
         self.response_audio_dir = Path("response_audio")
         self.test_report_dir = Path("test_report")
         self.setup_directories()
+        
+        # 开发时设置VA_TEST_CACHE=1，相同的请求直接返回本地缓存的响应，不再访问API
+        self.cache_enabled = os.getenv("VA_TEST_CACHE") == "1"
+        self.cache_file = self.test_report_dir / "test_cache.jsonl"
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        if self.cache_enabled:
+            self.load_request_cache()
+        
+        # 每个用例完成时即追加写入一行结果，测试中途中断也能保留已完成的结果
+        self.results_file = self.test_report_dir / f"test_results_{int(time.time())}_{os.getpid()}.jsonl"
+        self._results_stream = open(self.results_file, 'ab', buffering=1 << 16)
+        self._results_lock = threading.Lock()
+        
+        # 汇总统计在记录结果时累加，生成报告时无需再遍历全部结果
+        self._success_count = 0
+        self._intent_counts = Counter()
     
     def setup_directories(self):
         """设置音频保存目录和测试报告目录"""
-        # 创建音频保存目录
-        if not self.response_audio_dir.exists():
-            self.response_audio_dir.mkdir(exist_ok=True)
-            print(f"📁 创建音频保存目录: {self.response_audio_dir}")
-        
-        # 创建测试报告目录
-        if not self.test_report_dir.exists():
-            self.test_report_dir.mkdir(exist_ok=True)
-            print(f"📁 创建测试报告目录: {self.test_report_dir}")
+        # mkdir自身处理目录已存在的情况，多进程同时启动时也不会冲突
+        try:
+            self.response_audio_dir.mkdir(parents=True, exist_ok=True)
+            self.test_report_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"❌ 创建目录失败: {e}")
+            raise
+    
+    def load_request_cache(self):
+        """从JSONL文件加载请求缓存"""
+        if not self.cache_file.exists():
+            return
+        with open(self.cache_file, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    entry = orjson.loads(line)
+                    self._cache[entry["key"]] = entry
+        print(f"🗂️  已加载请求缓存: {len(self._cache)} 条")
+    
+    def cached_request(self, method: str, path: str, payload: Optional[Dict] = None, **kwargs) -> requests.Response:
+        """发送JSON请求；启用缓存时按(接口, 请求体哈希)命中则直接返回缓存的响应"""
+        url = f"{self.base_url}{path}"
+        if not self.cache_enabled:
+            return self.session.request(method, url, json=payload, **kwargs)
+        
+        body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+        key = hashlib.blake2b(f"{method} {url} ".encode('utf-8') + body, digest_size=16).hexdigest()
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        
+        if entry is None:
+            response = self.session.request(method, url, json=payload, **kwargs)
+            # 只缓存成功的响应
+            if response.status_code != 200:
+                return response
+            entry = {
+                "key": key,
+                "status": response.status_code,
+                "headers": dict(response.headers),
+                "body": response.text
+            }
+            with self._cache_lock:
+                self._cache[key] = entry
+                with open(self.cache_file, 'ab') as f:
+                    f.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+            return response
+        
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers.update(entry["headers"])
+        response.encoding = 'utf-8'
+        response._content = entry["body"].encode('utf-8')
+        response.url = url
+        return response
+    
+    def close(self):
+        """关闭HTTP会话及其连接池和结果文件"""
+        self.session.close()
+        self._results_stream.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     def save_audio_response(self, audio_data: bytes, test_name: str = "response") -> str:
         """保存音频响应到response_audio目录"""
@@ -51,12 +151,29 @@ class APIAudioTester:
             print(f"⚠️  音频已保存到临时文件: {temp_file}")
             return temp_file
     
+    async def save_audio_stream(self, response: httpx.Response, test_name: str = "response") -> tuple:
+        """将流式音频响应分块写入response_audio目录，返回(文件路径, 字节数)"""
+        timestamp = int(time.time())
+        filename = f"{test_name}_{timestamp}.wav"
+        filepath = self.response_audio_dir / filename
+        
+        # 响应体边接收边写盘，不在内存中保留完整音频
+        audio_size = 0
+        with open(filepath, 'wb', buffering=1 << 20) as f:
+            async for chunk in response.aiter_bytes(chunk_size=64 * 1024):
+                f.write(chunk)
+                audio_size += len(chunk)
+        
+        print(f"💾 音频已保存到: {filepath}")
+        print(f"   文件大小: {audio_size:,} 字节")
+        return str(filepath), audio_size
+    
     def test_health(self) -> bool:
         """测试健康检查接口"""
         try:
-            response = requests.get(f"{self.base_url}/health", timeout=5)
+            response = self.cached_request("GET", "/health", timeout=5)
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 print(f"✅ 健康检查通过")
                 print(f"   模型: {data.get('model')}")
                 print(f"   语音支持: {data.get('voice_enabled')}")
@@ -68,6 +185,30 @@ class APIAudioTester:
             print(f"❌ 健康检查异常: {e}")
             return False
     
+    def test_health_cache(self) -> bool:
+        """测试健康检查缓存：HEALTH_CACHE_TTL内连续两次请求都返回200，第二次命中服务端缓存"""
+        try:
+            # 直接发出请求，不经过本地响应缓存
+            first = self.session.get(f"{self.base_url}/health", timeout=5)
+            second = self.session.get(f"{self.base_url}/health", timeout=5)
+            if first.status_code != 200 or second.status_code != 200:
+                print(f"❌ 健康检查缓存测试失败: {first.status_code}, {second.status_code}")
+                return False
+            
+            cache_status = second.headers.get("X-Cache")
+            if cache_status is None:
+                print("⚠️ 服务未返回X-Cache头（未启用健康检查缓存），跳过缓存检查")
+                return True
+            if cache_status != "HIT":
+                print(f"❌ 第二次健康检查未命中缓存: X-Cache={cache_status}")
+                return False
+            
+            print("✅ 健康检查缓存命中")
+            return True
+        except Exception as e:
+            print(f"❌ 健康检查缓存测试异常: {e}")
+            return False
+    
     def test_text_chat(self, phone_number: str, text: str) -> Optional[Dict]:
         """测试文本聊天"""
         try:
@@ -79,16 +220,12 @@ class APIAudioTester:
             print(f"📝 测试文本聊天: {text[:30]}...")
             start_time = time.time()
             
-            response = requests.post(
-                f"{self.base_url}/chat",
-                json=payload,
-                timeout=60
-            )
+            response = self.cached_request("POST", "/chat", payload, timeout=60)
             
             response_time = (time.time() - start_time) * 1000
             
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 print(f"✅ 文本聊天成功")
                 print(f"   响应时间: {response_time:.0f}ms")
                 print(f"   用户ID: {data.get('user_id')}")
@@ -111,7 +248,7 @@ class APIAudioTester:
             print(f"❌ 文本聊天异常: {e}")
             return {"success": False, "error": str(e)}
     
-    def test_voice_recognize(self, audio_file_path: str) -> Optional[Dict]:
+    async def test_voice_recognize(self, client: httpx.AsyncClient, audio_file_path: str) -> Optional[Dict]:
         """测试语音识别"""
         try:
             if not os.path.exists(audio_file_path):
@@ -121,18 +258,14 @@ class APIAudioTester:
             print(f"🔊 测试语音识别: {os.path.basename(audio_file_path)}")
             start_time = time.time()
             
-            with open(audio_file_path, 'rb') as audio_file:
+            with open(audio_file_path, 'rb', buffering=1 << 20) as audio_file:
                 files = {'audio': audio_file}
-                response = requests.post(
-                    f"{self.base_url}/voice/recognize",
-                    files=files,
-                    timeout=300
-                )
+                response = await client.post("/voice/recognize", files=files)
             
             response_time = (time.time() - start_time) * 1000
             
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 print(f"✅ 语音识别成功")
                 print(f"   响应时间: {response_time:.0f}ms")
                 print(f"   识别结果: {data.get('recognized_text', '')}")
@@ -153,7 +286,7 @@ class APIAudioTester:
             print(f"❌ 语音识别异常: {e}")
             return {"success": False, "error": str(e)}
     
-    def test_voice_chat(self, phone_number: str, audio_file_path: str) -> Optional[Dict]:
+    async def test_voice_chat(self, client: httpx.AsyncClient, phone_number: str, audio_file_path: str) -> Optional[Dict]:
         """测试语音聊天"""
         try:
             if not os.path.exists(audio_file_path):
@@ -163,65 +296,64 @@ class APIAudioTester:
             print(f"🎤 测试语音聊天: {os.path.basename(audio_file_path)}")
             start_time = time.time()
             
-            with open(audio_file_path, 'rb') as audio_file:
+            with open(audio_file_path, 'rb', buffering=1 << 20) as audio_file:
                 files = {'audio': audio_file}
                 data = {'phone_number': phone_number}
-                response = requests.post(
-                    f"{self.base_url}/voice/chat",
-                    files=files,
-                    data=data,
-                    timeout=300
-                )
-            
-            response_time = (time.time() - start_time) * 1000
-            content_type = response.headers.get('Content-Type', '')
-            
-            result = {
-                "success": response.status_code == 200,
-                "response_time": response_time,
-                "content_type": content_type
-            }
-            
-            if response.status_code == 200:
-                if 'audio/wav' in content_type:
-                    # 音频响应 - 保存到response_audio目录
-                    test_name = f"voice_chat_{phone_number}"
-                    audio_path = self.save_audio_response(response.content, test_name)
-                    
-                    print(f"✅ 语音聊天成功 (音频回复)")
-                    print(f"   响应时间: {response_time:.0f}ms")
-                    print(f"   音频大小: {len(response.content)} 字节")
-                    print(f"   音频已保存到: {os.path.basename(audio_path)}")
+                async with client.stream("POST", "/voice/chat", files=files, data=data) as response:
+                    response_time = (time.time() - start_time) * 1000
+                    content_type = response.headers.get('Content-Type', '')
                     
-                    result["audio_file"] = audio_path
-                    result["audio_size"] = len(response.content)
+                    result = {
+                        "success": response.status_code == 200,
+                        "response_time": response_time,
+                        "content_type": content_type
+                    }
                     
-                elif 'application/json' in content_type:
-                    # 文本响应
-                    response_data = response.json()
-                    print(f"✅ 语音聊天成功 (文本回复)")
-                    print(f"   响应时间: {response_time:.0f}ms")
-                    print(f"   识别文本: {response_data.get('recognized_text', '')}")
-                    print(f"   回复内容: {response_data.get('response', '')[:50]}...")
-                    print(f"   意图: {response_data.get('intent', '')}")  # 添加意图打印
-                    
-                    result["data"] = response_data
-                    
-                    # 如果有音频响应字段，也保存到response_audio目录
-                    if response_data.get('audio_response'):
-                        test_name = f"voice_chat_json_{phone_number}"
-                        audio_path = self.save_audio_response(
-                            response_data['audio_response'], 
-                            test_name
-                        )
-                        result["audio_file"] = audio_path
-                        result["audio_size"] = len(response_data['audio_response'])
-                else:
-                    print(f"⚠️  未知响应类型: {content_type}")
-                    result["success"] = False
-            else:
-                print(f"❌ 语音聊天失败: {response.status_code} - {response.text[:100]}")
-                result["error"] = f"HTTP {response.status_code}"
+                    if response.status_code == 200:
+                        if 'audio/wav' in content_type:
+                            # 音频响应 - 保存到response_audio目录
+                            test_name = f"voice_chat_{phone_number}_{Path(audio_file_path).stem}"
+                            audio_path, audio_size = await self.save_audio_stream(response, test_name)
+                            
+                            # 响应时间计入音频接收完成
+                            response_time = (time.time() - start_time) * 1000
+                            result["response_time"] = response_time
+                            
+                            print(f"✅ 语音聊天成功 (音频回复)")
+                            print(f"   响应时间: {response_time:.0f}ms")
+                            print(f"   音频大小: {audio_size} 字节")
+                            print(f"   音频已保存到: {os.path.basename(audio_path)}")
+                            
+                            result["audio_file"] = audio_path
+                            result["audio_size"] = audio_size
+                            
+                        elif 'application/json' in content_type:
+                            # 文本响应
+                            response_data = orjson.loads(await response.aread())
+                            print(f"✅ 语音聊天成功 (文本回复)")
+                            print(f"   响应时间: {response_time:.0f}ms")
+                            print(f"   识别文本: {response_data.get('recognized_text', '')}")
+                            print(f"   回复内容: {response_data.get('response', '')[:50]}...")
+                            print(f"   意图: {response_data.get('intent', '')}")  # 添加意图打印
+                            
+                            result["data"] = response_data
+                            
+                            # 如果有音频响应字段，也保存到response_audio目录
+                            if response_data.get('audio_response'):
+                                test_name = f"voice_chat_json_{phone_number}_{Path(audio_file_path).stem}"
+                                audio_path = self.save_audio_response(
+                                    response_data['audio_response'], 
+                                    test_name
+                                )
+                                result["audio_file"] = audio_path
+                                result["audio_size"] = len(response_data['audio_response'])
+                        else:
+                            print(f"⚠️  未知响应类型: {content_type}")
+                            result["success"] = False
+                    else:
+                        await response.aread()
+                        print(f"❌ 语音聊天失败: {response.status_code} - {response.text[:100]}")
+                        result["error"] = f"HTTP {response.status_code}"
             
             return result
                 
@@ -229,8 +361,86 @@ class APIAudioTester:
             print(f"❌ 语音聊天异常: {e}")
             return {"success": False, "error": str(e)}
     
-    def run_comprehensive_test(self, audio_dir: str = "test_audio"):
-        """运行综合测试"""
+    def record_result(self, test_type: str, fields: Dict, result: Optional[Dict]) -> Dict:
+        """生成一条测试记录并立即追加到结果文件"""
+        record = {"type": test_type, **fields, "result": result}
+        line = orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        with self._results_lock:
+            self._results_stream.write(line)
+            self._count_result(result)
+        return record
+    
+    def _count_result(self, result: Optional[Dict]):
+        """累加成功数和意图分布（调用方持有_results_lock）"""
+        if result and result.get("success"):
+            self._success_count += 1
+            intent = (result.get("data") or {}).get("intent")
+            if intent:
+                self._intent_counts[intent] += 1
+    
+    def run_case(self, case: tuple) -> Dict:
+        """在线程池中执行一个同步测试用例"""
+        test_type, fields, method_name, args = case
+        return self.record_result(test_type, fields, getattr(self, method_name)(*args))
+    
+    async def run_voice_case(self, client: httpx.AsyncClient, case: tuple) -> Dict:
+        """执行一个语音测试用例"""
+        test_type, fields, method_name, args = case
+        return self.record_result(test_type, fields, await getattr(self, method_name)(client, *args))
+    
+    async def run_voice_tests(self, cases: list) -> list:
+        """通过HTTP/2异步客户端并发执行语音测试用例，返回与用例顺序一致的测试记录"""
+        if not cases:
+            return []
+        
+        # 多个音频上传复用同一连接上的HTTP/2流（服务端不支持时回退到HTTP/1.1连接池）
+        async with httpx.AsyncClient(
+            http2=True,
+            base_url=self.base_url,
+            timeout=300,
+            limits=httpx.Limits(max_connections=32)
+        ) as client:
+            return list(await asyncio.gather(*(self.run_voice_case(client, case) for case in cases)))
+    
+    def run_cases(self, cases: list) -> list:
+        """并发执行一组用例，返回与用例顺序一致的测试记录"""
+        # 文本聊天在线程池中执行，语音测试同时在事件循环中并发上传；
+        # 结果文件按完成顺序写入，返回的记录按用例顺序排列
+        is_voice = [asyncio.iscoroutinefunction(getattr(self, case[2])) for case in cases]
+        sync_cases = [case for case, voice in zip(cases, is_voice) if not voice]
+        voice_cases = [case for case, voice in zip(cases, is_voice) if voice]
+        
+        sync_records = [None] * len(sync_cases)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.run_case, case): i for i, case in enumerate(sync_cases)}
+            voice_records = iter(asyncio.run(self.run_voice_tests(voice_cases)))
+            for future in as_completed(futures):
+                sync_records[futures[future]] = future.result()
+        
+        sync_records = iter(sync_records)
+        return [next(voice_records) if voice else next(sync_records) for voice in is_voice]
+    
+    def run_sharded(self, cases: list, processes: int) -> list:
+        """将用例按序号交错分片，由多个进程各自执行，合并结果文件并返回按用例顺序排列的测试记录"""
+        shards = [cases[i::processes] for i in range(processes)]
+        with Pool(processes) as pool:
+            shard_outputs = pool.starmap(_run_shard, [(self.base_url, self.max_workers, shard) for shard in shards])
+        
+        records = [None] * len(cases)
+        for i, (shard_records, shard_file) in enumerate(shard_outputs):
+            records[i::processes] = shard_records
+            
+            # 各分片的结果文件并入本次测试的结果文件
+            shard_path = Path(shard_file)
+            with self._results_lock:
+                self._results_stream.write(shard_path.read_bytes())
+                for record in shard_records:
+                    self._count_result(record["result"])
+            shard_path.unlink()
+        return records
+    
+    def run_comprehensive_test(self, audio_dir: str = "test_audio", processes: int = 1):
+        """运行综合测试（processes大于1时用例分片到多个进程执行）"""
         print("=" * 60)
         print("开始综合API测试")
         print(f"📁 响应音频目录: {self.response_audio_dir}")
@@ -242,50 +452,40 @@ class APIAudioTester:
         if not self.test_health():
             print("❌ 健康检查失败，终止测试")
             return
+        if not self.test_health_cache():
+            print("❌ 健康检查缓存测试失败，终止测试")
+            return
         
-        # 文本聊天测试
-        print("\n2️⃣ 文本聊天测试:")
+        # 收集全部测试用例：(测试类型, 报告字段, 测试方法名, 参数)，只含可跨进程传递的数据
         text_cases = [
             ("13800138000", "你好，我想了解一下产品"),
             ("13800138001", "今天的天气怎么样？"),
             ("13800138002", "请帮我转接人工客服")
         ]
+        cases = [
+            ("text_chat", {"phone": phone, "text": text}, "test_text_chat", (phone, text))
+            for phone, text in text_cases
+        ]
         
-        for phone, text in text_cases:
-            result = self.test_text_chat(phone, text)
-            self.test_results.append({
-                "type": "text_chat",
-                "phone": phone,
-                "text": text,
-                "result": result
-            })
-            time.sleep(1)  # 避免请求过快
-        
-        # 测试音频文件
         audio_dir_path = Path(audio_dir)
         if audio_dir_path.exists():
             audio_files = list(audio_dir_path.glob("*.wav"))[:5]
-            
-            if audio_files:
-                print(f"\n3️⃣ 语音识别测试 ({len(audio_files)} 个音频):")
-                for audio_file in audio_files:
-                    result = self.test_voice_recognize(str(audio_file))
-                    self.test_results.append({
-                        "type": "voice_recognize",
-                        "file": audio_file.name,
-                        "result": result
-                    })
-                    time.sleep(2)  # 避免请求过快
-                
-                print(f"\n4️⃣ 语音聊天测试 ({len(audio_files)} 个音频):")
-                for audio_file in audio_files:
-                    result = self.test_voice_chat("13800138000", str(audio_file))
-                    self.test_results.append({
-                        "type": "voice_chat",
-                        "file": audio_file.name,
-                        "result": result
-                    })
-                    time.sleep(3)  # 避免请求过快
+            cases += [
+                ("voice_recognize", {"file": audio_file.name}, "test_voice_recognize", (str(audio_file),))
+                for audio_file in audio_files
+            ]
+            cases += [
+                ("voice_chat", {"file": audio_file.name}, "test_voice_chat", ("13800138000", str(audio_file)))
+                for audio_file in audio_files
+            ]
+        
+        processes = min(processes, len(cases))
+        if processes > 1:
+            print(f"\n2️⃣ 分 {processes} 个进程执行 {len(cases)} 个测试用例 (每进程并发数: {self.max_workers}):")
+            self.test_results.extend(self.run_sharded(cases, processes))
+        else:
+            print(f"\n2️⃣ 并发执行 {len(cases)} 个测试用例 (并发数: {self.max_workers}):")
+            self.test_results.extend(self.run_cases(cases))
         
         # 生成测试报告并保存到test_report目录
         self.generate_test_report()
@@ -297,21 +497,26 @@ class APIAudioTester:
         print("=" * 60)
         
         total_tests = len(self.test_results)
-        successful_tests = sum(1 for r in self.test_results if r.get("result", {}).get("success"))
+        successful_tests = self._success_count
         
         print(f"总测试数: {total_tests}")
         print(f"成功数: {successful_tests}")
         print(f"成功率: {successful_tests/total_tests*100:.1f}%" if total_tests > 0 else "0.0%")
         
-        # 统计意图分布
-        intent_stats = {}
-        for test in self.test_results:
-            result = test.get("result", {})
-            if result.get("success"):
-                data = result.get("data", {})
-                intent = data.get("intent")
-                if intent:
-                    intent_stats[intent] = intent_stats.get(intent, 0) + 1
+        # 成功用例的响应时间分位数
+        response_times = np.fromiter(
+            ((test["result"].get("response_time") or 0.0)
+             for test in self.test_results if (test.get("result") or {}).get("success")),
+            dtype=np.float32
+        )
+        latency_stats = {}
+        if response_times.size:
+            p50, p95, p99 = np.percentile(response_times, [50, 95, 99])
+            latency_stats = {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+            print(f"响应时间: P50 {p50:.0f}ms, P95 {p95:.0f}ms, P99 {p99:.0f}ms")
+        
+        # 意图分布
+        intent_stats = dict(self._intent_counts)
         
         if intent_stats:
             print(f"\n🎯 意图分布:")
@@ -321,7 +526,7 @@ class APIAudioTester:
         # 详细结果
         print("\n详细结果:")
         for i, test in enumerate(self.test_results, 1):
-            result = test.get("result", {})
+            result = test.get("result") or {}
             success = result.get("success", False)
             status = "✅" if success else "❌"
             
@@ -358,26 +563,58 @@ class APIAudioTester:
         timestamp = int(time.time())
         report_file = self.test_report_dir / f"test_report_{timestamp}.json"
         
-        with open(report_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                "timestamp": timestamp,
-                "total_tests": total_tests,
-                "successful_tests": successful_tests,
-                "success_rate": successful_tests/total_tests*100 if total_tests > 0 else 0,
-                "intent_stats": intent_stats,
-                "results": self.test_results
-            }, f, ensure_ascii=False, indent=2)
-        
-        print(f"\n📊 详细报告已保存到: {report_file}")
-        
-        # 显示response_audio目录中的音频文件
-        audio_files = list(self.response_audio_dir.glob("*.wav"))
-        if audio_files:
-            print(f"\n🎵 响应音频文件 ({len(audio_files)} 个):")
-            for audio_file in audio_files[-5:]:  # 显示最近5个
-                print(f"   - {audio_file.name}")
-            if len(audio_files) > 5:
-                print(f"   ... 还有 {len(audio_files) - 5} 个文件")
+        # 逐条结果已在测试过程中写入结果文件，报告只保存汇总
+        with self._results_lock:
+            self._results_stream.flush()
+        
+        report_file.write_bytes(orjson.dumps({
+            "timestamp": timestamp,
+            "total_tests": total_tests,
+            "successful_tests": successful_tests,
+            "success_rate": successful_tests/total_tests*100 if total_tests > 0 else 0,
+            "intent_stats": intent_stats,
+            "latency_ms": latency_stats,
+            "results_file": self.results_file.name
+        }, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        
+        print(f"\n📊 测试报告已保存到: {report_file}")
+        print(f"📄 详细结果已保存到: {self.results_file}")
+        
+        # 显示response_audio目录中最近的音频文件
+        audio_count, recent_audio = self.scan_response_audio()
+        if audio_count:
+            print(f"\n🎵 响应音频文件 ({audio_count} 个):")
+            for name in recent_audio:
+                print(f"   - {name}")
+            if audio_count > len(recent_audio):
+                print(f"   ... 还有 {audio_count - len(recent_audio)} 个文件")
+    
+    def scan_response_audio(self, limit: int = 5) -> tuple:
+        """扫描一遍response_audio目录：删除过期音频，返回(剩余文件数, 最近limit个文件名)"""
+        cutoff = time.time() - RESPONSE_AUDIO_RETENTION_DAYS * 86400
+        audio_count = 0
+        recent = []
+        with os.scandir(self.response_audio_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.wav') or not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime
+                if mtime < cutoff:
+                    os.unlink(entry.path)
+                    continue
+                audio_count += 1
+                # 只保留最近的limit个文件，不为每个文件创建Path对象
+                item = (mtime, entry.name)
+                if len(recent) < limit:
+                    heapq.heappush(recent, item)
+                else:
+                    heapq.heappushpop(recent, item)
+        return audio_count, [name for _, name in sorted(recent, reverse=True)]
+
+def _run_shard(base_url: str, max_workers: int, cases: list) -> tuple:
+    """子进程入口：用独立的测试器执行一个分片，返回(测试记录, 分片结果文件)"""
+    with APIAudioTester(base_url, max_workers) as tester:
+        return tester.run_cases(cases), str(tester.results_file)
 
 def main():
     """主函数"""
@@ -393,9 +630,13 @@ def main():
     if not audio_dir:
         audio_dir = "test_audio_local"
     
+    default_processes = max(1, (os.cpu_count() or 1) - 2)
+    processes = input(f"输入并行进程数 (默认: {default_processes}): ").strip()
+    processes = int(processes) if processes else default_processes
+    
     # 创建测试器并运行
-    tester = APIAudioTester(base_url)
-    tester.run_comprehensive_test(audio_dir)
+    with APIAudioTester(base_url) as tester:
+        tester.run_comprehensive_test(audio_dir, processes)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""
+HTTPVoiceHandler.handle_request_stream 的输出格式测试
+
+在本地启动模拟的令牌、ASR、LLM、TTS接口，不需要阿里云密钥：
+    python test/test_voice_stream.py
+或
+    python -m pytest test/test_voice_stream.py
+"""
+
+import asyncio
+import struct
+import sys
+import time
+from pathlib import Path
+
+import orjson
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import unified_processor as up
+
+# 每次TTS请求返回的音频块数和块大小
+TTS_CHUNKS = 3
+TTS_CHUNK_SIZE = 20000
+
+class MockVoiceServer:
+    """模拟阿里云语音接口；complete为False时LLM流不带finish_reason=stop即结束（回复被截断）"""
+    
+    def __init__(self):
+        self.complete = True
+        self.tts_texts = []
+        self._runner = None
+        self.base_url = None
+    
+    async def _token(self, request):
+        return web.json_response({"Token": {"Id": "test-token", "ExpireTime": int(time.time()) + 3600}})
+    
+    async def _asr(self, request):
+        await request.read()
+        return web.json_response({"status": 20000000, "result": "你好"})
+    
+    async def _llm(self, request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        parts = ["你好，", "我是小云。"]
+        for i, text in enumerate(parts):
+            finish_reason = "stop" if self.complete and i == len(parts) - 1 else "null"
+            output = {"output": {"text": text, "finish_reason": finish_reason}}
+            await response.write(b"data:" + orjson.dumps(output) + b"\n\n")
+        return response
+    
+    async def _tts(self, request):
+        payload = await request.json()
+        self.tts_texts.append(payload["text"])
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(TTS_CHUNKS):
+            await response.write(b"\x01" * TTS_CHUNK_SIZE)
+        return response
+    
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/", self._token)
+        app.router.add_post("/asr", self._asr)
+        app.router.add_post("/llm", self._llm)
+        app.router.add_post("/tts", self._tts)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+    
+    async def stop(self):
+        await self._runner.cleanup()
+
+def create_handler(server: MockVoiceServer) -> up.HTTPVoiceHandler:
+    """创建指向模拟接口的处理器"""
+    keys = {"access_key_id": "test", "access_key_secret": "test", "appkey": "test"}
+    api = up.UnifiedProcessorAPI({"asr": keys, "llm": {"api_key": "test", "timeout": 5}, "tts": dict(keys, cache_bytes=0)})
+    success, message = api.initialize()
+    assert success, message
+    
+    processor = api.processor
+    for token_cache in processor._token_caches.values():
+        token_cache.TOKEN_URL = server.base_url + "/"
+    processor.asr.asr_url = server.base_url + "/asr"
+    processor.llm.api_url = server.base_url + "/llm"
+    processor.tts.tts_url = server.base_url + "/tts"
+    return up.HTTPVoiceHandler(api)
+
+def parse_stream(body: bytes) -> tuple:
+    """拆分为(首行JSON, 音频帧长度列表, 结束帧之后剩余的字节)；没有结束帧时帧长度列表为None"""
+    line, rest = body.split(b"\n", 1)
+    header = orjson.loads(line)
+    frames = []
+    while len(rest) >= 4:
+        (length,) = struct.unpack(">I", rest[:4])
+        rest = rest[4:]
+        if length == 0:
+            return header, frames, rest
+        frames.append(length)
+        rest = rest[length:]
+    return header, None, rest
+
+async def run_stream(complete: bool) -> tuple:
+    """以完整或被截断的LLM流执行一次请求，返回(响应字节, TTS请求的文本列表)"""
+    server = MockVoiceServer()
+    server.complete = complete
+    await server.start()
+    handler = create_handler(server)
+    try:
+        audio = up.create_test_audio(1)
+        body = b"".join([chunk async for chunk in handler.handle_request_stream({}, audio)])
+        return body, server.tts_texts
+    finally:
+        await handler.processor_api.processor.close()
+        await server.stop()
+
+def test_complete_stream_framing():
+    """完整回复：一行success=true的JSON，随后是长度前缀的音频帧，以长度为0的帧结束"""
+    body, tts_texts = asyncio.run(run_stream(complete=True))
+    header, frames, rest = parse_stream(body)
+    
+    assert header["success"] is True
+    assert header["text"] == "你好"
+    assert header["response"] == "你好，我是小云。"
+    assert frames is not None, "缺少长度为0的结束帧"
+    assert sum(frames) == TTS_CHUNKS * TTS_CHUNK_SIZE
+    assert all(frames)
+    assert rest == b""
+    assert tts_texts == ["你好，我是小云。"]
+
+def test_truncated_llm_stream():
+    """LLM流在finish_reason=stop之前结束：只输出一行success=false的JSON，不合成语音"""
+    body, tts_texts = asyncio.run(run_stream(complete=False))
+    
+    assert body.endswith(b"\n") and body.count(b"\n") == 1
+    header = orjson.loads(body)
+    assert header["success"] is False
+    assert "LLM处理失败" in header["error"]
+    assert tts_texts == []
+
+def test_missing_audio():
+    """没有音频数据：只输出一行success=false的JSON"""
+    async def run():
+        api = up.UnifiedProcessorAPI({})
+        return [chunk async for chunk in up.HTTPVoiceHandler(api).handle_request_stream({}, None)]
+    
+    chunks = asyncio.run(run())
+    assert len(chunks) == 1
+    assert orjson.loads(chunks[0]) == {"success": False, "error": "没有提供音频数据"}
+
+if __name__ == "__main__":
+    for test in (test_complete_stream_framing, test_truncated_llm_stream, test_missing_audio):
+        test()
+        print(f"✅ {test.__name__}")
@@ -2,23 +2,216 @@ import os
 import logging
 import re
 import datetime
+import hashlib
+import sqlite3
+import threading
+import time
+import orjson
+import reprlib
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Optional, Dict, Any
 from langchain.tools import Tool
-from config import TAVILY_API_KEY, MAX_SEARCH_RESULTS, ENABLE_WEB_SEARCH
-from langchain_tavily import TavilySearch
+from config import TAVILY_API_KEY, MAX_SEARCH_RESULTS, ENABLE_WEB_SEARCH, SEARCH_CACHE_PATH, SEARCH_CACHE_TTL
 
 logger = logging.getLogger(__name__)
 
+# 温度、天气状况、风力合并为一个正则，一次扫描文本；每个分支只含一个命名分组
+_WEATHER_INFO_PATTERN = re.compile(
+    r'(?P<temp>\d+)\s*[℃°C度]|(?:气温|温度)[：:]\s*(?P<temp_label>\d+)'
+    r'|(?P<weather>多云|小雨|中雨|大雨|晴|阴|雨|雪|雾)'
+    r'|(?P<wind>[东南西北]风\s*\d*级)|风力?[：:]\s*(?P<wind_label>[^，。\n]+)'
+)
+_WEATHER_INFO_FIELDS = {"temp_label": "temp", "wind_label": "wind"}
+
+# 判断搜索结果是否与天气相关的关键词，合并为一个正则一次扫描
+_WEATHER_KEYWORD_PATTERN = re.compile('|'.join(map(re.escape, ['天气', '气温', '温度', '度', '晴', '雨', '云', '风'])))
+
+# 搜索结果只展示开头部分，按长度上限逐层截断后再转为文本，不生成完整的repr
+_RESULT_REPR = reprlib.Repr()
+_RESULT_REPR.maxlevel = 4
+_RESULT_REPR.maxstring = 500
+_RESULT_REPR.maxother = 500
+_RESULT_REPR.maxlist = 5
+_RESULT_REPR.maxdict = 10
+
+# 从Tavily结果中每条正文最多取用的字符数
+_RESULT_CONTENT_LIMIT = 500
+
+def _format_result(result: Any) -> str:
+    """将搜索结果转为有长度上限的文本：优先取answer，其次拼接前几条结果的正文，只读取需要的部分"""
+    if isinstance(result, str):
+        return result
+    if isinstance(result, dict):
+        answer = result.get("answer")
+        if answer:
+            return str(answer)
+        items = result.get("results")
+        if isinstance(items, list):
+            return "\n".join(
+                str(item.get("content") or "")[:_RESULT_CONTENT_LIMIT]
+                for item in items[:MAX_SEARCH_RESULTS] if isinstance(item, dict)
+            )
+    return _RESULT_REPR.repr(result)
+
+# 查询结果中表示失败的提示语
+_FAILURE_PATTERN = re.compile('失败|暂不可用')
+
+def _is_usable(text: str) -> bool:
+    """结果非空且不是失败提示"""
+    return bool(text) and not _FAILURE_PATTERN.search(text)
+
+# 英文备用天气查询使用的常见城市英文名；其他中文地名的英文查询与中文查询结果相近，不再重复调用
+_LOCATION_ENGLISH_NAMES = {
+    '北京': 'Beijing', '上海': 'Shanghai', '广州': 'Guangzhou', '深圳': 'Shenzhen',
+    '天津': 'Tianjin', '重庆': 'Chongqing', '杭州': 'Hangzhou', '南京': 'Nanjing',
+    '武汉': 'Wuhan', '成都': 'Chengdu', '西安': "Xi'an", '苏州': 'Suzhou',
+    '长沙': 'Changsha', '郑州': 'Zhengzhou', '青岛': 'Qingdao', '沈阳': 'Shenyang',
+    '大连': 'Dalian', '厦门': 'Xiamen', '哈尔滨': 'Harbin', '昆明': 'Kunming',
+    '香港': 'Hong Kong', '澳门': 'Macau', '台北': 'Taipei'
+}
+
+# 新闻时效性强缓存时间短，价格变化慢缓存时间长（其他搜索使用SEARCH_CACHE_TTL）
+_NEWS_CACHE_TTL = 60
+_PRICE_CACHE_TTL = 3600
+
+@lru_cache(maxsize=2)
+def _minute_stamp(minute: int) -> tuple:
+    """格式化给定分钟的(日期, 时分)，同一分钟内只格式化一次"""
+    moment = datetime.datetime.fromtimestamp(minute * 60)
+    return moment.strftime("%Y-%m-%d"), moment.strftime("%H:%M")
+
+def _now_stamp() -> tuple:
+    """当前的(日期, 时分)字符串"""
+    return _minute_stamp(int(time.time()) // 60)
+
+_SEARCH_CACHE_SCHEMA = '''CREATE TABLE IF NOT EXISTS search_cache (
+    key TEXT PRIMARY KEY,
+    result BLOB NOT NULL,
+    expires_at REAL NOT NULL
+)'''
+
+class SearchCache:
+    """Tavily搜索结果的SQLite缓存：进程重启后仍然有效，键中带日期，实时信息不跨天复用"""
+    
+    # 进程内保留最近使用的结果，命中时不再查询SQLite和反序列化
+    MEMORY_SIZE = 512
+    
+    def __init__(self, path: str = SEARCH_CACHE_PATH, ttl: int = SEARCH_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._memory_lock = threading.Lock()
+    
+    def _remember(self, key: str, result: Any, expires_at: float):
+        with self._memory_lock:
+            self._memory[key] = (expires_at, result)
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.MEMORY_SIZE:
+                self._memory.popitem(last=False)
+    
+    def _conn(self) -> sqlite3.Connection:
+        """获取当前线程的缓存库连接（首次调用时建表）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(_SEARCH_CACHE_SCHEMA)
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _key(query: str) -> str:
+        today = _now_stamp()[0]
+        return hashlib.blake2b(f"{today}|{query}".encode('utf-8'), digest_size=16).hexdigest()
+    
+    def get(self, query: str) -> Any:
+        """读取未过期的缓存结果，未命中返回None"""
+        key = self._key(query)
+        now = time.time()
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+        
+        try:
+            row = self._conn().execute(
+                'SELECT result, expires_at FROM search_cache WHERE key = ? AND expires_at > ?',
+                (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            result = orjson.loads(row[0])
+            self._remember(key, result, row[1])
+            return result
+        except Exception as e:
+            logger.warning(f"读取搜索缓存失败: {e}")
+            return None
+    
+    def set(self, query: str, result: Any, ttl: Optional[int] = None):
+        """写入搜索结果（ttl为空时使用默认有效期），同时清理已过期的记录"""
+        key = self._key(query)
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        self._remember(key, result, expires_at)
+        try:
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO search_cache (key, result, expires_at) VALUES (?, ?, ?)',
+                (key, orjson.dumps(result), expires_at)
+            )
+            conn.execute('DELETE FROM search_cache WHERE expires_at <= ?', (now,))
+            conn.commit()
+        except Exception as e:
+            logger.warning(f"写入搜索缓存失败: {e}")
+
 class WebSearchTools:
     """网络搜索工具集"""
     
+    # 实例属性固定，使用__slots__省去实例的__dict__，搜索路径上的属性访问更快
+    __slots__ = (
+        'tools', '_tavily_search', '_tavily_initialized', '_tavily_lock',
+        '_cache', '_tool_index'
+    )
+    
     def __init__(self):
         self.tools = []
-        self.tavily_search = None
+        self._tavily_search = None
+        self._tavily_initialized = False
+        self._tavily_lock = threading.Lock()
+        self._cache = SearchCache() if SEARCH_CACHE_TTL > 0 else None
         self._initialize_tools()
+        
+        # 按工具名直接查找搜索函数
+        self._tool_index = {tool.name: tool.func for tool in self.tools}
+    
+    @property
+    def tavily_search(self):
+        """Tavily客户端（首次搜索时创建，各线程共用同一个实例）"""
+        if not self._tavily_initialized:
+            with self._tavily_lock:
+                if not self._tavily_initialized:
+                    self._tavily_search = self._create_tavily_search()
+                    self._tavily_initialized = True
+        return self._tavily_search
+    
+    def _create_tavily_search(self):
+        if not self.tools:
+            return None
+        try:
+            from langchain_tavily import TavilySearch
+            return TavilySearch(max_results=MAX_SEARCH_RESULTS)
+        except Exception as e:
+            logger.error(f"Tavily搜索初始化失败: {e}")
+            return None
     
     def _initialize_tools(self):
-        """初始化搜索工具"""
+        """初始化搜索工具（Tavily客户端延迟到首次搜索时创建）"""
         if not ENABLE_WEB_SEARCH:
             logger.info("Web搜索功能已禁用")
             return
@@ -28,9 +221,6 @@ class WebSearchTools:
             return
         
         try:
-            # 初始化Tavily
-            self.tavily_search = TavilySearch(max_results=MAX_SEARCH_RESULTS)
-            
             # 创建工具列表
             self.tools = [
                 Tool(
@@ -45,36 +235,49 @@ class WebSearchTools:
                 ),
                 Tool(
                     name="NewsSearch",
-                    func=self._simple_search,
+                    func=self._news_search,
                     description="新闻搜索"
                 ),
                 Tool(
                     name="PriceSearch",
-                    func=self._simple_search,
+                    func=self._price_search,
                     description="价格查询"
                 )
             ]
             
-            logger.info(f"Web搜索工具初始化成功，共 {len(self.tools)} 个工具")
+            logger.info("Web搜索工具初始化成功，共 %d 个工具", len(self.tools))
             
         except Exception as e:
             logger.error(f"Web搜索工具初始化失败: {e}")
-            self.tavily_search = None
+            self.tools = []
     
-    def _simple_search(self, query: str) -> str:
+    def _run_search(self, query: str, ttl: Optional[int] = None) -> Any:
+        """调用Tavily搜索，相同问题在缓存有效期内直接返回缓存结果"""
+        if self._cache is not None:
+            result = self._cache.get(query)
+            if result is not None:
+                logger.debug("搜索缓存命中: %s", query)
+                return result
+        
+        result = self.tavily_search.run(query)
+        if result and self._cache is not None:
+            self._cache.set(query, result, ttl)
+        return result
+    
+    def _simple_search(self, query: str, ttl: Optional[int] = None) -> str:
         """简单稳定的搜索"""
         try:
             if not self.tavily_search:
                 return "搜索功能暂不可用"
             
             # 直接运行搜索，不做复杂处理
-            result = self.tavily_search.run(query)
+            result = self._run_search(query, ttl)
             
             # 安全处理结果
             if result is None:
                 return f"未找到关于'{query}'的信息。"
             
-            result_str = str(result)
+            result_str = _format_result(result)
             
             # 限制长度
             if len(result_str) > 500:
@@ -86,25 +289,28 @@ class WebSearchTools:
             logger.error(f"搜索失败: {e}")
             return f"搜索失败: {str(e)}"
     
+    def _news_search(self, query: str) -> str:
+        """新闻搜索：限定最新新闻"""
+        return self._simple_search(f"最新新闻 {query}", ttl=_NEWS_CACHE_TTL)
+    
+    def _price_search(self, query: str) -> str:
+        """价格查询：限定价格信息"""
+        return self._simple_search(f"{query} 价格", ttl=_PRICE_CACHE_TTL)
+    
     def _robust_weather_search(self, location: str) -> str:
         """天气搜索"""
         try:
-            logger.info(f"开始天气搜索: {location}")
+            logger.info("开始天气搜索: %s", location)
             
             if not self.tavily_search:
                 return "天气搜索功能暂不可用"
             
-            # 方案1: 尝试专业查询
+            # 方案1: 专业查询，解析出天气字段或结果与天气相关即返回
             weather_info = self._try_professional_weather_query(location)
-            if weather_info and "失败" not in weather_info and "暂不可用" not in weather_info:
+            if _is_usable(weather_info):
                 return weather_info
             
-            # 方案2: 尝试简单查询
-            weather_info = self._try_simple_weather_query(location)
-            if weather_info and "失败" not in weather_info and "暂不可用" not in weather_info:
-                return weather_info
-            
-            # 方案3: 使用备用方案
+            # 方案2: 专业查询没有可用结果时才发出备用查询，正常情况下每次天气查询只调用一次Tavily
             return self._fallback_weather_info(location)
             
         except Exception as e:
@@ -114,133 +320,87 @@ class WebSearchTools:
     def _try_professional_weather_query(self, location: str) -> str:
         """尝试专业天气查询"""
         try:
-            today = datetime.datetime.now().strftime("%Y-%m-%d")
+            today = _now_stamp()[0]
             query = f"{today} {location} 天气 实时 气温 湿度 风力"
             
-            logger.debug(f"专业查询: {query}")
-            result = self.tavily_search.run(query)
+            logger.debug("专业查询: %s", query)
+            result = self._run_search(query)
             
             if not result:
                 return ""
             
             # 转换为字符串并安全处理
-            result_str = str(result) if result else ""
+            result_str = _format_result(result)
             
             # 提取天气信息
             weather_data = self._parse_weather_from_text(result_str, location)
             if weather_data:
                 return weather_data
             
-            # 如果无法解析，返回原始结果
-            if len(result_str) > 300:
-                return f" {location}天气信息：{result_str[:297]}..."
-            return f" {location}天气信息：{result_str}"
-            
-        except Exception as e:
-            logger.debug(f"专业查询失败: {e}")
-            return ""
-    
-    def _try_simple_weather_query(self, location: str) -> str:
-        """尝试简单天气查询"""
-        try:
-            query = f"{location} 今天天气"
-            
-            logger.debug(f"简单查询: {query}")
-            result = self.tavily_search.run(query)
-            
-            if not result:
-                return ""
-            
-            result_str = str(result) if result else ""
-            
-            # 检查是否包含天气关键词
-            weather_keywords = ['天气', '气温', '温度', '度', '晴', '雨', '云', '风']
-            if any(keyword in result_str for keyword in weather_keywords):
-                if len(result_str) > 200:
-                    return f" {location}天气：{result_str[:197]}..."
-                return f" {location}天气：{result_str}"
+            # 如果无法解析但结果与天气相关，返回原始结果
+            if _WEATHER_KEYWORD_PATTERN.search(result_str):
+                if len(result_str) > 300:
+                    return f" {location}天气信息：{result_str[:297]}..."
+                return f" {location}天气信息：{result_str}"
             
             return ""
             
         except Exception as e:
-            logger.debug(f"简单查询失败: {e}")
+            logger.debug("专业查询失败: %s", e)
             return ""
     
     def _parse_weather_from_text(self, text: str, location: str) -> str:
         """从文本中解析天气信息"""
-        if not text or not isinstance(text, str):
+        if not text:
             return ""
         
-        # 确保text是字符串
-        text_str = str(text)
-        
-        # 查找温度信息
-        temp_match = None
-        temp_patterns = [
-            r'(\d+)\s*[℃°C度]',
-            r'气温[：:]\s*(\d+)',
-            r'温度[：:]\s*(\d+)'
-        ]
-        
-        for pattern in temp_patterns:
-            match = re.search(pattern, text_str)
-            if match:
-                temp_match = match
+        # 一次扫描中取温度、天气状况、风力各自最先出现的值，三项齐全即停止
+        found = {}
+        for match in _WEATHER_INFO_PATTERN.finditer(text):
+            field = _WEATHER_INFO_FIELDS.get(match.lastgroup, match.lastgroup)
+            found.setdefault(field, match.group(match.lastgroup))
+            if len(found) == 3:
                 break
         
-        # 查找天气状况
-        weather_match = None
-        weather_keywords = ['晴', '多云', '阴', '雨', '小雨', '中雨', '大雨', '雪', '雾']
-        for keyword in weather_keywords:
-            if keyword in text_str:
-                weather_match = keyword
-                break
-        
-        # 查找风力
-        wind_match = None
-        wind_patterns = [
-            r'([东南西北]风\s*\d*级)',
-            r'风力[：:]\s*([^，。\n]+)',
-            r'风[：:]\s*([^，。\n]+)'
-        ]
-        
-        for pattern in wind_patterns:
-            match = re.search(pattern, text_str)
-            if match:
-                wind_match = match.group(1)
-                break
+        temp_value = found.get("temp")
+        weather_match = found.get("weather")
+        wind_match = found.get("wind")
         
         # 构建结果
-        if temp_match or weather_match or wind_match:
-            result = f" {location}当前天气：\n"
+        if temp_value or weather_match or wind_match:
+            lines = [f" {location}当前天气："]
             
-            if temp_match:
-                temp_value = temp_match.group(1)
-                result += f" 温度：{temp_value}°C\n"
+            if temp_value:
+                lines.append(f" 温度：{temp_value}°C")
             
             if weather_match:
-                result += f" 天气：{weather_match}\n"
+                lines.append(f" 天气：{weather_match}")
             
             if wind_match:
-                result += f" 风力：{wind_match}\n"
+                lines.append(f" 风力：{wind_match}")
             
             # 添加时间
-            current_time = datetime.datetime.now().strftime("%H:%M")
-            result += f" 更新时间：{current_time}"
+            current_time = _now_stamp()[1]
+            lines.append(f" 更新时间：{current_time}")
             
-            return result
+            return "\n".join(lines)
         
         return ""
     
     def _fallback_weather_info(self, location: str) -> str:
         """备用天气信息"""
         try:
+            # 英文查询只对英文地名或已知英文名的城市发出
+            english_name = location if location.isascii() else _LOCATION_ENGLISH_NAMES.get(location.strip())
+            if not english_name:
+                return f" 暂时无法获取{location}的详细天气信息。\n建议使用天气APP或查看中国天气网获取实时信息。"
+            
             # 尝试直接搜索
-            query = f"{location} weather"
-            result = self.tavily_search.run(query)
+            query = f"{english_name} weather"
+            result = self._run_search(query)
             
             if result:
-                result_str = str(result)
+                result_str = _format_result(result)
                 if len(result_str) > 100:
                     return f" {location}天气信息：{result_str[:100]}..."
                 return f" {location}天气信息：{result_str}"
@@ -258,12 +418,9 @@ class WebSearchTools:
     def search(self, query: str, tool_name: str = "WebSearch") -> str:
         """使用指定工具进行搜索"""
         try:
-            for tool in self.tools:
-                if tool.name == tool_name:
-                    return tool.func(query)
-            
             # 如果没有找到指定工具，使用通用搜索
-            return self._simple_search(query)
+            func = self._tool_index.get(tool_name, self._simple_search)
+            return func(query)
             
         except Exception as e:
             logger.error(f"工具搜索失败: {e}")
@@ -271,10 +428,13 @@ class WebSearchTools:
 
 # 单例实例
 web_tools = None
+_web_tools_lock = threading.Lock()
 
 def get_web_tools():
     """获取Web工具单例"""
     global web_tools
     if web_tools is None:
-        web_tools = WebSearchTools()
+        with _web_tools_lock:
+            if web_tools is None:
+                web_tools = WebSearchTools()
     return web_tools
\ No newline at end of file
@@ -1,5 +1,4 @@
 import http.client
-import json
 import asyncio
 import wave
 import io
@@ -8,129 +7,303 @@ import uuid
 import hmac
 import hashlib
 import base64
+import bisect
 import requests
 from urllib import parse
 import time
 from datetime import datetime, timezone
 import aiohttp
-import traceback
-import math
+import logging
+import orjson
+import numpy as np
 import struct
 import random
+import re
 import urllib.parse
-from typing import Optional, Tuple, AsyncGenerator
+from typing import Optional, Tuple, AsyncGenerator, AsyncIterable, Awaitable, Callable, Dict
 import concurrent.futures
+from collections import OrderedDict
 import subprocess
+import shutil
+from functools import lru_cache
 
-class AccessToken:
-    """访问令牌管理器，负责阿里云ASR服务的Token获取和刷新"""
+try:
+    import av
+except ImportError:  # 未安装PyAV时使用ffmpeg子进程转换音频
+    av = None
+
+logger = logging.getLogger(__name__)
+
+# 空闲连接保活：每隔_KEEPALIVE_INTERVAL秒检查一次，只对最近_KEEPALIVE_IDLE_LIMIT秒内用过的主机保活
+_KEEPALIVE_INTERVAL = 60
+_KEEPALIVE_IDLE_LIMIT = 600
+
+# 令牌剩余有效期不足该秒数时在后台刷新，期间继续使用当前令牌
+_TOKEN_REFRESH_AHEAD = 60
+
+def make_session_id(prefix: str) -> str:
+    """生成"前缀_8位十六进制"形式的会话ID，仅用于日志和请求关联，不需要uuid4的唯一性保证"""
+    return f"{prefix}_{random.getrandbits(32):08x}"
+
+# 流式HTTP响应中音频帧的长度前缀
+_FRAME_LENGTH = struct.Struct(">I")
+
+# TTS合成结果缓存的默认容量（字节）
+_TTS_CACHE_BYTES = 10 * 1024 * 1024
+
+# 上游请求的重试次数和退避基数（秒）
+_MAX_RETRIES = 3
+_RETRY_BACKOFF = 1.0
+
+# ASR/LLM/TTS单次请求的默认超时（秒），略高于正常耗时，慢请求尽早放弃重试
+_ASR_TIMEOUT = 10
+_LLM_TIMEOUT = 30
+_TTS_TIMEOUT = 10
+
+class _IncompleteStreamError(Exception):
+    """流式LLM请求失败或在生成结束前中断"""
+
+class _RetryableError(Exception):
+    """可以重试的请求失败（如5xx、429、令牌失效），异常信息即最终返回给调用方的错误描述"""
+
+async def _retry(attempt_factory: Callable[[int], Awaitable], timeout: float, retries: int = _MAX_RETRIES, base: float = _RETRY_BACKOFF):
+    """执行attempt_factory(第几次尝试)，每次尝试限时timeout秒；超时、连接错误或_RetryableError时按指数退避
+    加随机抖动重试（避免大量会话同时重试），最后一次仍失败时抛出该异常"""
+    for attempt in range(retries):
+        try:
+            return await asyncio.wait_for(attempt_factory(attempt), timeout)
+        except (asyncio.TimeoutError, aiohttp.ClientError, _RetryableError) as e:
+            if attempt == retries - 1:
+                raise
+            delay = base * (2 ** attempt) + random.random() * 0.2
+            logger.debug("请求失败 (尝试 %s/%s): %r，%.1f秒后重试", attempt + 1, retries, e, delay)
+            await asyncio.sleep(delay)
+
+# 标准WAV文件头中RIFF头和fmt子块的布局
+_WAV_FMT_HEADER = struct.Struct("<4sI4s4sIHHIIHH")
+
+def _wav_header(data_size: int) -> bytes:
+    """16kHz单声道16bit PCM的标准44字节WAV文件头"""
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, 16000, 32000, 2, 16,
+        b'data', data_size
+    )
+
+def _find_wav_data(audio_data: bytes) -> Optional[Tuple[tuple, int, int]]:
+    """遍历RIFF子块，返回(fmt字段, data块偏移, data块长度)；不是有效WAV时返回None"""
+    if len(audio_data) < 12 or audio_data[:4] != b'RIFF' or audio_data[8:12] != b'WAVE':
+        return None
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(audio_data):
+        chunk_id, size = struct.unpack_from('<4sI', audio_data, pos)
+        pos += 8
+        if chunk_id == b'fmt ' and size >= 16:
+            fmt = struct.unpack_from('<HHIIHH', audio_data, pos)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            return fmt, pos, min(size, len(audio_data) - pos)
+        pos += size + (size & 1)  # 子块按偶数字节对齐
+    return None
+
+def _concat_wav(parts) -> bytes:
+    """把多段WAV音频的data块拼接为一个WAV文件，采用第一段的格式，格式不同或无效的片段被丢弃"""
+    if len(parts) == 1:
+        return parts[0]
+    fmt = None
+    pcm = []
+    for part in parts:
+        found = _find_wav_data(part)
+        if found is None:
+            logger.warning("丢弃无效的WAV片段, 长度: %s字节", len(part))
+            continue
+        part_fmt, offset, size = found
+        if fmt is None:
+            fmt = part_fmt
+        elif part_fmt != fmt:
+            logger.warning("丢弃格式不一致的WAV片段: %s", part_fmt)
+            continue
+        pcm.append(memoryview(part)[offset:offset + size])
+    if fmt is None:
+        return b""
+    data_size = sum(len(chunk) for chunk in pcm)
+    header = struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, *fmt,
+        b'data', data_size
+    )
+    return b"".join([header, *pcm])
+
+# 流式回复按句切分后逐句送入TTS的句末标点，以及单次请求同时进行的TTS合成数
+_SENTENCE_END = re.compile(r'[。！？!?；;\n]')
+_TTS_PIPELINE_CONCURRENCY = 3
+
+# LLM返回的错误信息：generate_response的错误前缀，或回复开头100字符内出现的失败/错误字样
+_LLM_ERROR_PATTERN = re.compile(r'^LLM请求(?:失败|异常|超时)|失败|错误')
+
+# ASR请求中固定不变的查询参数
+_ASR_STATIC_QUERY = "&".join(f"{k}={v}" for k, v in {
+    "format": "pcm",
+    "sample_rate": 16000,
+    "channels": 1,
+    "bits": 16,
+    "enable_punctuation_prediction": "true",
+    "enable_inverse_text_normalization": "true"
+}.items())
+
+# ASR音频上传的分块大小
+_UPLOAD_CHUNK_SIZE = 32 * 1024
+
+async def _iter_chunks(data: bytes, chunk_size: int = _UPLOAD_CHUNK_SIZE):
+    """按块产出数据的memoryview切片（不复制），作为分块上传的请求体"""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+def _encode_static_params(params: dict) -> list:
+    """CreateToken中不随请求变化的参数预先URL编码并排序，刷新时只需插入随机数和时间戳"""
+    return sorted((parse.quote(k, safe=''), parse.quote(v, safe='')) for k, v in params.items())
+
+def _sign_create_token(static_encoded: list, sign_key: bytes, nonce: str, timestamp: str) -> str:
+    """生成CreateToken请求的HMAC-SHA1签名"""
+    encoded = list(static_encoded)
+    bisect.insort(encoded, ("SignatureNonce", parse.quote(nonce, safe='')))
+    bisect.insort(encoded, ("Timestamp", parse.quote(timestamp, safe='')))
+    canonicalized_query_string = "&".join(f"{k}={v}" for k, v in encoded)
+    
+    string_to_sign = "GET&%2F&" + parse.quote(canonicalized_query_string, safe="~")
+    h = hmac.new(sign_key, string_to_sign.encode('utf-8'), hashlib.sha1)
+    return base64.b64encode(h.digest()).decode('utf-8')
+
+class TokenCache:
+    """阿里云智能语音访问令牌缓存：同一组AccessKey的ASR和TTS共用一个实例，临近过期时在后台单次刷新"""
     
-    def __init__(self, access_key_id: str, access_key_secret: str):
+    TOKEN_URL = "https://nls-meta.cn-shanghai.aliyuncs.com/"
+    
+    def __init__(self, access_key_id: str, access_key_secret: str, get_session: Callable[[str], Awaitable[aiohttp.ClientSession]],
+                 product: str = "nls-cloud-meta", region_id: str = "cn-shanghai", skew: int = 60):
         self.access_key_id = access_key_id
-        self.access_key_secret = access_key_secret
+        self._get_session = get_session
+        self._skew = skew  # 令牌按比实际过期时间提前skew秒视为过期
         self.token = None
         self.expire_time = 0
-        self._lock = asyncio.Lock()  # 防止并发刷新token
-        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._refresh_task: Optional[asyncio.Task] = None  # 进行中的刷新，并发调用方共用
+        
+        # 签名中的固定参数和密钥只编码一次
+        self._static_params = {
+            "AccessKeyId": access_key_id,
+            "Action": "CreateToken",
+            "Product": product,
+            "RegionId": region_id,
+            "Format": "JSON",
+            "SignatureMethod": "HMAC-SHA1",
+            "SignatureVersion": "1.0",
+            "Version": "2019-02-28"
+        }
+        self._static_encoded = _encode_static_params(self._static_params)
+        self._sign_key = f"{access_key_secret}&".encode('utf-8')
     
-    async def get_token(self) -> Optional[str]:
-        """异步获取访问令牌 - 修复：增加重试+延长超时"""
-        current_time = time.time()
+    async def get(self) -> Optional[str]:
+        """获取访问令牌：临近过期时先返回当前令牌并在后台刷新，只有令牌已过期才等待刷新结果"""
+        remaining = self.expire_time - time.time()
+        if self.token and remaining > _TOKEN_REFRESH_AHEAD:
+            return self.token
         
-        # 检查令牌是否有效（提前60秒刷新）
-        if self.token and current_time < self.expire_time - 60:
+        if self.token and remaining > 0:
+            self._start_refresh()
             return self.token
         
-        # 使用锁防止并发刷新
-        async with self._lock:
-            # 再次检查，防止其他协程已经刷新了token
-            if self.token and current_time < self.expire_time - 60:
-                return self.token
-            
-            # 生成请求参数
-            nonce = str(uuid.uuid4())
-            timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-            
-            params = {
-                "AccessKeyId": self.access_key_id,
-                "Action": "CreateToken",
-                "Format": "JSON",
-                "SignatureMethod": "HMAC-SHA1",
-                "SignatureNonce": nonce,
-                "SignatureVersion": "1.0",
-                "Timestamp": timestamp,
-                "Version": "2019-02-28"
-            }
-            
-            # 生成签名
-            signature = self._generate_signature(params)
-            params["Signature"] = signature
-            
-            # 请求URL
-            url = "https://nls-meta.cn-shanghai.aliyuncs.com/"
+        # 并发调用方等待同一个刷新任务，shield避免某个调用方被取消时中断共享的刷新
+        return await asyncio.shield(self._start_refresh())
+    
+    def invalidate(self, token: str):
+        """服务端拒绝令牌时作废；令牌已被其他调用方刷新过则保留新令牌"""
+        if self.token == token:
+            self.token = None
+            self.expire_time = 0
+    
+    def _start_refresh(self) -> asyncio.Task:
+        """启动刷新任务，已有刷新在进行时直接复用"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._do_refresh())
+        return self._refresh_task
+    
+    async def _do_refresh(self) -> Optional[str]:
+        """请求新的访问令牌，失败时重试"""
+        # 生成请求参数
+        nonce = str(uuid.uuid4())
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        
+        params = self._static_params.copy()
+        params["SignatureNonce"] = nonce
+        params["Timestamp"] = timestamp
+        
+        # 生成签名
+        params["Signature"] = self._generate_signature(nonce, timestamp)
+        
+        url = self.TOKEN_URL
+        
+        async def attempt(i: int) -> str:
+            logger.debug("获取语音服务Token (尝试 %s/%s): URL=%s", i + 1, _MAX_RETRIES, url)
+            session = await self._get_session(url)
+            async with session.get(url, params=params) as response:
+                logger.debug("语音服务Token响应状态: %s", response.status)
+                if response.status != 200:
+                    response_text = await response.text()
+                    raise _RetryableError(f"HTTP {response.status} - {response_text[:200]}")
+                result = await response.json(loads=orjson.loads)
             
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    print(f"[DEBUG] 获取ASR Token (尝试 {attempt+1}/{max_retries}): URL={url}")
-                    
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(url, params=params, timeout=30) as response:
-                            print(f"[DEBUG] ASR Token响应状态: {response.status}")
-                            
-                            if response.status == 200:
-                                result = await response.json()
-                                print(f"[DEBUG] ASR Token原始响应体: {result}")
-                                self.token = result["Token"]["Id"]
-                                token_expire = result["Token"].get("ExpireTime", 1800)
-                                self.expire_time = time.time() + token_expire - 60
-                                print(f"[DEBUG] 获取ASR Token成功")
-                                return self.token
-                            else:
-                                response_text = await response.text()
-                                print(f"[ERROR] 获取ASR Token失败: HTTP {response.status} - {response_text}")
-                except asyncio.TimeoutError:
-                    print(f"[ERROR] 获取ASR Token超时 (尝试 {attempt+1}/{max_retries})")
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(2 ** attempt)
-                except Exception as e:
-                    print(f"[ERROR] 获取ASR Token异常: {str(e)}")
-                    traceback.print_exc()
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(2 ** attempt)
+            now = time.time()
+            # ExpireTime为过期时刻的Unix时间戳，缺失时按30分钟有效期计算
+            expire_at = result["Token"].get("ExpireTime", 0)
+            if expire_at <= now:
+                expire_at = now + 1800
+            self.token = result["Token"]["Id"]
+            self.expire_time = expire_at - self._skew
+            logger.debug("获取语音服务Token成功")
+            return self.token
         
+        try:
+            return await _retry(attempt, timeout=30)
+        except asyncio.TimeoutError:
+            logger.error("获取语音服务Token超时")
+        except _RetryableError as e:
+            logger.error("获取语音服务Token失败: %s", e)
+        except Exception as e:
+            logger.exception("获取语音服务Token异常: %s", e)
         return None
     
-    def _generate_signature(self, params: dict) -> str:
+    def _generate_signature(self, nonce: str, timestamp: str) -> str:
         """生成阿里云API签名"""
-        sorted_params = sorted(params.items())
-        canonicalized_query_string = "&".join(
-            [f"{urllib.parse.quote(k, safe='')}={urllib.parse.quote(v, safe='')}" 
-             for k, v in sorted_params]
-        )
-        
-        string_to_sign = "GET&%2F&" + urllib.parse.quote(canonicalized_query_string, safe="~")
-        
-        sign_key = f"{self.access_key_secret}&".encode('utf-8')
-        h = hmac.new(sign_key, string_to_sign.encode('utf-8'), hashlib.sha1)
-        signature = base64.b64encode(h.digest()).decode('utf-8')
-        
-        return signature
+        return _sign_create_token(self._static_encoded, self._sign_key, nonce, timestamp)
 
 
 class ASRProvider:
     """阿里云ASR服务提供者"""
     
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, get_session: Callable[[str], Awaitable[aiohttp.ClientSession]], token_cache: TokenCache):
         self.config = config
+        self._get_session = get_session
+        self.token_cache = token_cache
         self.access_key_id = config.get('access_key_id')
         self.access_key_secret = config.get('access_key_secret')
         self.appkey = config.get('appkey')
-        self.token_url = "https://nls-meta.cn-shanghai.aliyuncs.com"
         self.asr_url = "https://nls-gateway.cn-shanghai.aliyuncs.com/stream/v1/asr"
+        # 单次请求的超时（秒），超时后按指数退避重试
+        self.timeout = config.get('timeout', _ASR_TIMEOUT)
         
-        self.token_manager = AccessToken(self.access_key_id, self.access_key_secret)
-        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._asr_url_cache: Tuple[Optional[str], str] = (None, "")
+        # 限制同时进行的音频转换数，并让每个ffmpeg的线程数乘以转换数约等于CPU核数，突发请求时不会抢占过多核
+        cpu_count = os.cpu_count() or 4
+        workers = config.get('ffmpeg_workers') or max(2, cpu_count // 2)
+        self._ffmpeg_threads = config.get('ffmpeg_threads_per') or max(1, cpu_count // workers)
+        self._convert_slots = asyncio.Semaphore(workers)
+        # PyAV解码/重采样时释放GIL，线程池即可并行转换
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
         self._validate_config()
     
     def _validate_config(self):
@@ -140,67 +313,92 @@ class ASRProvider:
             raise ValueError(f"ASR配置缺少必要的参数: {', '.join(missing_keys)}")
     
     async def _convert_audio(self, audio_data: bytes) -> bytes:
+        """转换为16kHz单声道16bit WAV：优先在线程池中用PyAV解码重采样，未安装PyAV时通过管道调用ffmpeg"""
         try:
-            loop = asyncio.get_event_loop()
-            converted_audio = await loop.run_in_executor(
-                self._executor,
-                self._convert_audio_sync,
-                audio_data
-            )
-            return converted_audio
+            async with self._convert_slots:
+                if av is None:
+                    return await self._convert_audio_ffmpeg(audio_data)
+                
+                loop = asyncio.get_running_loop()
+                converted_audio = await loop.run_in_executor(
+                    self._executor,
+                    self._convert_audio_sync,
+                    audio_data
+                )
+                return converted_audio
         except Exception as e:
-            print(f"[WARNING] 音频转换失败，返回原始数据: {str(e)}")
+            logger.warning("音频转换失败，返回原始数据: %s", e)
             return audio_data
     
     def _convert_audio_sync(self, audio_data: bytes) -> bytes:
         try:
-            import tempfile
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as input_file:
-                input_path = input_file.name
-                input_file.write(audio_data)
-            
-            output_path = f"{input_path}_converted.wav"
-            try:
-                cmd = [
-                    'ffmpeg', '-y',
-                    '-i', input_path,
-                    '-ar', '16000',
-                    '-ac', '1',
-                    '-acodec', 'pcm_s16le',
-                    '-f', 'wav',
-                    output_path
-                ]
-                
-                result = subprocess.run(
-                    cmd, 
-                    capture_output=True, 
-                    text=True,
-                    timeout=10
-                )
-                
-                if result.returncode != 0:
-                    print(f"[WARNING] ffmpeg转换失败: {result.stderr}")
-                    return self._simple_audio_conversion(audio_data)
-                
-                with open(output_path, 'rb') as f:
-                    converted_data = f.read()
-                
-                return converted_data
-            finally:
-                try:
-                    os.unlink(input_path)
-                    if os.path.exists(output_path):
-                        os.unlink(output_path)
-                except:
-                    pass
-        except subprocess.TimeoutExpired:
-            print("[WARNING] 音频转换超时，返回原始数据")
-            return audio_data
+            return self._convert_audio_pyav(audio_data)
         except Exception as e:
-            print(f"[WARNING] 音频转换异常: {str(e)}")
+            logger.warning("PyAV音频转换失败: %s", e)
             return self._simple_audio_conversion(audio_data)
     
+    def _convert_audio_pyav(self, audio_data: bytes) -> bytes:
+        resampler = av.AudioResampler(format='s16', layout='mono', rate=16000)
+        pcm = bytearray()
+        with av.open(io.BytesIO(audio_data)) as container:
+            for frame in container.decode(audio=0):
+                for resampled in resampler.resample(frame):
+                    pcm += resampled.to_ndarray().tobytes()
+        # 取出重采样器中缓存的尾部样本
+        for resampled in resampler.resample(None):
+            pcm += resampled.to_ndarray().tobytes()
+        return self._pcm_to_wav(pcm)
+    
+    async def _convert_audio_ffmpeg(self, audio_data: bytes) -> bytes:
+        """音频经stdin传给ffmpeg，从stdout读回原始PCM，不落临时文件"""
+        cmd = [
+            'ffmpeg', '-v', 'error',
+            '-threads', str(self._ffmpeg_threads),
+            '-i', 'pipe:0',
+            '-ar', '16000',
+            '-ac', '1',
+            '-f', 's16le',
+            'pipe:1'
+        ]
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            logger.warning("无法启动ffmpeg: %s", e)
+            return self._simple_audio_conversion(audio_data)
+        
+        try:
+            pcm, stderr = await asyncio.wait_for(proc.communicate(audio_data), timeout=10)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            logger.warning("音频转换超时，返回原始数据")
+            return audio_data
+        
+        if proc.returncode != 0:
+            logger.warning("ffmpeg转换失败: %s", stderr.decode('utf-8', 'replace'))
+            return self._simple_audio_conversion(audio_data)
+        return self._pcm_to_wav(pcm)
+    
+    @staticmethod
+    def _pcm_to_wav(pcm: bytes) -> bytes:
+        """16kHz单声道16bit PCM加上WAV文件头"""
+        return _wav_header(len(pcm)) + pcm
+    
     def _simple_audio_conversion(self, audio_data: bytes) -> bytes:
+        # 采样格式已符合要求、只是文件头不标准（如带LIST等附加子块）时，只重写文件头，不逐帧读出再写回
+        parsed = _find_wav_data(audio_data)
+        if parsed is not None:
+            (audio_format, nchannels, framerate, _, _, bits), offset, size = parsed
+            if audio_format == 1 and nchannels == 1 and framerate == 16000 and bits == 16:
+                if offset == 44 and size == len(audio_data) - 44:
+                    return audio_data
+                return _wav_header(size) + memoryview(audio_data)[offset:offset + size]
+        
         try:
             with io.BytesIO(audio_data) as bio:
                 with wave.open(bio, 'rb') as wav:
@@ -221,126 +419,174 @@ class ASRProvider:
                     
                     return output.getvalue()
         except:
-            print("[WARNING] 无法解析音频格式，返回原始数据")
+            logger.warning("无法解析音频格式，返回原始数据")
             return audio_data
     
+    def _validate_audio_format_fast(self, audio_data: bytes) -> Optional[bool]:
+        """直接解析标准44字节WAV头中的fmt子块；文件头不是标准布局时返回None"""
+        if len(audio_data) < _WAV_FMT_HEADER.size:
+            return None
+        riff, _, wave_id, fmt_id, _, audio_format, nchannels, framerate, _, _, bits = _WAV_FMT_HEADER.unpack_from(audio_data, 0)
+        if riff != b'RIFF' or wave_id != b'WAVE' or fmt_id != b'fmt ':
+            return None
+        
+        valid = audio_format == 1 and nchannels == 1 and framerate == 16000 and bits == 16
+        if not valid:
+            logger.debug("音频格式不匹配: 编码%s, %sHz, %s通道, %s位 (需要PCM 16000Hz单声道16位)", audio_format, framerate, nchannels, bits)
+        return valid
+    
     def _validate_audio_format(self, audio_data: bytes) -> bool:
+        valid = self._validate_audio_format_fast(audio_data)
+        if valid is not None:
+            return valid
+        
         try:
             with io.BytesIO(audio_data) as bio:
                 with wave.open(bio, 'rb') as wav:
                     params = wav.getparams()
                     if params.framerate != 16000:
-                        print(f"[DEBUG] 音频采样率不匹配: {params.framerate}Hz (需要16000Hz)")
+                        logger.debug("音频采样率不匹配: %sHz (需要16000Hz)", params.framerate)
                         return False
                     if params.nchannels != 1:
-                        print(f"[DEBUG] 音频通道数不匹配: {params.nchannels} (需要1)")
+                        logger.debug("音频通道数不匹配: %s (需要1)", params.nchannels)
                         return False
                     if params.sampwidth != 2:
-                        print(f"[DEBUG] 音频位深不匹配: {params.sampwidth}字节 (需要2字节)")
+                        logger.debug("音频位深不匹配: %s字节 (需要2字节)", params.sampwidth)
                         return False
                     
-                    print(f"[DEBUG] 音频格式验证通过: {params.framerate}Hz, {params.nchannels}通道, {params.sampwidth}字节/样本")
+                    logger.debug("音频格式验证通过: %sHz, %s通道, %s字节/样本", params.framerate, params.nchannels, params.sampwidth)
                     return True
         except Exception as e:
-            print(f"[DEBUG] 无法验证音频格式: {str(e)}")
+            logger.debug("无法验证音频格式: %s", e)
             return False
     
+    def _build_asr_request(self, token: str, session_id: str) -> Tuple[str, dict]:
+        """构造ASR请求的URL和请求头，URL在令牌更换前复用"""
+        cached_token, url = self._asr_url_cache
+        if cached_token != token:
+            url = f"{self.asr_url}?appkey={self.appkey}&token={token}&{_ASR_STATIC_QUERY}"
+            self._asr_url_cache = (token, url)
+        
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-NLS-Token": token,
+            "X-NLS-Session-Id": session_id,
+            "User-Agent": "ASR-Client/1.0"
+        }
+        return url, headers
+    
     async def speech_to_text(self, audio_data: bytes, session_id: str) -> Tuple[Optional[str], Optional[str]]:
-        token = await self.token_manager.get_token()
+        token = await self.token_cache.get()
         if not token:
-            print("[ERROR] 无法获取有效的ASR Token")
+            logger.error("无法获取有效的ASR Token")
             return None, "获取ASR Token失败"
         
         prepared_audio = audio_data
         
         if not self._validate_audio_format(audio_data):
-            print("[DEBUG] 音频格式不符合要求，进行转换...")
+            logger.debug("音频格式不符合要求，进行转换...")
             prepared_audio = await self._convert_audio(audio_data)
         
-        params = {
-            "appkey": self.appkey,
-            "token": token,
-            "format": "pcm",
-            "sample_rate": 16000,
-            "channels": 1,
-            "bits": 16,
-            "enable_punctuation_prediction": "true",
-            "enable_inverse_text_normalization": "true"
-        }
+        url, headers = self._build_asr_request(token, session_id)
+        # 长度已知，带上Content-Length，服务端不必处理chunked编码
+        upload_headers = {**headers, "Content-Length": str(len(prepared_audio))}
         
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-        url = f"{self.asr_url}?{query_string}"
+        async def attempt(i: int) -> Tuple[Optional[str], Optional[str]]:
+            nonlocal token, url, upload_headers
+            logger.debug("发送ASR请求 (尝试 %s/%s): URL=%s, 音频长度=%s字节", i + 1, _MAX_RETRIES, url, len(prepared_audio))
+            
+            session = await self._get_session(url)
+            # 请求体按块写出，大音频上传时不一次性占用事件循环；每次重试都重新生成
+            body = _iter_chunks(prepared_audio)
+            async with session.post(url, data=body, headers=upload_headers) as response:
+                raw_response = await response.text()
+                if response.status != 200:
+                    error_msg = f"ASR请求失败: HTTP {response.status} - {raw_response}"
+                    logger.error(error_msg)
+                    if response.status == 408 or response.status >= 500:
+                        raise _RetryableError(error_msg)
+                    return None, error_msg
+                result = await response.json(loads=orjson.loads)
+            
+            if result.get("status") == 20000000:
+                if result.get("result"):
+                    recognized_text = result["result"]
+                    logger.debug("ASR识别成功: %s", recognized_text)
+                    return recognized_text, None
+                logger.warning("ASR识别返回空结果，完整响应: %s", result)
+                return "", "ASR返回空结果"
+            
+            error_msg = (
+                f"ASR识别失败: {result.get('message', '未知错误')} "
+                f"(状态码: {result.get('status')})"
+            )
+            logger.error(error_msg)
+            if result.get("status") == 40000004:
+                logger.debug("Token无效，尝试刷新...")
+                self.token_cache.invalidate(token)
+                token = await self.token_cache.get()
+                if token:
+                    url, headers = self._build_asr_request(token, session_id)
+                    upload_headers = {**headers, "Content-Length": str(len(prepared_audio))}
+                    raise _RetryableError(error_msg)
+            return None, error_msg
         
-        headers = {
-            "Content-Type": "application/octet-stream",
-            "X-NLS-Token": token,
-            "X-NLS-Session-Id": session_id,
-            "User-Agent": "ASR-Client/1.0"
-        }
+        try:
+            return await _retry(attempt, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("ASR请求超时")
+            return None, "ASR请求超时"
+        except _RetryableError as e:
+            return None, str(e)
+        except Exception as e:
+            error_msg = f"ASR请求异常: {str(e)}"
+            logger.exception(error_msg)
+            return None, error_msg
+
+    async def speech_to_text_stream(self, audio_chunks: AsyncIterable[bytes], session_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """流式识别：边接收音频边以chunked方式上传，音频需为16kHz单声道16bit PCM"""
+        token = await self.token_cache.get()
+        if not token:
+            logger.error("无法获取有效的ASR Token")
+            return None, "获取ASR Token失败"
         
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                print(f"[DEBUG] 发送ASR请求 (尝试 {attempt+1}/{max_retries}): URL={url}, 音频长度={len(prepared_audio)}字节")
-                
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=30)
-                    async with session.post(url, data=prepared_audio, headers=headers, timeout=timeout) as response:
-                        raw_response = await response.text()
-                        
-                        if response.status == 200:
-                            result = await response.json()
-                            if result.get("status") == 20000000:
-                                if result.get("result"):
-                                    recognized_text = result["result"]
-                                    print(f"[DEBUG] ASR识别成功: {recognized_text}")
-                                    return recognized_text, None
-                                else:
-                                    print(f"[WARNING] ASR识别返回空结果，完整响应: {result}")
-                                    return "", "ASR返回空结果"
-                            else:
-                                error_msg = (
-                                    f"ASR识别失败: {result.get('message', '未知错误')} "
-                                    f"(状态码: {result.get('status')})"
-                                )
-                                print(f"[ERROR] {error_msg}")
-                                if result.get("status") == 40000004:
-                                    print("[DEBUG] Token无效，尝试刷新...")
-                                    self.token_manager.token = None
-                                    token = await self.token_manager.get_token()
-                                    if token and attempt < max_retries - 1:
-                                        await asyncio.sleep(1)
-                                        continue
-                                return None, error_msg
-                        else:
-                            error_msg = f"ASR请求失败: HTTP {response.status} - {raw_response}"
-                            print(f"[ERROR] {error_msg}")
-                            if response.status == 408 or response.status >= 500:
-                                if attempt < max_retries - 1:
-                                    await asyncio.sleep(2 ** attempt)
-                                    continue
-                            return None, error_msg
-            except asyncio.TimeoutError:
-                error_msg = f"ASR请求超时 (尝试 {attempt+1}/{max_retries})"
-                print(f"[ERROR] {error_msg}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                return None, error_msg
-            except Exception as e:
-                error_msg = f"ASR请求异常: {str(e)}"
-                print(f"[ERROR] {error_msg}")
-                traceback.print_exc()
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                return None, error_msg
+        url, headers = self._build_asr_request(token, session_id)
         
-        return None, "ASR请求失败，达到最大重试次数"
+        # 请求体是一次性的流，无法重放，因此不做重试
+        try:
+            logger.debug("发送流式ASR请求: URL=%s", url)
+            session = await self._get_session(url)
+            timeout = aiohttp.ClientTimeout(total=30)
+            async with session.post(url, data=audio_chunks, headers=headers, timeout=timeout) as response:
+                raw_response = await response.text()
+                if response.status != 200:
+                    error_msg = f"ASR请求失败: HTTP {response.status} - {raw_response}"
+                    logger.error(error_msg)
+                    return None, error_msg
+                
+                result = await response.json(loads=orjson.loads)
+                if result.get("status") != 20000000:
+                    error_msg = (
+                        f"ASR识别失败: {result.get('message', '未知错误')} "
+                        f"(状态码: {result.get('status')})"
+                    )
+                    logger.error(error_msg)
+                    return None, error_msg
+                if not result.get("result"):
+                    return "", "ASR返回空结果"
+                
+                logger.debug("流式ASR识别成功: %s", result['result'])
+                return result["result"], None
+        except asyncio.TimeoutError:
+            return None, "ASR请求超时"
+        except Exception as e:
+            error_msg = f"ASR请求异常: {str(e)}"
+            logger.error(error_msg)
+            return None, error_msg
     
     async def process_audio_stream(self, audio_chunks: list, session_id: str) -> Tuple[Optional[str], Optional[str]]:
         if not audio_chunks:
-            print("[WARNING] 音频数据为空")
+            logger.warning("音频数据为空")
             return "", "音频数据为空"
         
         audio_data = b"".join(audio_chunks)
@@ -348,12 +594,14 @@ class ASRProvider:
 
 
 class AliBLProvider:
-    def __init__(self, config):
+    def __init__(self, config, get_session):
+        self._get_session = get_session
         self.access_key_id = config.get('access_key_id')
         self.access_key_secret = config.get('access_key_secret')
         self.api_key = config.get('api_key')
         self.api_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
         self.model = config.get('model', 'qwen-turbo')
+        self.timeout = config.get('timeout', _LLM_TIMEOUT)
         self._validate_config()
     
     def _validate_config(self):
@@ -376,49 +624,58 @@ class AliBLProvider:
             }
         }
         
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                print(f"[DEBUG] 发送LLM请求 (尝试 {attempt+1}/{max_retries}): URL={self.api_url}, 消息长度={len(str(data))}字符")
+        async def attempt(i: int) -> str:
+            logger.debug("发送LLM请求 (尝试 %s/%s): URL=%s, 消息长度=%s字符", i + 1, _MAX_RETRIES, self.api_url, len(str(data)))
+            
+            session = await self._get_session(self.api_url)
+            async with session.post(url=self.api_url, data=orjson.dumps(data), headers=headers) as response:
+                response_text = await response.text()
+                logger.debug("LLM响应: HTTP %s, 响应长度=%s字符", response.status, len(response_text))
                 
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=60)
-                    async with session.post(url=self.api_url, json=data, headers=headers, timeout=timeout) as response:
-                        response_text = await response.text()
-                        print(f"[DEBUG] LLM响应: HTTP {response.status}, 响应长度={len(response_text)}字符")
-                        
-                        if response.status == 200:
-                            result = await response.json()
-                            return result["output"]["text"]
-                        else:
-                            error = f"LLM请求失败: HTTP {response.status} - {response_text[:200]}..."
-                            print(f"[ERROR] {error}")
-                            if response.status == 429 or response.status >= 500:
-                                if attempt < max_retries - 1:
-                                    wait_time = 2 ** attempt
-                                    print(f"[DEBUG] 等待{wait_time}秒后重试...")
-                                    await asyncio.sleep(wait_time)
-                                    continue
-                            return error
-            except asyncio.TimeoutError:
-                error = f"LLM请求超时 (尝试 {attempt+1}/{max_retries})"
-                print(f"[ERROR] {error}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                return error
-            except Exception as e:
-                error = f"LLM请求异常: {str(e)}"
-                print(f"[ERROR] {error}")
-                traceback.print_exc()
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
+                if response.status == 200:
+                    result = await response.json(loads=orjson.loads)
+                    return result["output"]["text"]
+                
+                error = f"LLM请求失败: HTTP {response.status} - {response_text[:200]}..."
+                logger.error(error)
+                if response.status == 429 or response.status >= 500:
+                    raise _RetryableError(error)
                 return error
         
-        return "LLM请求失败，达到最大重试次数"
+        try:
+            return await _retry(attempt, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("LLM请求超时")
+            return "LLM请求超时"
+        except _RetryableError as e:
+            return str(e)
+        except Exception as e:
+            error = f"LLM请求异常: {str(e)}"
+            logger.exception(error)
+            return error
 
-    async def stream_response(self, messages) -> AsyncGenerator[str, None]:
+    @staticmethod
+    def _parse_sse_line(line: bytes) -> Optional[dict]:
+        """解析一行SSE数据，返回其中的output字段（含增量text和finish_reason），非data行或无output时返回None"""
+        line = line.strip()
+        if not line.startswith(b'data:'):
+            return None
+        chunk = line[5:].strip()
+        if not chunk:
+            return None
+        try:
+            # orjson直接解析bytes，不需要先解码为str
+            chunk_data = orjson.loads(chunk)
+            if isinstance(chunk_data.get("output"), dict):
+                return chunk_data["output"]
+            logger.warning("流式LLM返回非输出数据: %s", line)
+        except Exception as e:
+            logger.warning("流式LLM解析异常: %s - 原始数据: %s", e, line)
+        return None
+    
+    async def stream_text(self, messages) -> AsyncGenerator[str, None]:
+        """流式生成回复，逐段产出增量文本；请求失败、连接中断或流在finish_reason=stop之前结束时抛出异常。
+        两次收到数据之间最多等待self.timeout秒"""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}",
@@ -436,124 +693,100 @@ class AliBLProvider:
                 "incremental_output": True
             }
         }
-
-        try:
-            print(f"[DEBUG] 发送流式LLM请求: URL={self.api_url}")
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=120)
-                async with session.post(self.api_url, json=data, headers=headers, timeout=timeout) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        print(f"[ERROR] 流式LLM请求失败: HTTP {response.status} - {error_text}")
-                        return
-                    
-                    async for line in response.content:
-                        if not line:
-                            continue
-                        try:
-                            line_str = line.decode('utf-8').strip()
-                            if line_str.startswith('data:'):
-                                chunk = line_str[5:].strip()
-                                if chunk:
-                                    chunk_data = json.loads(chunk)
-                                    if "output" in chunk_data and "text" in chunk_data["output"]:
-                                        yield chunk_data["output"]["text"]
-                        except Exception as e:
-                            print(f"[WARNING] 流式LLM解析异常: {str(e)} - 原始数据: {line}")
-        except Exception as e:
-            print(f"[ERROR] 流式LLM请求失败: {str(e)}")
-            traceback.print_exc()
+        
+        logger.debug("发送流式LLM请求: URL=%s", self.api_url)
+        session = await self._get_session(self.api_url)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        async with session.post(self.api_url, data=orjson.dumps(data), headers=headers, timeout=timeout) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise _IncompleteStreamError(f"HTTP {response.status} - {error_text[:200]}")
+            
+            # 按网络数据块读取，在缓冲区中切分SSE行，不逐行读取StreamReader
+            finished = False
+            buffer = bytearray()
+            async for data, _ in response.content.iter_chunks():
+                buffer += data
+                while (end := buffer.find(b'\n')) != -1:
+                    line = bytes(buffer[:end])
+                    del buffer[:end + 1]
+                    output = self._parse_sse_line(line)
+                    if output is not None:
+                        finished = finished or output.get("finish_reason") == "stop"
+                        if output.get("text"):
+                            yield output["text"]
+            
+            # 最后一行可能没有换行符
+            output = self._parse_sse_line(bytes(buffer))
+            if output is not None:
+                finished = finished or output.get("finish_reason") == "stop"
+                if output.get("text"):
+                    yield output["text"]
+            
+            if not finished:
+                raise _IncompleteStreamError("流在生成结束前中断")
     
 class TTSProvider:
-    def __init__(self, config):
+    def __init__(self, config, get_session, token_cache: TokenCache):
+        self._get_session = get_session
+        self.token_cache = token_cache
         self.access_key_id = config.get('access_key_id')
         self.access_key_secret = config.get('access_key_secret')
         self.appkey = config.get('appkey')
-        self.token_url = "https://nls-meta.cn-shanghai.aliyuncs.com"
         self.tts_url = "https://nls-gateway.cn-shanghai.aliyuncs.com/stream/v1/tts"
-        self.region_id = "cn-shanghai"
-        self.product = "nls-cloud-meta"
         self.voice = config.get('voice', 'xiaoyun')
-        self.token = None
-        self.token_expire = 0
-        self._lock = asyncio.Lock()
+        self.timeout = config.get('timeout', _TTS_TIMEOUT)
         self._validate_config()
+        
+        # 重复的回复文本（问候语、常见答复）直接返回已合成的音频，按总字节数做LRU淘汰
+        self._cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_max_bytes = config.get('cache_bytes', _TTS_CACHE_BYTES)
     
     def _validate_config(self):
         required_keys = ['access_key_id', 'access_key_secret', 'appkey']
         missing_keys = [key for key in required_keys if not getattr(self, key)]
         if missing_keys:
             raise ValueError(f"TTS配置缺少必要的参数: {', '.join(missing_keys)}")
-    
-    async def get_tts_token(self):
-        """修复核心错误：时间戳格式 %Y-%m-d → %Y-%m-%d"""
-        if self.token and time.time() < self.token_expire:
-            return self.token
-        
-        async with self._lock:
-            if self.token and time.time() < self.token_expire:
-                return self.token
-                
-            
-            timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-            nonce = str(uuid.uuid4())
-            
-            params = {
-                "AccessKeyId": self.access_key_id,
-                "Action": "CreateToken",
-                "Product": self.product,
-                "RegionId": self.region_id,
-                "Format": "JSON",
-                "SignatureMethod": "HMAC-SHA1",
-                "SignatureVersion": "1.0",
-                "SignatureNonce": nonce,
-                "Timestamp": timestamp,
-                "Version": "2019-02-28"
-            }
-            
-            sorted_params = sorted(params.items())
-            canonicalized_query_string = "&".join(
-                [f"{parse.quote(k, safe='')}={parse.quote(v, safe='')}" for k, v in sorted_params]
-            )
-            
-            string_to_sign = "GET&%2F&" + parse.quote(canonicalized_query_string, safe="")
-            
-            key = self.access_key_secret + "&"
-            h = hmac.new(key.encode('utf-8'), string_to_sign.encode('utf-8'), hashlib.sha1)
-            signature = base64.b64encode(h.digest()).decode('utf-8')
-            
-            params["Signature"] = signature
-            
-            try:
-                print(f"[DEBUG] 获取TTS Token: URL={self.token_url}")
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=30)
-                    async with session.get(self.token_url, params=params, timeout=timeout) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            self.token = result["Token"]["Id"]
-                            self.token_expire = time.time() + 1800 - 60
-                            print(f"[DEBUG] 获取TTS Token成功")
-                            return self.token
-                        else:
-                            response_text = await response.text()
-                            print(f"[ERROR] 获取TTS Token失败: HTTP {response.status} - {response_text[:200]}...")
-            except asyncio.TimeoutError:
-                print(f"[ERROR] 获取TTS Token超时")
-            except Exception as e:
-                print(f"[ERROR] 获取TTS Token异常: {str(e)}")
-                traceback.print_exc()
-        
-        return None
 
+    def _cache_key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self.voice}|{text}".encode(), digest_size=16).digest()
+    
+    def _cache_put(self, key: bytes, audio_data: bytes):
+        if len(audio_data) > self._cache_max_bytes:
+            return
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._cache_bytes -= len(old)
+        self._cache[key] = audio_data
+        self._cache_bytes += len(audio_data)
+        while self._cache_bytes > self._cache_max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+    
     async def text_to_speech(self, text, session_id):
+        """合成语音，相同发音人和文本的结果从缓存返回"""
         if not text or len(text.strip()) == 0:
-            print("[WARNING] TTS输入文本为空")
+            logger.warning("TTS输入文本为空")
             return b""
         
-        token = await self.get_tts_token()
+        key = self._cache_key(text)
+        audio_data = self._cache.get(key)
+        if audio_data is not None:
+            self._cache.move_to_end(key)
+            logger.debug("TTS缓存命中, 音频长度: %s字节", len(audio_data))
+            return audio_data
+        
+        audio_data = await self._synthesize(text, session_id)
+        # 失败时返回空字节，不写入缓存
+        if audio_data and self._cache_max_bytes > 0:
+            self._cache_put(key, audio_data)
+        return audio_data
+    
+    async def _synthesize(self, text, session_id):
+        token = await self.token_cache.get()
         if not token:
-            print("[ERROR] 无法获取有效的TTS Token")
+            logger.error("无法获取有效的TTS Token")
             return b""
         
         url = f"{self.tts_url}"
@@ -567,53 +800,47 @@ class TTSProvider:
             "session_id": session_id
         }
         
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                print(f"[DEBUG] 发送TTS请求 (尝试 {attempt+1}/{max_retries}): URL={url}, 文本长度={len(text)}字符")
-                
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=30)
-                    async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
-                        if response.status == 200:
-                            audio_data = await response.read()
-                            print(f"[DEBUG] TTS合成成功, 音频长度: {len(audio_data)}字节")
-                            return audio_data
-                        else:
-                            error_text = await response.text()
-                            error_msg = f"TTS请求失败: HTTP {response.status} - {error_text[:200]}..."
-                            print(f"[ERROR] {error_msg}")
-                            if "token" in error_text.lower() and attempt < max_retries - 1:
-                                print("[DEBUG] Token可能失效，尝试刷新...")
-                                self.token = None
-                                await asyncio.sleep(1)
-                                continue
-                            return b""
-            except asyncio.TimeoutError:
-                print(f"[ERROR] TTS请求超时 (尝试 {attempt+1}/{max_retries})")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                return b""
-            except Exception as e:
-                error_msg = f"TTS请求异常: {str(e)}"
-                print(f"[ERROR] {error_msg}")
-                traceback.print_exc()
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                return b""
+        async def attempt(i: int) -> bytes:
+            logger.debug("发送TTS请求 (尝试 %s/%s): URL=%s, 文本长度=%s字符", i + 1, _MAX_RETRIES, url, len(text))
+            
+            session = await self._get_session(url)
+            async with session.post(url, data=orjson.dumps(payload), headers=headers) as response:
+                if response.status == 200:
+                    audio_data = await response.read()
+                    logger.debug("TTS合成成功, 音频长度: %s字节", len(audio_data))
+                    return audio_data
+                error_text = await response.text()
+            
+            error_msg = f"TTS请求失败: HTTP {response.status} - {error_text[:200]}..."
+            logger.error(error_msg)
+            if "token" in error_text.lower():
+                logger.debug("Token可能失效，尝试刷新...")
+                self.token_cache.invalidate(payload["token"])
+                token = await self.token_cache.get()
+                if token:
+                    payload["token"] = token
+                    raise _RetryableError(error_msg)
+            return b""
         
+        try:
+            return await _retry(attempt, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("TTS请求超时")
+        except _RetryableError:
+            pass
+        except Exception as e:
+            logger.exception("TTS请求异常: %s", e)
         return b""
 
-    async def stream_speech(self, text, session_id) -> AsyncGenerator[bytes, None]:
+    async def stream_speech(self, text, session_id, min_chunk: int = 16384) -> AsyncGenerator[bytes, None]:
+        """流式合成，网络上收到的小块音频累积到至少min_chunk字节再输出，最后一块可能更小"""
         if not text or len(text.strip()) == 0:
-            print("[WARNING] 流式TTS输入文本为空")
+            logger.warning("流式TTS输入文本为空")
             return
             
-        token = await self.get_tts_token()
+        token = await self.token_cache.get()
         if not token:
-            print("[ERROR] 无法获取有效的TTS Token")
+            logger.error("无法获取有效的TTS Token")
             return
         
         url = f"{self.tts_url}?enable_subtitle=true"
@@ -630,24 +857,45 @@ class TTSProvider:
         }
         
         try:
-            print(f"[DEBUG] 发送流式TTS请求: URL={url}, 文本长度={len(text)}字符")
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=60)
-                async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        print(f"[ERROR] 流式TTS请求失败: HTTP {response.status} - {error_text[:200]}...")
-                        return
-                    
-                    async for chunk in response.content.iter_any():
-                        if chunk:
-                            yield chunk
+            logger.debug("发送流式TTS请求: URL=%s, 文本长度=%s字符", url, len(text))
+            session = await self._get_session(url)
+            timeout = aiohttp.ClientTimeout(total=60)
+            async with session.post(url, data=orjson.dumps(payload), headers=headers, timeout=timeout) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error("流式TTS请求失败: HTTP %s - %s...", response.status, error_text[:200])
+                    return
+                
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(65536):
+                    buffer += chunk
+                    if len(buffer) >= min_chunk:
+                        yield bytes(buffer)
+                        buffer.clear()
+                if buffer:
+                    yield bytes(buffer)
         except Exception as e:
-            print(f"[ERROR] 流式TTS请求异常: {str(e)}")
-            traceback.print_exc()
+            logger.exception("流式TTS请求异常: %s", e)
 
 
 class AliyunProcessor:
+    # 系统Prompt，每次请求复用同一个消息对象
+    _SYSTEM_MESSAGES = (
+        {
+            "role": "system",
+            "content": """你是名为小云的智能语音助手，你的核心设定如下：
+1. 你的名字是小云，是一个友好的智能语音助手；
+2. 当用户向你打招呼（比如“你好”“哈喽”“我叫XX”）时，必须先回应“你好，我是小云，一个智能语音助手，请问有什么可以帮到您？”；
+3. 回答要简洁、友好，符合智能助手的身份。"""
+        },
+    )
+    
+    # 流式处理使用的简短系统Prompt
+    _STREAMING_SYSTEM_MESSAGE = {
+        "role": "system",
+        "content": "你是名为小云的智能语音助手，友好且专业，用户打招呼时要回应'你好，我是小云，一个智能语音助手，请问有什么可以帮到您？'"
+    }
+    
     def __init__(self, config):
         asr_config = config.get('asr', {})
         llm_config = config.get('llm', {})
@@ -655,9 +903,18 @@ class AliyunProcessor:
         
         self._validate_config(asr_config, llm_config, tts_config)
         
-        self.asr = ASRProvider(asr_config)
-        self.llm = AliBLProvider(llm_config)
-        self.tts = TTSProvider(tts_config)
+        # nls-meta、nls-gateway、dashscope各用一个ClientSession（独立连接池），各请求复用keep-alive连接，不再每次重新握手TCP/TLS
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._last_used: Dict[str, float] = {}
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+        
+        # ASR和TTS使用同一组AccessKey时共用一个令牌缓存，只需一次CreateToken调用
+        self._token_caches: Dict[tuple, TokenCache] = {}
+        
+        self.asr = ASRProvider(asr_config, self._get_session, self._get_token_cache(asr_config))
+        self.llm = AliBLProvider(llm_config, self._get_session)
+        self.tts = TTSProvider(tts_config, self._get_session, self._get_token_cache(tts_config))
         
         self.stats = {
             "asr_success": 0,
@@ -669,82 +926,164 @@ class AliyunProcessor:
             "total_processed": 0
         }
     
+    def _get_token_cache(self, config: dict) -> TokenCache:
+        """按(access_key_id, product, region)取令牌缓存，没有时创建"""
+        product = config.get('product', 'nls-cloud-meta')
+        region_id = config.get('region_id', 'cn-shanghai')
+        key = (config.get('access_key_id'), product, region_id)
+        cache = self._token_caches.get(key)
+        if cache is None:
+            cache = TokenCache(config.get('access_key_id'), config.get('access_key_secret'), self._get_session,
+                               product=product, region_id=region_id)
+            self._token_caches[key] = cache
+        return cache
+    
+    async def _get_session(self, url: str) -> aiohttp.ClientSession:
+        """按URL的主机取共享会话，首次使用时在当前事件循环中创建，超时由各请求单独指定"""
+        host = urllib.parse.urlsplit(url).netloc
+        self._last_used[host] = time.monotonic()
+        
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=32,
+                ttl_dns_cache=600,
+                keepalive_timeout=120,
+                force_close=False,
+                enable_cleanup_closed=True
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=60, connect=10)
+            )
+            self._sessions[host] = session
+        
+        if self._keepalive_task is None or self._keepalive_task.done():
+            self._keepalive_task = asyncio.create_task(self._keepalive_loop())
+        return session
+    
+    async def _keepalive_loop(self):
+        """空闲的主机定期发一次HEAD请求保持连接，超过_KEEPALIVE_IDLE_LIMIT未使用的主机不再保活"""
+        while True:
+            await asyncio.sleep(_KEEPALIVE_INTERVAL)
+            now = time.monotonic()
+            for host, session in list(self._sessions.items()):
+                idle = now - self._last_used.get(host, 0)
+                if session.closed or not _KEEPALIVE_INTERVAL <= idle < _KEEPALIVE_IDLE_LIMIT:
+                    continue
+                await self._ping(session, f"https://{host}/")
+    
+    @staticmethod
+    async def _ping(session: aiohttp.ClientSession, url: str):
+        """发一次HEAD请求，建立或保持到该主机的连接"""
+        try:
+            async with session.head(url, timeout=aiohttp.ClientTimeout(total=5)):
+                pass
+        except Exception as e:
+            logger.debug("连接预热/保活请求失败: %s - %s", url, e)
+    
+    async def warmup(self):
+        """并发获取语音服务令牌并与各上游主机建立连接，首个请求不再承担握手和令牌获取的开销"""
+        roots = {}
+        for url in (self.asr.asr_url, self.llm.api_url, self.tts.tts_url):
+            parts = urllib.parse.urlsplit(url)
+            roots[parts.netloc] = f"{parts.scheme}://{parts.netloc}/"
+        
+        async def ping(url):
+            await self._ping(await self._get_session(url), url)
+        
+        await asyncio.gather(
+            *(cache.get() for cache in self._token_caches.values()),
+            *(ping(url) for url in roots.values()),
+            return_exceptions=True
+        )
+        logger.debug("语音服务预热完成: %s", ", ".join(roots))
+    
+    def start_warmup(self):
+        """在当前事件循环中后台执行warmup，重复调用只预热一次"""
+        if self._warmup_task is None:
+            self._warmup_task = asyncio.create_task(self.warmup())
+    
     def _validate_config(self, asr_config, llm_config, tts_config):
         if not asr_config.get('access_key_id'):
-            print("[WARNING] ASR配置缺少access_key_id")
+            logger.warning("ASR配置缺少access_key_id")
         if not llm_config.get('api_key'):
-            print("[WARNING] LLM配置缺少api_key")
+            logger.warning("LLM配置缺少api_key")
         if not tts_config.get('access_key_id'):
-            print("[WARNING] TTS配置缺少access_key_id")
+            logger.warning("TTS配置缺少access_key_id")
     
     async def process(self, audio_data, chat_history=None):
         
         try:
-            session_id = f"session_{uuid.uuid4().hex[:8]}"
-            print(f"[INFO] 开始处理流程, Session ID: {session_id}")
+            session_id = make_session_id("session")
+            logger.info("开始处理流程, Session ID: %s", session_id)
             self.stats["total_processed"] += 1
             
             text, error = await self.asr.speech_to_text(audio_data, session_id)
             if error or not text:
                 error_msg = f"ASR失败: {error}" if error else "ASR返回空结果"
-                print(f"[ERROR] {error_msg}")
+                logger.error(error_msg)
                 self.stats["asr_failed"] += 1
                 return {"error": error_msg}
             
             self.stats["asr_success"] += 1
-            print(f"[DEBUG] ASR识别成功: '{text[:100]}...'" if len(text) > 100 else f"[DEBUG] ASR识别成功: '{text}'")
+            logger.debug("ASR识别成功: '%.100s'", text)
             
-            print(f"[DEBUG] 调用大模型...")
+            logger.debug("调用大模型...")
             # 添加系统Prompt
-            messages_for_llm = [
-                {
-                    "role": "system",
-                    "content": """你是名为小云的智能语音助手，你的核心设定如下：
-1. 你的名字是小云，是一个友好的智能语音助手；
-2. 当用户向你打招呼（比如“你好”“哈喽”“我叫XX”）时，必须先回应“你好，我是小云，一个智能语音助手，请问有什么可以帮到您？”；
-3. 回答要简洁、友好，符合智能助手的身份。"""
-                }
-            ]
+            messages_for_llm = list(self._SYSTEM_MESSAGES)
             #历史对话上下文
             if chat_history:
                 valid_history = [
                     msg for msg in chat_history 
-                    if msg.get("role") in ["user", "assistant"] and msg.get("content")
+                    if msg.get("role") in ("user", "assistant") and msg.get("content")
                 ]
-                messages_for_llm.extend(valid_history)
-                print(f"[DEBUG] 加载历史对话: {len(valid_history)} 条有效消息")
-            
+                messages_for_llm += valid_history
+                logger.debug("加载历史对话: %s 条有效消息", len(valid_history))
             messages_for_llm.append({"role": "user", "content": text})
             
-            llm_response = await self.llm.generate_response({
-                "messages": messages_for_llm
-            })
-            
-            if isinstance(llm_response, str) and (
-                llm_response.startswith("LLM请求失败") or 
-                llm_response.startswith("LLM请求异常") or
-                llm_response.startswith("LLM请求超时") or
-                "失败" in llm_response[:100] or
-                "错误" in llm_response[:100]
-            ):
+            # 流式接收回复，每凑满一句就开始合成语音，TTS与LLM后续输出重叠进行
+            try:
+                llm_response, tts_parts = await self._stream_reply_with_speech(
+                    {"messages": messages_for_llm}, session_id)
+            except (_IncompleteStreamError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 不完整的回复和已合成的部分音频都丢弃
+                logger.warning("流式LLM未正常结束: %r", e)
+                llm_response, tts_parts = "", None
+            if not llm_response:
+                # 流式请求失败时退回带重试的非流式请求
+                logger.warning("流式LLM无完整输出，改用非流式请求")
+                llm_response = await self.llm.generate_response({
+                    "messages": messages_for_llm
+                })
+                tts_parts = None
+            
+            if isinstance(llm_response, str) and _LLM_ERROR_PATTERN.search(llm_response, 0, 100):
                 error_msg = f"LLM处理失败: {llm_response[:200]}..."
-                print(f"[ERROR] {error_msg}")
+                logger.error(error_msg)
                 self.stats["llm_failed"] += 1
                 return {"error": error_msg}
             
             self.stats["llm_success"] += 1
-            print(f"[DEBUG] LLM回复成功: '{llm_response[:100]}...'" if len(llm_response) > 100 else f"[DEBUG] LLM回复成功: '{llm_response}'")
+            logger.debug("LLM回复成功: '%.100s'", llm_response)
             
-            print(f"[DEBUG] 开始TTS合成...")
-            tts_audio = await self.tts.text_to_speech(llm_response, session_id)
+            tts_audio = b""
+            if tts_parts is not None:
+                if all(tts_parts):
+                    tts_audio = _concat_wav(tts_parts)
+                else:
+                    logger.warning("部分句子的TTS合成失败，改为整段合成")
+            if not tts_audio:
+                logger.debug("开始TTS合成...")
+                tts_audio = await self.tts.text_to_speech(llm_response, session_id)
             if not tts_audio or len(tts_audio) < 100:
                 error_msg = f"TTS合成失败，音频长度: {len(tts_audio) if tts_audio else 0}字节"
-                print(f"[ERROR] {error_msg}")
+                logger.error(error_msg)
                 self.stats["tts_failed"] += 1
                 return {"error": error_msg}
             
             self.stats["tts_success"] += 1
-            print(f"[INFO] 处理流程完成")
+            logger.info("处理流程完成")
             
             return {
                 "text": text,
@@ -754,32 +1093,51 @@ class AliyunProcessor:
             }
         except Exception as e:
             error_msg = f"处理流程异常: {str(e)}"
-            print(f"[ERROR] {error_msg}")
-            traceback.print_exc()
+            logger.exception(error_msg)
             return {"error": error_msg}
     
+    async def _stream_reply_with_speech(self, messages, session_id) -> Tuple[str, list]:
+        """流式生成回复并按句并发合成语音，返回(完整回复, 按句顺序排列的音频列表)；
+        回复流未完整结束时抛出异常，已开始的合成被取消"""
+        slots = asyncio.Semaphore(_TTS_PIPELINE_CONCURRENCY)
+        
+        async def synthesize(sentence):
+            async with slots:
+                return await self.tts.text_to_speech(sentence, session_id)
+        
+        chunks = []
+        tasks = []
+        buffer = ""
+        try:
+            async for chunk in self.llm.stream_text(messages):
+                chunks.append(chunk)
+                buffer += chunk
+                while (match := _SENTENCE_END.search(buffer)) is not None:
+                    sentence, buffer = buffer[:match.end()], buffer[match.end():]
+                    if sentence.strip():
+                        tasks.append(asyncio.create_task(synthesize(sentence)))
+            if buffer.strip():
+                tasks.append(asyncio.create_task(synthesize(buffer)))
+            
+            return "".join(chunks), list(await asyncio.gather(*tasks))
+        finally:
+            for task in tasks:
+                task.cancel()
+    
     async def process_streaming(self, audio_chunks, session_id=None):
         if not session_id:
-            session_id = f"stream_{uuid.uuid4().hex[:8]}"
+            session_id = make_session_id("stream")
         
-        print(f"[INFO] 开始流式处理流程, Session ID: {session_id}")
+        logger.info("开始流式处理流程, Session ID: %s", session_id)
         
         text, error = await self.asr.process_audio_stream(audio_chunks, session_id)
         if error or not text:
             return {"error": f"ASR失败: {error}" if error else "ASR返回空结果"}
         
         async def llm_stream():
-            # 流式调用添加系统Prompt
-            messages = {
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "你是名为小云的智能语音助手，友好且专业，用户打招呼时要回应'你好，我是小云，一个智能语音助手，请问有什么可以帮到您？'"
-                    },
-                    {"role": "user", "content": text}
-                ]
-            }
-            async for chunk in self.llm.stream_response(messages):
+            # 流式调用添加系统Prompt；流未正常结束时抛出异常，由调用方决定如何处理不完整的回复
+            messages = {"messages": [self._STREAMING_SYSTEM_MESSAGE, {"role": "user", "content": text}]}
+            async for chunk in self.llm.stream_text(messages):
                 yield {"type": "llm", "data": chunk}
         
         async def tts_stream(llm_text):
@@ -795,11 +1153,29 @@ class AliyunProcessor:
     def get_stats(self):
         return self.stats.copy()
     
+    async def aclose(self):
+        """取消预热和连接保活任务，并发关闭共享的HTTP会话"""
+        tasks = [task for task in (self._warmup_task, self._keepalive_task) if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        self._warmup_task = None
+        self._keepalive_task = None
+        
+        sessions, self._sessions = self._sessions, {}
+        cleanups = [session.close() for session in sessions.values() if not session.closed]
+        
+        # 被取消的任务在这里一并等待结束，单个清理失败不影响其余清理
+        results = await asyncio.gather(*tasks, *cleanups, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("清理资源失败: %s", result)
+    
     async def close(self):
         if hasattr(self.asr, '_executor'):
             self.asr._executor.shutdown(wait=False)
+        await self.aclose()
         
-        print("[INFO] 处理器资源已清理")
+        logger.info("处理器资源已清理")
 
 
 def create_test_audio(duration=3, sample_rate=16000):
@@ -809,28 +1185,25 @@ def create_test_audio(duration=3, sample_rate=16000):
             wav_file.setsampwidth(2)
             wav_file.setframerate(sample_rate)
             
-            frames = b''
+            base_freq = 250
+            formant_freq = 1000
             amplitude = 32767 * 0.3
-            for i in range(int(sample_rate * duration)):
-                base_freq = 250
-                formant_freq = 1000
-                t = i / sample_rate
-                dynamic_freq = base_freq + 50 * math.sin(2 * math.pi * 5 * t)
-                
-                sample_val = amplitude * (
-                    0.5 * (math.sin(2 * math.pi * dynamic_freq * t) + 0.5 * math.sin(4 * math.pi * dynamic_freq * t)) +
-                    0.3 * math.sin(2 * math.pi * formant_freq * t) +
-                    0.03 * random.uniform(-1, 1))
-                
-                sample_val = max(-32768, min(32767, sample_val))
-                sample = int(sample_val)
-                frames += struct.pack('<h', sample)
-                
-            wav_file.writeframes(frames)
+            t = np.arange(int(sample_rate * duration), dtype=np.float64) / sample_rate
+            dynamic_freq = base_freq + 50 * np.sin(2 * np.pi * 5 * t)
+            
+            sample_val = amplitude * (
+                0.5 * (np.sin(2 * np.pi * dynamic_freq * t) + 0.5 * np.sin(4 * np.pi * dynamic_freq * t)) +
+                0.3 * np.sin(2 * np.pi * formant_freq * t) +
+                0.03 * np.random.uniform(-1, 1, size=t.shape))
+            
+            samples = np.clip(sample_val, -32768, 32767).astype('<i2')
+            wav_file.writeframes(samples.tobytes())
         return wav_io.getvalue()
 
 
+@lru_cache(maxsize=1)
 def check_dependencies():
+    """检查运行依赖，结果在进程内缓存，ffmpeg命令只执行一次"""
     missing = []
     try:
         import aiohttp
@@ -842,24 +1215,28 @@ def check_dependencies():
     except ImportError:
         missing.append("wave (Python内置，不应缺失)")
     
-    try:
-        result = subprocess.run(['ffmpeg', '-version'], 
-                               capture_output=True, 
-                               text=True,
-                               timeout=5)
-        if result.returncode != 0:
-            print("[WARNING] ffmpeg命令执行失败")
-    except FileNotFoundError:
-        print("[WARNING] ffmpeg未安装，音频转换功能可能受限")
-    except subprocess.TimeoutExpired:
-        print("[WARNING] ffmpeg检查超时")
+    # 先查PATH，未安装时不必启动子进程
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        logger.warning("ffmpeg未安装，音频转换功能可能受限")
+    else:
+        try:
+            result = subprocess.run([ffmpeg, '-version'], 
+                                   capture_output=True, 
+                                   text=True,
+                                   timeout=5)
+            if result.returncode != 0:
+                logger.warning("ffmpeg命令执行失败")
+        except OSError:
+            logger.warning("ffmpeg命令执行失败")
+        except subprocess.TimeoutExpired:
+            logger.warning("ffmpeg检查超时")
     
     if missing:
-        print(f"[ERROR] 缺少依赖: {', '.join(missing)}")
-        print("请安装: pip install " + " ".join(missing))
+        logger.error("缺少依赖: %s，请安装: pip install %s", ", ".join(missing), " ".join(missing))
         return False
     
-    print("[INFO] 所有依赖检查通过")
+    logger.info("所有依赖检查通过")
     return True
 
 
@@ -894,8 +1271,8 @@ async def main():
     processor = None
     try:
         processor = AliyunProcessor(SAMPLE_CONFIG)
-        test_audio = create_test_audio(duration=2)
-        print(f"[INFO] 测试音频创建完成，长度: {len(test_audio)}字节")
+        test_audio = await asyncio.to_thread(create_test_audio, 2)
+        logger.info("测试音频创建完成，长度: %s字节", len(test_audio))
         
         result = await processor.process(test_audio)
         
@@ -914,8 +1291,7 @@ async def main():
             print(f"{key}: {value}")
             
     except Exception as e:
-        print(f"[ERROR] 主程序异常: {str(e)}")
-        traceback.print_exc()
+        logger.exception("主程序异常: %s", e)
     finally:
         if processor:
             await processor.close()
@@ -924,10 +1300,19 @@ class UnifiedProcessorAPI:
     def __init__(self, config: dict):
         self.config = config
         self.processor = None
+        # 同一段音频的并发请求共用一次处理：音频摘要 -> 处理任务
+        self._inflight: Dict[bytes, asyncio.Task] = {}
         
     def initialize(self):
         try:
             self.processor = AliyunProcessor(self.config)
+            # 在事件循环中初始化时后台预热连接和令牌
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                self.processor.start_warmup()
             return True, "初始化成功"
         except Exception as e:
             return False, f"初始化失败: {str(e)}"
@@ -940,11 +1325,20 @@ class UnifiedProcessorAPI:
         
         try:
             if not session_id:
-                session_id = f"gradio_{uuid.uuid4().hex[:8]}"
+                session_id = make_session_id("gradio")
             
-            result = await self.processor.process(audio_data)
-            return result
+            key = hashlib.blake2b(audio_data, digest_size=16).digest()
+            task = self._inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self.processor.process(audio_data))
+                self._inflight[key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            else:
+                logger.debug("相同音频的请求正在处理，等待其结果")
+            # 处理在独立任务中进行，某个请求断开不影响共享同一任务的其他请求
+            return dict(await asyncio.shield(task))
         except Exception as e:
+            logger.exception("处理失败: %s", e)
             return {"error": f"处理失败: {str(e)}"}
     
     def get_capabilities(self):
@@ -963,7 +1357,9 @@ class HTTPVoiceHandler:
     async def handle_request(self, request_data: dict, audio_data: bytes = None):
         try:
             username = request_data.get("username", "anonymous")
-            session_id = request_data.get("session_id", f"http_{uuid.uuid4().hex[:8]}")
+            session_id = request_data.get("session_id")
+            if session_id is None:
+                session_id = make_session_id("http")
             
             if audio_data is None:
                 return {
@@ -989,17 +1385,78 @@ class HTTPVoiceHandler:
             }
             
         except Exception as e:
+            logger.exception("处理请求失败: %s", e)
             return {
                 "success": False,
                 "error": f"处理请求失败: {str(e)}"
             }
+    
+    async def handle_request_stream(self, request_data: dict, audio_data: bytes = None) -> AsyncGenerator[bytes, None]:
+        """流式处理请求，不在内存中攒完整音频：先输出一行JSON（识别文本、回复文本等），随后是若干
+        "4字节大端长度+16kHz单声道16bit PCM"的音频帧，以长度为0的帧结束；失败时只输出一行success=false的JSON"""
+        session_id = request_data.get("session_id")
+        if session_id is None:
+            session_id = make_session_id("http")
+        
+        def error_line(error: str) -> bytes:
+            logger.error(error)
+            return orjson.dumps({"success": False, "error": error}) + b"\n"
+        
+        if audio_data is None:
+            yield error_line("没有提供音频数据")
+            return
+        
+        if not self.processor_api.processor:
+            success, message = self.processor_api.initialize()
+            if not success:
+                yield error_line(message)
+                return
+        
+        header_sent = False
+        try:
+            result = await self.processor_api.processor.process_streaming([audio_data], session_id)
+            if "error" in result:
+                yield error_line(result["error"])
+                return
+            
+            # 回复不完整时不输出成功结果，也不合成半截回复的语音
+            try:
+                response = "".join([item["data"] async for item in result["llm_stream"]])
+            except (_IncompleteStreamError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                yield error_line(f"LLM处理失败: 流式回复未正常结束 ({e!r})")
+                return
+            if not response:
+                yield error_line("LLM处理失败: 回复为空")
+                return
+            
+            yield orjson.dumps({
+                "success": True,
+                "text": result["text"],
+                "response": response,
+                "session_id": session_id,
+                "timestamp": int(time.time())
+            }) + b"\n"
+            header_sent = True
+            
+            async for item in result["tts_stream"](response):
+                yield _FRAME_LENGTH.pack(len(item["data"]))
+                yield item["data"]
+        except Exception as e:
+            logger.exception("流式处理请求失败: %s", e)
+            if not header_sent:
+                yield error_line(f"处理请求失败: {str(e)}")
+                return
+        # 音频中途出错时也以空帧结束
+        yield _FRAME_LENGTH.pack(0)
 
 __all__ = [
     "AliyunProcessor",
     "UnifiedProcessorAPI",
     "HTTPVoiceHandler",
-    "create_test_audio"
+    "create_test_audio",
+    "make_session_id"
 ]
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
\ No newline at end of file
@@ -1,17 +1,57 @@
 import asyncio
+import io
 import logging
-import uuid
-from typing import Dict, Any, Optional, Tuple
-from unified_processor import AliyunProcessor
+import os
+import struct
+from typing import Dict, Any, Optional, Tuple, AsyncIterable, AsyncGenerator
+from urllib.parse import quote, unquote
+from unified_processor import AliyunProcessor, make_session_id
 
 logger = logging.getLogger(__name__)
 
+def _streaming_wav_header(sample_rate: int = 16000, channels: int = 1, sample_width: int = 2) -> bytes:
+    """长度未知的WAV文件头（RIFF/data大小填最大值），用于边合成边输出的PCM流"""
+    byte_rate = sample_rate * channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 0xFFFFFFFF, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8,
+        b'data', 0xFFFFFFFF - 36
+    )
+
+def voice_result_headers(result: Dict[str, Any]) -> Dict[str, str]:
+    """语音回复以原始WAV返回时，将识别文本、回复等元数据放入响应头（中文经URL编码）"""
+    return {
+        "X-Recognized-Text": quote(result.get("recognized_text", "")),
+        "X-Response-Text": quote(result.get("response", "")),
+        "X-Intent": result.get("intent", "C"),
+        "X-Intent-Description": quote(result.get("intent_description", "")),
+        "X-User-Id": str(result.get("user_id", 0)),
+        "X-Is-New-User": "1" if result.get("is_new_user") else "0",
+        "X-Timestamp": result.get("timestamp") or ""
+    }
+
+def parse_voice_result_headers(headers) -> Dict[str, Any]:
+    """从语音回复的响应头还原元数据，与voice_result_headers对应"""
+    return {
+        "recognized_text": unquote(headers.get("X-Recognized-Text", "")),
+        "response": unquote(headers.get("X-Response-Text", "")),
+        "intent": headers.get("X-Intent", "C"),
+        "intent_description": unquote(headers.get("X-Intent-Description", "")),
+        "user_id": int(headers.get("X-User-Id", 0)),
+        "is_new_user": headers.get("X-Is-New-User") == "1",
+        "channel": "voice",
+        "timestamp": headers.get("X-Timestamp", "")
+    }
+
 class VoiceProcessor:
     """语音处理器，封装阿里云语音服务"""
     
     def __init__(self):
         self.processor = None
+        self.whisper_model = None
         self._initialize_processor()
+        self._initialize_whisper()
     
     def _initialize_processor(self):
         """初始化语音处理器"""
@@ -20,29 +60,41 @@ class VoiceProcessor:
                 ASR_ACCESS_KEY_ID,
                 ASR_ACCESS_KEY_SECRET,
                 ASR_APPKEY,
+                ASR_FFMPEG_WORKERS,
+                ASR_FFMPEG_THREADS_PER,
+                ASR_TIMEOUT,
                 TTS_ACCESS_KEY_ID,
                 TTS_ACCESS_KEY_SECRET,
                 TTS_APPKEY,
                 TTS_VOICE,
+                TTS_CACHE_BYTES,
+                TTS_TIMEOUT,
                 ALIYUN_LLM_API_KEY,
-                ALIYUN_LLM_MODEL
+                ALIYUN_LLM_MODEL,
+                ALIYUN_LLM_TIMEOUT
             )
             
             config = {
                 "asr": {
                     "access_key_id": ASR_ACCESS_KEY_ID,
                     "access_key_secret": ASR_ACCESS_KEY_SECRET,
-                    "appkey": ASR_APPKEY
+                    "appkey": ASR_APPKEY,
+                    "ffmpeg_workers": ASR_FFMPEG_WORKERS,
+                    "ffmpeg_threads_per": ASR_FFMPEG_THREADS_PER,
+                    "timeout": ASR_TIMEOUT
                 },
                 "llm": {
                     "api_key": ALIYUN_LLM_API_KEY,
-                    "model": ALIYUN_LLM_MODEL
+                    "model": ALIYUN_LLM_MODEL,
+                    "timeout": ALIYUN_LLM_TIMEOUT
                 },
                 "tts": {
                     "access_key_id": TTS_ACCESS_KEY_ID,
                     "access_key_secret": TTS_ACCESS_KEY_SECRET,
                     "appkey": TTS_APPKEY,
-                    "voice": TTS_VOICE
+                    "voice": TTS_VOICE,
+                    "cache_bytes": TTS_CACHE_BYTES,
+                    "timeout": TTS_TIMEOUT
                 }
             }
             
@@ -54,26 +106,89 @@ class VoiceProcessor:
             self.processor = None
             return False
     
+    def start_warmup(self):
+        """在当前事件循环中后台预热阿里云语音服务的连接和令牌"""
+        if self.processor:
+            self.processor.start_warmup()
+    
+    async def aclose(self):
+        """关闭语音处理器共享的HTTP会话"""
+        if self.processor:
+            await self.processor.aclose()
+    
+    def _initialize_whisper(self):
+        """按配置初始化本地faster-whisper识别模型（CTranslate2 int8量化）"""
+        from config import ASR_BACKEND, WHISPER_MODEL, WHISPER_DEVICE
+        if ASR_BACKEND != "faster_whisper":
+            return
+        
+        try:
+            from faster_whisper import WhisperModel
+            
+            compute_type = "int8" if WHISPER_DEVICE == "cpu" else "int8_float16"
+            self.whisper_model = WhisperModel(
+                WHISPER_MODEL,
+                device=WHISPER_DEVICE,
+                compute_type=compute_type,
+                cpu_threads=max(1, (os.cpu_count() or 2) // 2)
+            )
+            logger.info(f"faster-whisper初始化成功: {WHISPER_MODEL} ({WHISPER_DEVICE}, {compute_type})")
+        except Exception as e:
+            logger.error(f"faster-whisper初始化失败，使用阿里云ASR: {e}")
+            self.whisper_model = None
+    
+    def _whisper_transcribe(self, audio_data: bytes) -> str:
+        """同步执行本地识别；segments为惰性生成器，需在同一线程内消费完"""
+        segments, _ = self.whisper_model.transcribe(
+            io.BytesIO(audio_data),
+            language="zh",
+            beam_size=1,
+            vad_filter=True  # 跳过静音段
+        )
+        return "".join(segment.text for segment in segments).strip()
+    
     async def speech_to_text(self, audio_data: bytes) -> Tuple[Optional[str], Optional[str]]:
         """语音转文本"""
+        if self.whisper_model is not None:
+            try:
+                text = await asyncio.to_thread(self._whisper_transcribe, audio_data)
+                if not text:
+                    return None, "未识别到语音内容"
+                return text, None
+            except Exception as e:
+                logger.error(f"本地语音识别失败: {e}")
+                return None, str(e)
+        
         if not self.processor:
             return None, "语音处理器未初始化"
         
         try:
-            session_id = f"crm_{uuid.uuid4().hex[:8]}"
+            session_id = make_session_id("crm")
             text, error = await self.processor.asr.speech_to_text(audio_data, session_id)
             return text, error
         except Exception as e:
             logger.error(f"语音识别失败: {e}")
             return None, str(e)
     
+    async def speech_to_text_stream(self, audio_chunks: AsyncIterable[bytes]) -> Tuple[Optional[str], Optional[str]]:
+        """流式语音转文本（16kHz单声道16bit PCM），音频边上传边转发给ASR"""
+        if not self.processor:
+            return None, "语音处理器未初始化"
+        
+        try:
+            session_id = make_session_id("crm")
+            return await self.processor.asr.speech_to_text_stream(audio_chunks, session_id)
+        except Exception as e:
+            logger.error(f"流式语音识别失败: {e}")
+            return None, str(e)
+    
     async def text_to_speech(self, text: str) -> Tuple[Optional[bytes], Optional[str]]:
         """文本转语音"""
         if not self.processor:
             return None, "语音处理器未初始化"
         
         try:
-            session_id = f"crm_{uuid.uuid4().hex[:8]}"
+            session_id = make_session_id("crm")
             audio_data = await self.processor.tts.text_to_speech(text, session_id)
             if not audio_data or len(audio_data) < 100:
                 return None, "语音合成失败"
@@ -82,8 +197,21 @@ class VoiceProcessor:
             logger.error(f"语音合成失败: {e}")
             return None, str(e)
     
-    async def process_voice_query(self, audio_data: bytes, phone_number: str) -> Dict[str, Any]:
-        """处理完整的语音查询"""
+    async def text_to_speech_stream(self, text: str) -> AsyncGenerator[bytes, None]:
+        """流式文本转语音：合成出第一块音频后先输出WAV头，随后逐块输出16kHz单声道PCM"""
+        if not self.processor:
+            return
+        
+        session_id = make_session_id("crm")
+        header_sent = False
+        async for chunk in self.processor.tts.stream_speech(text, session_id):
+            if not header_sent:
+                yield _streaming_wav_header(16000)
+                header_sent = True
+            yield chunk
+    
+    async def process_voice_query(self, audio_data: bytes, phone_number: str, engine=None) -> Dict[str, Any]:
+        """处理完整的语音查询，engine为调用方已有的ResponseEngine实例"""
         # 语音转文本
         text, error = await self.speech_to_text(audio_data)
         if error or not text:
@@ -94,11 +222,13 @@ class VoiceProcessor:
             }
         
         # 使用CRM的响应引擎处理文本
-        from response_engine import ResponseEngine
-        engine = ResponseEngine()
+        if engine is None:
+            from response_engine import ResponseEngine
+            engine = ResponseEngine()
         
         # 设置语音通道
-        result = engine.process_query(phone_number, text, channel='voice')
+        # process_query为同步阻塞调用（意图识别、RAG、LLM），放到线程池中执行，避免阻塞事件循环
+        result = await asyncio.to_thread(engine.process_query, phone_number, text, 'voice')
         
         # 文本转语音
         if result.get("response"):